@@ -1,15 +1,44 @@
 # New Oasis Orders and Returns Debug Script
 import os
 import json
+import hashlib
 import requests
 import sys
 from datetime import datetime, timedelta
 from pprint import pprint
 from io import StringIO
 import argparse # Add argparse
+import threading
+import contextvars
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+import step1_output
+import zoho_auth
+import zoho_cache
+import zoho_client
+import zoho_concurrency
+import zoho_store
+import zoho_telemetry
 
 # CONFIGURATION
 CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config_inventory.json')
+ZOHO_API_BASE_URL = "https://www.zohoapis.com/inventory/v1"
+# Upper bound on concurrent detail requests (per-SO, per-package, per-RMA) issued by run_step1.
+# Can be overridden per call or with the STEP1_MAX_WORKERS environment variable.
+DEFAULT_MAX_WORKERS = int(os.environ.get('STEP1_MAX_WORKERS', '8'))
+# Rows per list page (Zoho's maximum), used for the organization-wide list scans.
+LIST_PAGE_SIZE = 200
+# STEP2 only reads package serials of endoscope SKUs, and only treats orders with a
+# HiFCSA plan as cohorts (keep these in sync with STEP2.ENDOSCOPE_SKUS and its
+# csa_sku_keywords). Package details of other orders are not fetched unless
+# STEP1_PREFILTER=0.
+RELEVANT_ENDOSCOPE_SKUS = {'P313N00', 'P417N00'}
+CSA_SKU_KEYWORDS = ['HiFCSA-1yr', 'HiFCSA-2yr']
+PREFILTER_IRRELEVANT_ORDERS = os.environ.get('STEP1_PREFILTER', '1').lower() not in ('0', 'false', 'no')
+PACKAGES_SKIPPED_REASON = "no endoscope or CSA plan line items"
+# Suffix of the progress journal kept next to the output file while run_step1 is running.
+CHECKPOINT_SUFFIX = '.checkpoint.jsonl'
 
 def load_config():
     """Loads configuration from the JSON file."""
@@ -23,52 +52,40 @@ def get_headers(config):
         'X-com-zoho-organizationid': config['organization_id']
     }
 
-def refresh_access_token(config):
-    """Refreshes the Zoho OAuth access token."""
-    print("Refreshing access token...")
-    url = "https://accounts.zoho.com/oauth/v2/token"
-    data = {
-        'refresh_token': config['refresh_token'],
-        'client_id': config['client_id'],
-        'client_secret': config['client_secret'],
-        'grant_type': 'refresh_token'
-    }
-    try:
-        response = requests.post(url, data=data)
-        response.raise_for_status()
-        tokens = response.json()
-        if 'access_token' not in tokens:
-            raise Exception(f"Failed to refresh token. Response: {tokens}")
-        config['access_token'] = tokens['access_token']
-        with open(CONFIG_PATH, 'w') as f:
-            json.dump(config, f, indent=2)
-        print("Access token refreshed successfully.")
-        return config['access_token']
-    except requests.exceptions.RequestException as e:
-        print(f"Error refreshing access token: {e}")
-        if response is not None:
-            print(f"Response status: {response.status_code}")
-            print(f"Response body: {response.text}")
-        raise
+def refresh_access_token(config, stale_token=None):
+    """
+    Refreshes the Zoho OAuth access token in config (and the config file) unless
+    another worker already replaced stale_token (default: config's current token).
+    """
+    if stale_token is None:
+        stale_token = config.get('access_token')
+    return zoho_auth.get_token_manager(CONFIG_PATH).refresh(config, stale_token)
 
 def zoho_get(url, config, params=None, max_retries=5, backoff_factor=2):
     """Makes a GET request to the Zoho API, handling token refresh and 429 rate limits."""
     import time
+    # Refresh ahead of the recorded expiry rather than waiting for a 401
+    access_token = zoho_auth.get_token_manager(CONFIG_PATH).ensure_fresh(config)
     headers = get_headers(config)
     retries = 0
     while retries <= max_retries:
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = zoho_client.get_client().get(url, headers=headers, params=params)
             if response.status_code == 401:
                 print("Token expired, refreshing...")
-                refresh_access_token(config)
+                access_token = refresh_access_token(config, stale_token=access_token)
                 headers = get_headers(config) # Get updated headers
-                response = requests.get(url, headers=headers, params=params) # Retry request
+                zoho_telemetry.record_retry(zoho_client.endpoint_label(url), token_refresh=True)
+                response = zoho_client.get_client().get(url, headers=headers, params=params) # Retry request
 
             if response.status_code == 429:
-                wait_time = backoff_factor ** retries
+                # Honour Zoho's Retry-After; fall back to exponential backoff without one
+                wait_time = zoho_concurrency.retry_after_seconds(response)
+                if wait_time is None:
+                    wait_time = backoff_factor ** retries
                 print(f"Rate limit hit (429). Waiting {wait_time} seconds before retrying (attempt {retries+1}/{max_retries})...")
                 time.sleep(wait_time)
+                zoho_telemetry.record_retry(zoho_client.endpoint_label(url), throttle_wait=wait_time)
                 retries += 1
                 continue
 
@@ -81,9 +98,12 @@ def zoho_get(url, config, params=None, max_retries=5, backoff_factor=2):
                 print(f"Response body: {response.text}")
             if isinstance(e, requests.exceptions.HTTPError) and getattr(e.response, 'status_code', None) == 429:
                 # Already handled above, but just in case
-                wait_time = backoff_factor ** retries
+                wait_time = zoho_concurrency.retry_after_seconds(e.response)
+                if wait_time is None:
+                    wait_time = backoff_factor ** retries
                 print(f"Rate limit hit (429) in exception. Waiting {wait_time} seconds before retrying (attempt {retries+1}/{max_retries})...")
                 time.sleep(wait_time)
+                zoho_telemetry.record_retry(zoho_client.endpoint_label(url), throttle_wait=wait_time)
                 retries += 1
                 continue
             raise # Re-raise the exception to halt execution if needed
@@ -112,11 +132,126 @@ def fetch_salesorders_for_customer(config, customer_id):
 
     return all_salesorders
 
-def fetch_package_detail(config, package_id):
+def parse_zoho_timestamp(value):
+    """Parses a Zoho timestamp such as '2025-01-27T14:43:43-0500'. Returns None if missing or malformed."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+    except (TypeError, ValueError):
+        return None
+
+def fetch_salesorders_modified_since(config, customer_id, watermark):
+    """
+    Fetch a customer's sales orders newest-modified first, stopping once a page
+    ends with an order modified before the watermark. Returns (salesorders, reached_end);
+    reached_end is True when the whole list was paged, so ids missing from it were deleted.
+    With customer_id=None the organization-wide list is paged instead.
+    """
+    scope = f"customer ID: {customer_id}" if customer_id else "all customers"
+    print(f"Fetching sales orders modified since {watermark} for {scope}...")
+    watermark_dt = parse_zoho_timestamp(watermark)
+    url = f"{ZOHO_API_BASE_URL}/salesorders"
+    params = {'sort_column': 'last_modified_time', 'sort_order': 'D', 'per_page': LIST_PAGE_SIZE}
+    if customer_id:
+        params['customer_id'] = customer_id
+    salesorders = []
+    page = 1
+    has_more_pages = True
+
+    while has_more_pages:
+        params['page'] = page
+        data = zoho_get(url, config, params)
+        if not data:
+            # A silently short list would advance the watermark past orders we never saw.
+            raise RuntimeError(f"Failed to fetch sales order page {page} for {scope}")
+        page_salesorders = data.get('salesorders', [])
+        salesorders.extend(page_salesorders)
+        has_more_pages = data.get('page_context', {}).get('has_more_page', False)
+        print(f"  Fetched page {page}, total SOs so far: {len(salesorders)}")
+        page += 1
+
+        if has_more_pages and watermark_dt and page_salesorders:
+            oldest_on_page = parse_zoho_timestamp(page_salesorders[-1].get('last_modified_time'))
+            # Strictly older: orders sharing the watermark timestamp may continue on the next page.
+            if oldest_on_page and oldest_on_page < watermark_dt:
+                print(f"  Reached watermark after {page-1} page(s); remaining orders are unchanged.")
+                return salesorders, False
+
+    return salesorders, True
+
+def fetch_all_salesreturns(config):
+    """Fetch the organization-wide sales return list. Raises RuntimeError if a page fails."""
+    print("Fetching sales returns for all customers...")
+    url = f"{ZOHO_API_BASE_URL}/salesreturns"
+    params = {'per_page': LIST_PAGE_SIZE}
+    all_salesreturns = []
+    page = 1
+    has_more_pages = True
+
+    while has_more_pages:
+        params['page'] = page
+        data = zoho_get(url, config, params)
+        if not data:
+            raise RuntimeError(f"Failed to fetch sales return page {page} for all customers")
+        all_salesreturns.extend(data.get('salesreturns', []))
+        has_more_pages = data.get('page_context', {}).get('has_more_page', False)
+        print(f"  Fetched page {page}, total RMAs so far: {len(all_salesreturns)}")
+        page += 1
+
+    return all_salesreturns
+
+def partition_by_customer(documents, contact_ids):
+    """Groups list rows by customer_id (keeping list order), for the given contacts only."""
+    partitioned = {customer_id: [] for customer_id in contact_ids}
+    for document in documents:
+        rows = partitioned.get(document.get('customer_id'))
+        if rows is not None:
+            rows.append(document)
+    return partitioned
+
+def partition_batched_lists(salesorders, salesorders_complete, salesreturns, contact_ids):
+    """Builds the prefetched_lists structure accepted by run_step1 from org-wide list rows."""
+    return {
+        "salesorders": partition_by_customer(salesorders, contact_ids),
+        "salesorders_complete": salesorders_complete,
+        "salesreturns": partition_by_customer(salesreturns, contact_ids),
+    }
+
+def fetch_batched_lists(config, contact_ids, modified_since=None):
+    """
+    Pages the organization-wide sales order and sales return lists once and
+    partitions them by customer_id, so list-call volume no longer grows with the
+    number of contacts. With modified_since (the oldest watermark among the
+    contacts), sales order paging stops once it passes that watermark.
+    """
+    salesorders, salesorders_complete = fetch_salesorders_modified_since(config, None, modified_since)
+    salesreturns = fetch_all_salesreturns(config)
+    print(f"Batched lists: {len(salesorders)} sales orders, {len(salesreturns)} sales returns across the organization")
+    return partition_batched_lists(salesorders, salesorders_complete, salesreturns, contact_ids)
+
+def fetch_detail(config, endpoint, object_id, validator=None):
+    """
+    Fetch the raw detail response for /{endpoint}/{object_id}, going through the
+    on-disk response cache. validator (e.g. the document's last_modified_time from
+    the list call) must match the cached entry for it to be reused.
+    """
+    cache = zoho_cache.get_cache()
+    if cache is not None:
+        cached = cache.get(endpoint, object_id, validator)
+        if cached is not None:
+            return cached
+
+    data = zoho_get(f"{ZOHO_API_BASE_URL}/{endpoint}/{object_id}", config, {'organization_id': config['organization_id']})
+    # Only cache successful responses (Zoho reports errors with a non-zero 'code')
+    if cache is not None and data and data.get('code', 0) == 0:
+        cache.put(endpoint, object_id, data, validator)
+    return data
+
+def fetch_package_detail(config, package_id, validator=None):
     """Fetch detailed information for a specific package."""
     print(f"Fetching details for Package ID: {package_id}...")
-    url = f"https://www.zohoapis.com/inventory/v1/packages/{package_id}"
-    return zoho_get(url, config).get('package', {})
+    return fetch_detail(config, 'packages', package_id, validator).get('package', {})
 
 def fetch_salesreturns_for_customer(config, customer_id):
     """Fetch all sales returns for a customer using server-side filtering."""
@@ -138,264 +273,815 @@ def fetch_salesreturns_for_customer(config, customer_id):
 
     return all_salesreturns
 
-def fetch_salesreturn_detail(config, salesreturn_id):
+def fetch_salesreturn_detail(config, salesreturn_id, validator=None):
     """Fetch detailed information for a specific sales return."""
-    print(f"Fetching details for Sales Return ID: {salesreturn_id}...")
-    url = f"https://www.zohoapis.com/inventory/v1/salesreturns/{salesreturn_id}"
-    return zoho_get(url, config).get('salesreturn', {})
+    print(f"  Fetching details for RMA ID: {salesreturn_id}...")
+    return fetch_detail(config, 'salesreturns', salesreturn_id, validator).get('salesreturn', {})
+
+def salesorder_needs_packages(so_detail):
+    """
+    True if the order's package details can affect STEP2: it has an endoscope line
+    item (whose shipped serials STEP2 tracks) or a CSA plan line item.
+    Packages only contain the order's own line items, so this is decided from the SO detail.
+    """
+    for item in so_detail.get('line_items', []):
+        if not isinstance(item, dict):
+            continue
+        item_sku = item.get('sku', '') or ''
+        item_name = (item.get('name', '') or '').lower()
+        if item_sku in RELEVANT_ENDOSCOPE_SKUS:
+            return True
+        if any(kw in item_sku for kw in CSA_SKU_KEYWORDS) or ('csa' in item_name and 'prepaid' in item_name):
+            return True
+    return False
+
+def mark_packages_skipped(so_detail, prefilter=PREFILTER_IRRELEVANT_ORDERS):
+    """
+    Returns True (and records the skip on the detail for auditing) if the order's
+    package details should not be fetched.
+    """
+    if not prefilter or not so_detail.get('packages') or salesorder_needs_packages(so_detail):
+        return False
+    so_detail['package_details_skipped'] = PACKAGES_SKIPPED_REASON
+    return True
+
+def skipped_package_fetches(salesorders):
+    """Lists the orders whose package details were skipped by the relevance prefilter."""
+    return [
+        {
+            "salesorder_id": so.get('salesorder_id'),
+            "salesorder_number": so.get('salesorder_number'),
+            "package_ids": [pkg.get('package_id') for pkg in so.get('packages', [])],
+            "reason": so['package_details_skipped'],
+        }
+        for so in salesorders if so and so.get('package_details_skipped')
+    ]
+
+def fetch_salesorder_with_packages(config, salesorder_id, modified_time=None):
+    """
+    Fetch a sales order's detail plus the detail of each of its packages.
+    Package line items (with serial numbers) are stored on the SO's package
+    entries as 'detailed_line_items', which is the shape STEP2 expects.
+    modified_time is the order's last_modified_time from the list call; the
+    cached detail is reused only while it matches. Cached package details are
+    validated by the order's modified time and the package's status on it (see
+    package_validator).
+    Orders that cannot affect STEP2 keep their package summaries but get no
+    package detail requests (see mark_packages_skipped).
+    """
+    print(f"  Fetching details for SO ID: {salesorder_id}...")
+    so_detail_data = fetch_detail(config, 'salesorders', salesorder_id, modified_time)
+    so_detail = so_detail_data.get('salesorder', {})
+    if mark_packages_skipped(so_detail):
+        return so_detail
+
+    so_modified_time = modified_time or so_detail.get('last_modified_time')
+    for pkg_from_so in so_detail.get('packages', []):
+        pkg_id = pkg_from_so.get('package_id')
+        if not pkg_id:
+            continue
+        # Fetch package details to get line items with serial numbers
+        print(f"      Fetching details for Package ID: {pkg_id}...")
+        pkg_detail_data = fetch_detail(config, 'packages', pkg_id, package_validator(so_modified_time, pkg_from_so))
+        attach_package_line_items(pkg_from_so, pkg_detail_data)
+
+    return so_detail
+
+def package_validator(so_modified_time, pkg_from_so):
+    """
+    Cache validator of a package's detail. A package can be edited (serials,
+    line items) without its status changing, which updates its order's
+    last_modified_time, so both go into the validator.
+    """
+    return f"{so_modified_time}|{pkg_from_so.get('status')}"
+
+def attach_package_line_items(pkg_from_so, pkg_detail_data):
+    """Stores a package detail response's line items on the SO's package entry as 'detailed_line_items'."""
+    # Check if line_items are directly in the response or nested under 'package'
+    pkg_line_items = None
+    if 'line_items' in pkg_detail_data:
+        pkg_line_items = pkg_detail_data['line_items']
+    elif 'package' in pkg_detail_data and 'line_items' in pkg_detail_data['package']:
+        pkg_line_items = pkg_detail_data['package']['line_items']
+
+    if pkg_line_items:
+        # Store detailed line items in the package object for JSON output
+        pkg_from_so['detailed_line_items'] = pkg_line_items
+
+def map_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Applies func to every item using a bounded thread pool and yields the
+    results in input order, regardless of completion order. An exception from
+    any call propagates to the caller just like in a sequential loop. The calls
+    run in a copy of the caller's context (e.g. its telemetry clinic group).
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    context = contextvars.copy_context()
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    try:
+        yield from executor.map(lambda item: context.copy().run(func, item), items)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def print_salesorder_detail(so, so_detail):
+    """Prints the line items and packages of a fetched sales order."""
+    so_id = so.get('salesorder_id')
+    so_number = so.get('salesorder_number')
+    so_date = so.get('date')
+    so_status = so.get('status')
+    print(f"\n--- Sales Order: {so_number} (ID: {so_id}, Date: {so_date}, Status: {so_status}) ---")
+
+    if not so_detail:
+        print("  Failed to fetch sales order details.")
+        return
+
+    # Extract shipment_date directly from sales order detail AFTER fetching
+    shipment_date_so = so_detail.get('shipment_date', 'N/A')
+    print(f"  Sales Order Shipment Date: {shipment_date_so}") # Print shipment date after fetching details
+
+    # Display line items from the detailed sales order
+    line_items = so_detail.get('line_items', [])
+    print(f"  Line Items ({len(line_items)}):")
+    for item in line_items:
+        item_name = item.get('name', 'N/A')
+        item_sku = item.get('sku', 'N/A')
+        item_qty = item.get('quantity', 0)
+        print(f"    - {item_name} (SKU: {item_sku}, Qty: {item_qty})")
+
+    # Get packages from the detailed sales order
+    packages = so_detail.get('packages', [])
+    if not packages:
+        print("  No packages found for this sales order.")
+        return
+    if so_detail.get('package_details_skipped'):
+        print(f"  Skipped details for {len(packages)} package(s): {so_detail['package_details_skipped']}.")
+        return
+
+    print(f"  Packages ({len(packages)}):")
+    for pkg_from_so in packages:
+        pkg_id = pkg_from_so.get('package_id')
+        pkg_number = pkg_from_so.get('package_number')
+        pkg_status = pkg_from_so.get('status')
+        shipment = pkg_from_so.get('shipment_order', {})
+        delivery_date = shipment.get('delivery_date', 'N/A')
+        tracking_number = shipment.get('tracking_number', 'N/A')
+
+        print(f"\n    Package: {pkg_number} (ID: {pkg_id}, Status: {pkg_status})")
+        print(f"      Delivery Date: {delivery_date}")
+        print(f"      Tracking Number: {tracking_number}")
+
+        if not pkg_id:
+            print("      Package ID not available, cannot fetch details.")
+            continue
+
+        pkg_line_items = pkg_from_so.get('detailed_line_items')
+        if not pkg_line_items:
+            print("      No line items found in package details.")
+            continue
+
+        print(f"      Line Items in Package ({len(pkg_line_items)}):")
+        for line in pkg_line_items:
+            line_name = line.get('name', 'N/A')
+            line_sku = line.get('sku', 'N/A')
+            line_qty = line.get('quantity', 0)
+            line_serials = line.get('serial_numbers', [])
+            # Check if this is an endoscope item
+            is_endoscope = "endoscope" in line_name.lower() or "scope" in line_name.lower()
+
+            print(f"        - {line_name} (SKU: {line_sku}, Qty: {line_qty})") # Corrected SKU reference
+            if line_serials:
+                print(f"          Serial Numbers: {', '.join(line_serials)}")
+            elif is_endoscope:
+                print(f"          No serial numbers recorded for this endoscope")
+
+def print_salesreturn_detail(rma, rma_detail):
+    """Prints the line items and return receipts of a fetched sales return."""
+    rma_id = rma.get('salesreturn_id')
+    rma_number = rma.get('salesreturn_number')
+    rma_date = rma.get('date')
+    rma_status = rma.get('status')
+    rma_so_number = rma.get('salesorder_number', 'N/A')
+
+    print(f"\n--- RMA: {rma_number} (ID: {rma_id}, Date: {rma_date}, Status: {rma_status}) ---")
+    print(f"  Associated Sales Order: {rma_so_number}")
+
+    if not rma_detail:
+        print("  Failed to fetch sales return details.")
+        return
+
+    line_items = rma_detail.get('line_items', [])
+    detailed_receive_status = rma_detail.get('receive_status', 'N/A')
+    print(f"  Receive Status (Detail): {detailed_receive_status}")
+
+    # Display line items - include all endoscope items regardless of serial numbers
+    print(f"  Line Items ({len(line_items)}):")
+    for item in line_items:
+        item_name = item.get('name', 'N/A')
+        item_sku = item.get('sku', 'N/A')
+        item_qty = item.get('quantity', 0)
+        item_serials = item.get('serial_numbers', [])
+
+        # Check if this is an endoscope item
+        is_endoscope = "endoscope" in item_name.lower() or "scope" in item_name.lower()
+
+        print(f"    - {item_name} (SKU: {item_sku}, Qty: {item_qty})")
+        if item_serials:
+            print(f"      Serial Numbers: {', '.join(item_serials)}")
+        elif is_endoscope:
+            print(f"      No serial numbers recorded for this endoscope")
+
+    # Display salesreturnreceives information (return receipts)
+    salesreturnreceives = rma_detail.get('salesreturnreceives', [])
+    if not salesreturnreceives:
+        print("  No return receipts found for this RMA.")
+        return
+
+    print(f"  Return Receipts ({len(salesreturnreceives)}):")
+    for receive in salesreturnreceives:
+        receive_id = receive.get('receive_id')
+        receive_number = receive.get('receive_number')
+        receive_date = receive.get('date')
+        receive_notes = receive.get('notes', 'N/A')
 
-def run_step1(contact_ids, output_json_path):
+        print(f"    Receipt: {receive_number} (ID: {receive_id}, Date: {receive_date})")
+        if receive_notes != 'N/A':
+            print(f"      Notes: {receive_notes}")
+
+        # Display line items in the receipt
+        receive_items = receive.get('line_items', [])
+        if receive_items:
+            print(f"      Items Received ({len(receive_items)}):")
+            for item in receive_items:
+                item_name = item.get('name', 'N/A')
+                item_qty = item.get('quantity', 0)
+                item_serials = item.get('serial_numbers', [])
+
+                # Check if this is an endoscope item
+                is_endoscope = "endoscope" in item_name.lower() or "scope" in item_name.lower()
+
+                print(f"        - {item_name} (Qty: {item_qty})")
+                if item_serials:
+                    print(f"          Serial Numbers: {', '.join(item_serials)}")
+                elif is_endoscope:
+                    print(f"          No serial numbers recorded for this endoscope")
+
+def salesreturn_change_key(rma):
+    """
+    Returns the value used to detect that a sales return changed between syncs.
+    Sales returns carry no reliable last_modified_time, so unless Zoho supplies
+    one the key is a fingerprint of the list row (status, receive status, ...).
+    """
+    if rma.get('last_modified_time'):
+        return rma['last_modified_time']
+    return hashlib.sha1(json.dumps(rma, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_previous_step1_output(output_json_path):
+    """
+    Loads an earlier run_step1 output (JSON or NDJSON) to seed an incremental sync.
+    Returns {'sync_state', 'salesorders_by_id', 'salesreturns_by_id'}, or None if the
+    file is missing, unreadable or predates sync_state. For NDJSON outputs the
+    by-id mappings read each document from disk when it is looked up.
+    """
+    if not os.path.exists(output_json_path):
+        print(f"No previous Step 1 output at {output_json_path}; running a full sync.")
+        return None
+    try:
+        footer, salesorders_by_id, salesreturns_by_id = step1_output.load_step1_documents_by_id(output_json_path)
+    except (OSError, ValueError) as e:
+        print(f"Could not read previous Step 1 output {output_json_path} ({e}); running a full sync.")
+        return None
+    if not isinstance(footer.get('sync_state'), dict):
+        print(f"Previous Step 1 output {output_json_path} has no sync_state; running a full sync.")
+        return None
+    return {
+        "sync_state": footer['sync_state'],
+        "salesorders_by_id": salesorders_by_id,
+        "salesreturns_by_id": salesreturns_by_id,
+    }
+
+class Step1Checkpoint:
+    """
+    Append-only journal of sales order and sales return details completed during a
+    run, stored next to the output as <output>.checkpoint.jsonl. If a run dies before
+    writing its output, the next run reuses journaled details whose validator
+    (last_modified_time / salesreturn_change_key) still matches the list call,
+    instead of fetching them again. The journal is deleted once the output is saved.
+    Only the validator and byte offset of each entry are kept in memory; details are
+    read back from the journal when needed, so it also serves as the run's spill
+    store for fetched documents (see FetchedDocuments).
+    """
+
+    def __init__(self, output_json_path):
+        self.path = f"{output_json_path}{CHECKPOINT_SUFFIX}"
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._reader = None
+        self.resumed = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # A line cut short by the crash that interrupted the previous run
+                self._entries[(entry['kind'], entry['id'])] = (entry['validator'], offset)
+        print(f"Loaded {len(self._entries)} completed documents from checkpoint {self.path}")
+
+    def contains(self, kind, object_id):
+        return (kind, object_id) in self._entries
+
+    def read(self, kind, object_id):
+        """Returns the journaled detail for the document, or None if it has none."""
+        entry = self._entries.get((kind, object_id))
+        if entry is None:
+            return None
+        with self._lock:
+            if self._reader is None:
+                self._reader = open(self.path, 'rb')
+            self._reader.seek(entry[1])
+            line = self._reader.readline()
+        return json.loads(line)['detail']
+
+    def get(self, kind, object_id, validator):
+        """Returns the journaled detail if present and still current, else None."""
+        entry = self._entries.get((kind, object_id))
+        if entry is None or entry[0] != validator:
+            return None
+        with self._lock:
+            self.resumed += 1
+        return self.read(kind, object_id)
+
+    def record(self, kind, object_id, validator, detail):
+        """Appends a completed document to the journal (flushed immediately)."""
+        line = json.dumps({"kind": kind, "id": object_id, "validator": validator, "detail": detail})
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+                if self._file.tell() > 0:
+                    # Start on a fresh line in case the previous run died mid-write
+                    self._file.write(b"\n")
+            offset = self._file.tell()
+            self._file.write(line.encode('utf-8') + b"\n")
+            self._file.flush()
+            self._entries[(kind, object_id)] = (validator, offset)
+
+    def close(self):
+        with self._lock:
+            for handle in (self._file, self._reader):
+                if handle is not None:
+                    handle.close()
+            self._file = None
+            self._reader = None
+
+    def remove(self):
+        """Deletes the journal after the run's output has been saved."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class FetchedDocuments(Mapping):
+    """
+    Details fetched during one contact's sync, keyed by id. Documents the checkpoint
+    has journaled are read back from it on access rather than held in memory.
+    Failed fetches are not part of the mapping; their ids are kept in .failed.
+    """
+
+    def __init__(self, kind, checkpoint=None):
+        self.kind = kind
+        self.checkpoint = checkpoint
+        self.failed = set()
+        self._held = {}
+        self._journaled = set()
+
+    def add(self, object_id, detail):
+        if not detail:
+            self.failed.add(object_id)
+        elif self.checkpoint is not None and self.checkpoint.contains(self.kind, object_id):
+            self._journaled.add(object_id)
+        else:
+            self._held[object_id] = detail
+
+    def __getitem__(self, object_id):
+        if object_id in self._journaled:
+            return self.checkpoint.read(self.kind, object_id)
+        return self._held[object_id]
+
+    def __contains__(self, object_id):
+        return object_id in self._journaled or object_id in self._held
+
+    def __iter__(self):
+        yield from self._held
+        yield from self._journaled
+
+    def __len__(self):
+        return len(self._held) + len(self._journaled)
+
+def fetch_with_checkpoint(checkpoint, kind, object_id, validator, fetch):
+    """Returns the document from the checkpoint if possible, otherwise fetch() and journal it."""
+    if checkpoint is not None:
+        detail = checkpoint.get(kind, object_id, validator)
+        if detail is not None:
+            return detail
+    detail = fetch()
+    if checkpoint is not None and detail:
+        checkpoint.record(kind, object_id, validator, detail)
+    return detail
+
+def index_previous_output(previous_output):
+    """Returns (contacts_state, salesorder details by id, salesreturn details by id) from a previous output."""
+    if not previous_output:
+        return {}, {}, {}
+    return (
+        previous_output['sync_state'].get('contacts', {}),
+        previous_output['salesorders_by_id'],
+        previous_output['salesreturns_by_id'],
+    )
+
+def select_salesorders_to_fetch(salesorders, previous_state, previous_details):
+    """Returns the listed orders that are new or whose last_modified_time moved since the previous sync."""
+    known = previous_state.get('salesorders', {}) if previous_state else {}
+    return [
+        so for so in salesorders
+        if so.get('salesorder_id') not in previous_details
+        or known.get(so.get('salesorder_id')) != so.get('last_modified_time')
+    ]
+
+def merge_contact_salesorders(salesorders, reached_end, fetched, previous_state, previous_details):
+    """
+    Merges freshly fetched order details (a FetchedDocuments keyed by salesorder_id)
+    with the previous sync's details. Returns (details, state) where details is an
+    iterator that loads each document as it is consumed, and state holds per-order
+    last_modified_time values and the contact's new watermark.
+    """
+    known = previous_state.get('salesorders', {}) if previous_state else {}
+    listed = {so.get('salesorder_id'): so for so in salesorders}
+
+    # New orders first (in list order), then previously known orders in their previous order.
+    ordered_ids = [so_id for so_id in listed if so_id not in known]
+    ordered_ids += [so_id for so_id in known if so_id in listed or not reached_end]
+
+    state = {}
+    for so_id in ordered_ids:
+        if so_id in fetched:
+            state[so_id] = listed[so_id].get('last_modified_time')
+        else:
+            # Not re-fetched, or the fetch failed: keep the previous detail and timestamp so it is retried next sync
+            state[so_id] = known.get(so_id)
+    any_failed = bool(fetched.failed)
+    details = (fetched[so_id] if so_id in fetched else previous_details.get(so_id, {}) for so_id in ordered_ids)
+
+    watermark = latest_zoho_timestamp(state.values())
+    if any_failed:
+        # Hold the watermark back (to none at all on a first sync) so the next sync pages back to the failed orders
+        watermark = previous_state.get('salesorders_watermark') if previous_state else None
+
+    return details, {'salesorders': state, 'salesorders_watermark': watermark}
+
+def latest_zoho_timestamp(values):
+    """Returns the latest of some Zoho timestamps (ignoring missing or malformed ones), or None."""
+    timestamps = [(parse_zoho_timestamp(t), t) for t in values]
+    timestamps = [pair for pair in timestamps if pair[0]]
+    return max(timestamps)[1] if timestamps else None
+
+def previous_contact_salesorders(previous_state, previous_details):
+    """Returns (details, state) exactly as recorded by the previous sync, used when listing fails."""
+    details = (previous_details.get(so_id, {}) for so_id in previous_state.get('salesorders', {}))
+    state = {key: previous_state.get(key) for key in ('salesorders', 'salesorders_watermark')}
+    return details, state
+
+def select_salesreturns_to_fetch(salesreturns, previous_state, previous_details):
+    """Returns the listed returns that are new or whose salesreturn_change_key moved."""
+    known = previous_state.get('salesreturns', {}) if previous_state else {}
+    return [
+        rma for rma in salesreturns
+        if rma.get('salesreturn_id') not in previous_details
+        or known.get(rma.get('salesreturn_id')) != salesreturn_change_key(rma)
+    ]
+
+def merge_contact_salesreturns(salesreturns, fetched, previous_state, previous_details):
+    """
+    Merges freshly fetched return details (a FetchedDocuments) with the previous
+    sync's. Returns (details iterator, state).
+    """
+    known = previous_state.get('salesreturns', {}) if previous_state else {}
+    state = {}
+    for rma in salesreturns:
+        rma_id = rma.get('salesreturn_id')
+        state[rma_id] = salesreturn_change_key(rma) if rma_id in fetched else known.get(rma_id)
+    details = (
+        fetched[rma_id] if rma_id in fetched else previous_details.get(rma_id, {})
+        for rma_id in (rma.get('salesreturn_id') for rma in salesreturns)
+    )
+    return details, {'salesreturns': state}
+
+def sync_contact_salesorders(config, customer_id, previous_state, previous_details, max_workers, listed=None,
+                             checkpoint=None):
+    """
+    Fetches one contact's sales order details. With previous_state, only orders that are
+    new or whose last_modified_time moved are re-fetched; the rest are reused from
+    previous_details (keyed by salesorder_id). listed, if given, is a prefetched
+    (salesorders, reached_end) pair used instead of listing the contact's orders.
+    Completed orders are journaled to checkpoint (a Step1Checkpoint), if given, and
+    read back from it as details is consumed. Returns (details, state, fetched_count).
+    """
+    if listed is not None:
+        salesorders, reached_end = listed
+    elif previous_state:
+        salesorders, reached_end = fetch_salesorders_modified_since(config, customer_id, previous_state.get('salesorders_watermark'))
+    else:
+        salesorders, reached_end = fetch_salesorders_for_customer(config, customer_id), True
+
+    to_fetch = select_salesorders_to_fetch(salesorders, previous_state, previous_details)
+    print(f"Found {len(salesorders)} listed sales orders for {customer_id}; {len(to_fetch)} new or modified")
+
+    # Fetch detailed data (SO + its packages) for each sales order concurrently
+    fetched = FetchedDocuments('salesorders', checkpoint)
+    so_details = map_concurrently(
+        lambda so: fetch_with_checkpoint(
+            checkpoint, 'salesorders', so.get('salesorder_id'), so.get('last_modified_time'),
+            lambda: fetch_salesorder_with_packages(config, so.get('salesorder_id'), so.get('last_modified_time'))
+        ),
+        to_fetch,
+        max_workers
+    )
+    for so, so_detail in zip(to_fetch, so_details):
+        print_salesorder_detail(so, so_detail)
+        fetched.add(so.get('salesorder_id'), so_detail)
+
+    details, state = merge_contact_salesorders(salesorders, reached_end, fetched, previous_state, previous_details)
+    return details, state, len(to_fetch)
+
+def sync_contact_salesreturns(config, customer_id, previous_state, previous_details, max_workers, listed=None,
+                              checkpoint=None):
+    """
+    Fetches one contact's sales return details, re-fetching only returns that are new
+    or whose salesreturn_change_key moved. listed, if given, is the contact's
+    prefetched return rows. Returns (details, state, fetched_count).
+    """
+    salesreturns = listed if listed is not None else fetch_salesreturns_for_customer(config, customer_id)
+
+    to_fetch = select_salesreturns_to_fetch(salesreturns, previous_state, previous_details)
+    print(f"Found {len(salesreturns)} sales returns for {customer_id}; {len(to_fetch)} new or modified")
+
+    # Fetch detailed RMA info (line items, receive status, salesreturnreceives) concurrently
+    fetched = FetchedDocuments('salesreturns', checkpoint)
+    rma_details = map_concurrently(
+        lambda rma: fetch_with_checkpoint(
+            checkpoint, 'salesreturns', rma.get('salesreturn_id'), salesreturn_change_key(rma),
+            lambda: fetch_salesreturn_detail(config, rma.get('salesreturn_id'), salesreturn_change_key(rma))
+        ),
+        to_fetch,
+        max_workers
+    )
+    for rma, rma_detail in zip(to_fetch, rma_details):
+        print_salesreturn_detail(rma, rma_detail)
+        fetched.add(rma.get('salesreturn_id'), rma_detail)
+
+    details, state = merge_contact_salesreturns(salesreturns, fetched, previous_state, previous_details)
+    return details, state, len(to_fetch)
+
+def write_contact_documents(writer, salesorders, salesreturns):
+    """
+    Streams one contact's merged details to a step1_output writer.
+    Returns the contact's skipped_package_fetches entries.
+    """
+    skipped = []
+    for so_detail in salesorders:
+        writer.write('salesorders', so_detail)
+        skipped.extend(skipped_package_fetches([so_detail]))
+    for rma_detail in salesreturns:
+        writer.write('salesreturns', rma_detail)
+    return skipped
+
+def finish_step1_output(writer, skipped, contacts_state, sync_mode, salesorders_fetched, salesreturns_fetched):
+    """Prints the run summary and completes the Step 1 output (the contract STEP2 reads)."""
+    print(f"\n--- Aggregation Summary ({sync_mode} sync) ---")
+    print(f"Sales order details fetched: {salesorders_fetched}")
+    print(f"Sales return details fetched: {salesreturns_fetched}")
+    print(f"Total detailed sales orders processed: {writer.counts['salesorders']}")
+    print(f"Total detailed sales returns processed: {writer.counts['salesreturns']}")
+    print(f"Sales orders with package details skipped by the relevance prefilter: {len(skipped)}")
+    cache = zoho_cache.get_cache()
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
+
+    writer.close({
+        "skipped_package_fetches": skipped,
+        "sync_state": {
+            "mode": sync_mode,
+            "synced_at": datetime.now().isoformat(),
+            "salesorders_fetched": salesorders_fetched,
+            "salesreturns_fetched": salesreturns_fetched,
+            "contacts": contacts_state
+        }
+    })
+    print(f"\nAggregated data saved to {writer.path}")
+
+def prefetched_for_contact(prefetched_lists, customer_id, previous_state):
+    """
+    Returns (listed salesorders, listed salesreturns) for a contact from prefetched_lists,
+    or (None, None) if the contact must list its own documents: either nothing was
+    prefetched, or the batched order list stopped at a watermark this contact has no state for.
+    """
+    if not prefetched_lists or customer_id not in prefetched_lists['salesorders']:
+        return None, None
+    if not prefetched_lists['salesorders_complete'] and not previous_state:
+        return None, None
+    return (
+        (prefetched_lists['salesorders'][customer_id], prefetched_lists['salesorders_complete']),
+        prefetched_lists['salesreturns'][customer_id],
+    )
+
+def run_step1(contact_ids, output_json_path, max_workers=DEFAULT_MAX_WORKERS, incremental=False, prefetched_lists=None,
+              resume=True):
     """
     Fetches sales orders and returns for a list of contact IDs,
-    aggregates them, and saves the results to JSON.
+    aggregates them, and saves the results to JSON. If output_json_path ends in
+    .ndjson, each contact's documents are streamed to the file as soon as the
+    contact is done instead (see step1_output), so memory does not grow with
+    the number of documents.
+    Detail requests (SO + packages, RMA) run on a pool of up to max_workers
+    threads; results are collected in list order so the JSON output is
+    identical to a sequential run.
+    With incremental=True, the sync_state saved in an existing output file is
+    used to re-fetch only documents that changed since that sync, and the
+    result is merged with the previous details. Contacts without saved state
+    (and files without sync_state) get a full fetch.
+    prefetched_lists (from fetch_batched_lists) supplies each contact's list rows
+    so the per-contact list calls are skipped.
+    Completed documents are journaled to <output_json_path>.checkpoint.jsonl; with
+    resume=True a run that died part-way is resumed from that journal.
     Loads configuration internally.
     Logging/stdout capture is handled by the calling script.
     """
     # Output capture is now handled by the calling script (process_clinics_alt.py)
 
-    all_salesorders_data = []
-    all_salesreturns_data = []
-    detailed_salesorders = []
-    detailed_salesreturns = []
+    skipped = []
+    contacts_state = {}
+    salesorders_fetched = 0
+    salesreturns_fetched = 0
+    checkpoint = None
+    writer = None
 
     try:
         # Load configuration internally
         config = load_config()
         print("Configuration loaded within run_step1.")
+        zoho_client.get_client().concurrency_limiter.start_at(max_workers)
+
+        if not resume and os.path.exists(f"{output_json_path}{CHECKPOINT_SUFFIX}"):
+            os.remove(f"{output_json_path}{CHECKPOINT_SUFFIX}")
+        checkpoint = Step1Checkpoint(output_json_path)
+
+        previous_output = load_previous_step1_output(output_json_path) if incremental else None
+        previous_contacts, previous_so_details, previous_rma_details = index_previous_output(previous_output)
+        sync_mode = 'incremental' if previous_output else 'full'
+        writer = step1_output.open_step1_writer(output_json_path, contact_ids)
 
-        print(f"Starting Step 1 processing for contact IDs: {', '.join(contact_ids)}")
+        print(f"Starting Step 1 processing ({sync_mode}) for contact IDs: {', '.join(contact_ids)} (max workers: {max_workers})")
 
         for customer_id in contact_ids:
             print(f"\n--- Processing Contact ID: {customer_id} ---")
+            previous_state = previous_contacts.get(customer_id)
+            listed_salesorders, listed_salesreturns = prefetched_for_contact(prefetched_lists, customer_id, previous_state)
 
             # PART 1: Get all sales orders for the current customer_id
             print("\n" + "="*40 + f" Sales Orders for {customer_id} " + "="*40)
-            current_salesorders = fetch_salesorders_for_customer(config, customer_id)
-            print(f"Found {len(current_salesorders)} sales orders for {customer_id}")
-            all_salesorders_data.extend(current_salesorders)
-
-            # Fetch detailed data for each sales order for JSON output
-            for so in current_salesorders: # Process only the current customer's orders here for details
-                so_id = so.get('salesorder_id')
-                so_number = so.get('salesorder_number')
-                so_date = so.get('date')
-                so_status = so.get('status')
-                print(f"\n--- Sales Order: {so_number} (ID: {so_id}, Date: {so_date}, Status: {so_status}) ---")
-
-                # Fetch detailed sales order info to get line items, packages, and shipment date
-                print(f"  Fetching details for SO ID: {so_id}...")
-                so_detail_data = zoho_get(
-                    f"https://www.zohoapis.com/inventory/v1/salesorders/{so_id}",
-                    config,
-                    {'organization_id': config['organization_id']}
+            try:
+                so_details, so_state, so_count = sync_contact_salesorders(
+                    config, customer_id, previous_state, previous_so_details, max_workers, listed_salesorders, checkpoint
                 )
-                so_detail = so_detail_data.get('salesorder', {})
-                detailed_salesorders.append(so_detail) # Collect detailed data
-
-                if not so_detail:
-                    print("  Failed to fetch sales order details.")
-                    # Print basic info even if details fail
-                    continue
-
-                # Extract shipment_date directly from sales order detail AFTER fetching
-                shipment_date_so = so_detail.get('shipment_date', 'N/A')
-                print(f"  Sales Order Shipment Date: {shipment_date_so}") # Print shipment date after fetching details
-
-                # Display line items from the detailed sales order
-                line_items = so_detail.get('line_items', [])
-                print(f"  Line Items ({len(line_items)}):")
-                for item in line_items:
-                    item_name = item.get('name', 'N/A')
-                    item_sku = item.get('sku', 'N/A')
-                    item_qty = item.get('quantity', 0)
-                    print(f"    - {item_name} (SKU: {item_sku}, Qty: {item_qty})")
-
-                # Get packages from the detailed sales order
-                packages = so_detail.get('packages', [])
-                if packages:
-                    print(f"  Packages ({len(packages)}):")
-                    for i, pkg_from_so in enumerate(packages):
-                        pkg_id = pkg_from_so.get('package_id')
-                        pkg_number = pkg_from_so.get('package_number')
-                        pkg_status = pkg_from_so.get('status')
-                        shipment = pkg_from_so.get('shipment_order', {})
-                        delivery_date = shipment.get('delivery_date', 'N/A')
-                        tracking_number = shipment.get('tracking_number', 'N/A')
-
-                        print(f"\n    Package: {pkg_number} (ID: {pkg_id}, Status: {pkg_status})")
-                        print(f"      Delivery Date: {delivery_date}")
-                        print(f"      Tracking Number: {tracking_number}")
-
-                        if pkg_id:
-                            # Fetch package details to get line items with serial numbers
-                            print(f"      Fetching details for Package ID: {pkg_id}...")
-                            pkg_detail_data = zoho_get(
-                                f"https://www.zohoapis.com/inventory/v1/packages/{pkg_id}",
-                                config,
-                                {'organization_id': config['organization_id']}
-                            )
-
-                            # Check if line_items are directly in the response or nested under 'package'
-                            pkg_line_items = None
-                            if 'line_items' in pkg_detail_data:
-                                pkg_line_items = pkg_detail_data['line_items']
-                            elif 'package' in pkg_detail_data and 'line_items' in pkg_detail_data['package']:
-                                pkg_line_items = pkg_detail_data['package']['line_items']
-
-                            if pkg_line_items:
-                                # Store detailed line items in the package object for JSON output
-                                pkg_from_so['detailed_line_items'] = pkg_line_items
-
-                                print(f"      Line Items in Package ({len(pkg_line_items)}):")
-                                for line in pkg_line_items:
-                                    line_name = line.get('name', 'N/A')
-                                    line_sku = line.get('sku', 'N/A')
-                                    line_qty = line.get('quantity', 0)
-                                    line_serials = line.get('serial_numbers', [])
-                                    # Check if this is an endoscope item
-                                    is_endoscope = "endoscope" in line_name.lower() or "scope" in line_name.lower()
-
-                                    print(f"        - {line_name} (SKU: {line_sku}, Qty: {line_qty})") # Corrected SKU reference
-                                    if line_serials:
-                                        print(f"          Serial Numbers: {', '.join(line_serials)}")
-                                    elif is_endoscope:
-                                        print(f"          No serial numbers recorded for this endoscope")
-                                        # print(f"          Serial Numbers: {', '.join(line_serials)}") # Redundant print removed
-                            else:
-                                print("      No line items found in package details.")
-                        else:
-                            print("      Package ID not available, cannot fetch details.")
-                else:
-                    print("  No packages found for this sales order.")
+            except RuntimeError as e:
+                if not previous_state:
+                    raise
+                # Keep the last synced sales orders for this contact rather than dropping them
+                print(f"WARNING: {e}. Keeping previously synced sales orders for {customer_id}.")
+                so_details, so_state = previous_contact_salesorders(previous_state, previous_so_details)
+                so_count = 0
+            salesorders_fetched += so_count
 
             # PART 2: Get all sales returns (RMAs) for the current customer_id
             print("\n" + "="*40 + f" Sales Returns (RMAs) for {customer_id} " + "="*40)
-            current_salesreturns = fetch_salesreturns_for_customer(config, customer_id)
-            print(f"Found {len(current_salesreturns)} sales returns for {customer_id}")
-            all_salesreturns_data.extend(current_salesreturns)
-
-            # Fetch detailed data for each sales return for JSON output
-            for rma in current_salesreturns: # Process only the current customer's returns here for details
-                rma_id = rma.get('salesreturn_id')
-                rma_number = rma.get('salesreturn_number')
-                rma_date = rma.get('date')
-                rma_status = rma.get('status')
-                rma_receive_status = rma.get('receive_status', 'N/A') # Check if this field exists in list view
-                rma_so_number = rma.get('salesorder_number', 'N/A')
-
-                print(f"\n--- RMA: {rma_number} (ID: {rma_id}, Date: {rma_date}, Status: {rma_status}) ---")
-                print(f"  Associated Sales Order: {rma_so_number}")
-                # print(f"  Receive Status: {rma_receive_status}") # May need detail view
-
-                # Fetch detailed RMA info to get line items, receive status, and salesreturnreceives
-                print(f"  Fetching details for RMA ID: {rma_id}...")
-                rma_detail_data = zoho_get(
-                    f"https://www.zohoapis.com/inventory/v1/salesreturns/{rma_id}",
-                    config,
-                    {'organization_id': config['organization_id']}
-                )
-                rma_detail = rma_detail_data.get('salesreturn', {})
-                detailed_salesreturns.append(rma_detail) # Collect detailed data
-
-                if not rma_detail:
-                    print("  Failed to fetch sales return details.")
-                    continue
-
-                line_items = rma_detail.get('line_items', [])
-                detailed_receive_status = rma_detail.get('receive_status', 'N/A')
-                print(f"  Receive Status (Detail): {detailed_receive_status}")
-
-                # Display line items - include all endoscope items regardless of serial numbers
-                print(f"  Line Items ({len(line_items)}):")
-                for item in line_items:
-                    item_name = item.get('name', 'N/A')
-                    item_sku = item.get('sku', 'N/A')
-                    item_qty = item.get('quantity', 0)
-                    item_serials = item.get('serial_numbers', [])
-
-                    # Check if this is an endoscope item
-                    is_endoscope = "endoscope" in item_name.lower() or "scope" in item_name.lower()
-
-                    print(f"    - {item_name} (SKU: {item_sku}, Qty: {item_qty})")
-                    if item_serials:
-                        print(f"      Serial Numbers: {', '.join(item_serials)}")
-                    elif is_endoscope:
-                        print(f"      No serial numbers recorded for this endoscope")
-
-                # Display salesreturnreceives information (return receipts)
-                salesreturnreceives = rma_detail.get('salesreturnreceives', [])
-                if salesreturnreceives:
-                    print(f"  Return Receipts ({len(salesreturnreceives)}):")
-                    for receive in salesreturnreceives:
-                        receive_id = receive.get('receive_id')
-                        receive_number = receive.get('receive_number')
-                        receive_date = receive.get('date')
-                        receive_notes = receive.get('notes', 'N/A')
-
-                        print(f"    Receipt: {receive_number} (ID: {receive_id}, Date: {receive_date})")
-                        if receive_notes != 'N/A':
-                            print(f"      Notes: {receive_notes}")
-
-                        # Display line items in the receipt
-                        receive_items = receive.get('line_items', [])
-                        if receive_items:
-                            print(f"      Items Received ({len(receive_items)}):")
-                            for item in receive_items:
-                                item_name = item.get('name', 'N/A')
-                                item_qty = item.get('quantity', 0)
-                                item_serials = item.get('serial_numbers', [])
-
-                                # Check if this is an endoscope item
-                                is_endoscope = "endoscope" in item_name.lower() or "scope" in item_name.lower()
-
-                                print(f"        - {item_name} (Qty: {item_qty})")
-                                if item_serials:
-                                    print(f"          Serial Numbers: {', '.join(item_serials)}")
-                                elif is_endoscope:
-                                    print(f"          No serial numbers recorded for this endoscope")
-                else:
-                    print("  No return receipts found for this RMA.")
+            rma_details, rma_state, rma_count = sync_contact_salesreturns(
+                config, customer_id, previous_state, previous_rma_details, max_workers, listed_salesreturns, checkpoint
+            )
+            salesreturns_fetched += rma_count
+
+            skipped.extend(write_contact_documents(writer, so_details, rma_details))
+            contacts_state[customer_id] = {**so_state, **rma_state}
 
 
         # --- Aggregation and Saving (after loop for contact_ids) ---
-        print(f"\n--- Aggregation Summary ---")
-        print(f"Total sales orders fetched across all IDs: {len(all_salesorders_data)}")
-        print(f"Total sales returns fetched across all IDs: {len(all_salesreturns_data)}")
-        print(f"Total detailed sales orders processed: {len(detailed_salesorders)}")
-        print(f"Total detailed sales returns processed: {len(detailed_salesreturns)}")
-
-        # Save aggregated detailed data to JSON file
-        output_data = {
-            "contact_ids_processed": contact_ids,
-            "salesorders": detailed_salesorders, # Contains details fetched inside the loop
-            "salesreturns": detailed_salesreturns # Contains details fetched inside the loop
-        }
-        with open(output_json_path, 'w') as f:
-            json.dump(output_data, f, indent=4)
-        print(f"\nAggregated data saved to {output_json_path}")
+        print(f"HTTP client: {zoho_client.get_client().stats()}")
+        print(f"Documents resumed from checkpoint: {checkpoint.resumed}")
+        finish_step1_output(writer, skipped, contacts_state, sync_mode, salesorders_fetched, salesreturns_fetched)
+        checkpoint.remove()
 
     except Exception as e:
         print(f"\nAn error occurred: {e}")
         import traceback
         traceback.print_exc()
+        if writer is not None:
+            writer.abort()
+        if checkpoint is not None:
+            checkpoint.close()
+            print(f"Progress kept in {checkpoint.path}; the next run for this output will resume from it.")
     # finally block removed as stdout redirection is handled externally
 
+def store_contact_documents(store, customer_id):
+    """
+    Returns (salesorder details, salesreturn details, state) for one contact from
+    the document store, shaped as a live sync would produce them: package line
+    items are attached to each order's package entries unless the relevance
+    prefilter skips them.
+    """
+    so_details = []
+    so_state = {}
+    for so_id, modified_time, so_detail in store.iter_documents('salesorders', customer_id):
+        if not mark_packages_skipped(so_detail):
+            for pkg_from_so in so_detail.get('packages', []):
+                pkg_detail = store.get('packages', pkg_from_so.get('package_id')) if pkg_from_so.get('package_id') else None
+                if pkg_detail:
+                    attach_package_line_items(pkg_from_so, {'package': pkg_detail})
+        so_details.append(so_detail)
+        so_state[so_id] = modified_time
+
+    rma_details = []
+    rma_state = {}
+    for rma_id, change_key, rma_detail in store.iter_documents('salesreturns', customer_id):
+        rma_details.append(rma_detail)
+        rma_state[rma_id] = change_key
+
+    state = {
+        'salesorders': so_state,
+        'salesorders_watermark': latest_zoho_timestamp(so_state.values()),
+        'salesreturns': rma_state,
+    }
+    return so_details, rma_details, state
+
+def write_step1_output_from_store(contact_ids, output_json_path, store=None):
+    """
+    Writes the Step 1 output for a list of contact IDs from the document store
+    (kept current by document_sync) without calling Zoho. The output has the
+    same shape as run_step1's, so STEP2 reads either.
+    """
+    store = store or zoho_store.get_store()
+    print(f"Writing Step 1 output from the document store ({store.path}) for contact IDs: {', '.join(contact_ids)}")
+    skipped = []
+    contacts_state = {}
+    writer = step1_output.open_step1_writer(output_json_path, contact_ids)
+    try:
+        for customer_id in contact_ids:
+            so_details, rma_details, state = store_contact_documents(store, customer_id)
+            print(f"Contact {customer_id}: {len(so_details)} sales orders, {len(rma_details)} sales returns in the store")
+            skipped.extend(write_contact_documents(writer, so_details, rma_details))
+            contacts_state[customer_id] = state
+        finish_step1_output(writer, skipped, contacts_state, 'store', 0, 0)
+    except Exception:
+        writer.abort()
+        raise
+
 if __name__ == "__main__":
    # This part is primarily for testing STEP1.py directly.
    # The orchestrator script will import and call run_step1 directly.
    parser = argparse.ArgumentParser(description="Fetch Zoho Inventory data for specific contact IDs.")
    parser.add_argument('--contact-ids', required=True, nargs='+', help='List of Zoho contact IDs to process.')
-   parser.add_argument('--output-json', required=True, help='Path to save the aggregated JSON data.')
+   parser.add_argument('--output-json', required=True, help='Path to save the aggregated data (.json, or .ndjson to stream documents as they complete).')
+   parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS, help='Maximum number of concurrent Zoho detail requests.')
+   parser.add_argument('--incremental', action='store_true', help='Only re-fetch documents changed since the sync recorded in --output-json.')
+   parser.add_argument('--no-resume', action='store_true', help='Ignore any checkpoint left by an interrupted run.')
+   parser.add_argument('--from-store', action='store_true',
+                       help='Write the output from the local document store (see document_sync.py) instead of calling Zoho.')
    # --output-md argument removed as logging is handled externally
 
    args = parser.parse_args()
+   if args.max_workers > zoho_client.DEFAULT_POOL_SIZE:
+       # Keep one pooled connection per worker so requests don't queue on the pool.
+       zoho_client.configure_client(pool_size=args.max_workers)
 
    try:
        # Config is now loaded inside run_step1
        # Call run_step1 without the md path
-       run_step1(args.contact_ids, args.output_json)
+       if args.from_store:
+           write_step1_output_from_store(args.contact_ids, args.output_json)
+       else:
+           run_step1(args.contact_ids, args.output_json, max_workers=args.max_workers, incremental=args.incremental, resume=not args.no_resume)
    except Exception as e:
        print(f"An error occurred during script execution: {e}")
        import traceback
        traceback.print_exc()
-       sys.exit(1)
\ No newline at end of file
+       sys.exit(1)
@@ -0,0 +1,415 @@
+# Asyncio ingestion engine for Step 1.
+#
+# Produces the same output file as STEP1.run_step1 (including sync_state, so
+# incremental syncs can alternate between the two engines), but runs list
+# pages, sales order details, package details and return details as asyncio
+# tasks on the caller's event loop. This lets the FastAPI backend run a sync
+# without tying up executor threads, and keeps thousands of requests
+# outstanding while the shared rate limiter decides when each one is sent.
+import asyncio
+import os
+import sys
+import argparse
+import traceback
+
+import STEP1
+import step1_output
+import zoho_auth
+import zoho_cache
+import zoho_client
+import zoho_concurrency
+import zoho_telemetry
+
+# Upper bound on Zoho requests in flight at once for one run_step1_async call.
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get('STEP1_ASYNC_MAX_CONCURRENCY', '32'))
+
+
+async def gather_all(*aws):
+    """
+    Like asyncio.gather, but lets every task finish before re-raising the first
+    exception, so work already in flight still completes (and is checkpointed)
+    when one request fails.
+    """
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+class AsyncZohoSession:
+    """Config, HTTP client, checkpoint and token-refresh lock shared by the tasks of one run."""
+
+    def __init__(self, config, client, max_concurrency=DEFAULT_MAX_CONCURRENCY, checkpoint=None):
+        self.config = config
+        self.client = client
+        self.checkpoint = checkpoint
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._refresh_lock = asyncio.Lock()
+        client.concurrency_limiter.start_at(max_concurrency)
+
+    async def refresh_token(self, stale_token):
+        """Refreshes the access token once, however many tasks saw it fail or expire."""
+        async with self._refresh_lock:
+            # Another task may already have refreshed the token while we waited
+            if self.config.get('access_token') == stale_token:
+                await asyncio.to_thread(STEP1.refresh_access_token, self.config, stale_token)
+        return self.config['access_token']
+
+    async def get(self, url, params=None, max_retries=5, backoff_factor=2):
+        """Async counterpart of STEP1.zoho_get: refreshes the token on 401 and backs off on 429."""
+        access_token = self.config.get('access_token')
+        if zoho_auth.get_token_manager(STEP1.CONFIG_PATH).needs_refresh(self.config):
+            access_token = await self.refresh_token(access_token)
+        headers = STEP1.get_headers(self.config)
+        retries = 0
+        while retries <= max_retries:
+            async with self._semaphore:
+                response = await self.client.get(url, headers=headers, params=params)
+            if response.status_code == 401:
+                print("Token expired, refreshing...")
+                access_token = await self.refresh_token(access_token)
+                headers = STEP1.get_headers(self.config) # Get updated headers
+                zoho_telemetry.record_retry(zoho_client.endpoint_label(url), token_refresh=True)
+                async with self._semaphore:
+                    response = await self.client.get(url, headers=headers, params=params) # Retry request
+
+            if response.status_code == 429:
+                wait_time = zoho_concurrency.retry_after_seconds(response)
+                if wait_time is None:
+                    wait_time = backoff_factor ** retries
+                print(f"Rate limit hit (429). Waiting {wait_time} seconds before retrying (attempt {retries+1}/{max_retries})...")
+                await asyncio.sleep(wait_time)
+                zoho_telemetry.record_retry(zoho_client.endpoint_label(url), throttle_wait=wait_time)
+                retries += 1
+                continue
+
+            if response.status_code >= 400:
+                print(f"Error during Zoho API GET request to {url}: HTTP {response.status_code}")
+                print(f"Response body: {response.text}")
+                response.raise_for_status()
+            return response.json()
+        print(f"FATAL: Exceeded maximum retries ({max_retries}) for {url}. Skipping this request.")
+        return {}  # Return empty dict to allow the run to continue
+
+
+async def fetch_salesorders_for_customer(session, customer_id):
+    """Fetch all sales orders for a customer using server-side filtering."""
+    print(f"Fetching sales orders for customer ID: {customer_id}...")
+    url = f"{STEP1.ZOHO_API_BASE_URL}/salesorders"
+    all_salesorders = []
+    page = 1
+    has_more_pages = True
+
+    while has_more_pages:
+        data = await session.get(url, {'customer_id': customer_id, 'page': page})
+        all_salesorders.extend(data.get('salesorders', []))
+        has_more_pages = data.get('page_context', {}).get('has_more_page', False)
+        print(f"  Fetched page {page}, total SOs so far: {len(all_salesorders)}")
+        page += 1
+
+    return all_salesorders
+
+async def fetch_salesorders_modified_since(session, customer_id, watermark):
+    """
+    Async counterpart of STEP1.fetch_salesorders_modified_since (customer_id=None
+    pages the organization-wide list). Returns (salesorders, reached_end).
+    """
+    scope = f"customer ID: {customer_id}" if customer_id else "all customers"
+    print(f"Fetching sales orders modified since {watermark} for {scope}...")
+    watermark_dt = STEP1.parse_zoho_timestamp(watermark)
+    url = f"{STEP1.ZOHO_API_BASE_URL}/salesorders"
+    salesorders = []
+    page = 1
+    has_more_pages = True
+
+    while has_more_pages:
+        params = {'sort_column': 'last_modified_time', 'sort_order': 'D', 'per_page': STEP1.LIST_PAGE_SIZE, 'page': page}
+        if customer_id:
+            params['customer_id'] = customer_id
+        data = await session.get(url, params)
+        if not data:
+            # A silently short list would advance the watermark past orders we never saw.
+            raise RuntimeError(f"Failed to fetch sales order page {page} for {scope}")
+        page_salesorders = data.get('salesorders', [])
+        salesorders.extend(page_salesorders)
+        has_more_pages = data.get('page_context', {}).get('has_more_page', False)
+        print(f"  Fetched page {page}, total SOs so far: {len(salesorders)}")
+        page += 1
+
+        if has_more_pages and watermark_dt and page_salesorders:
+            oldest_on_page = STEP1.parse_zoho_timestamp(page_salesorders[-1].get('last_modified_time'))
+            if oldest_on_page and oldest_on_page < watermark_dt:
+                print(f"  Reached watermark after {page-1} page(s); remaining orders are unchanged.")
+                return salesorders, False
+
+    return salesorders, True
+
+async def fetch_salesreturns_for_customer(session, customer_id):
+    """Fetch all sales returns for a customer using server-side filtering."""
+    print(f"Fetching sales returns for customer ID: {customer_id}...")
+    url = f"{STEP1.ZOHO_API_BASE_URL}/salesreturns"
+    all_salesreturns = []
+    page = 1
+    has_more_pages = True
+
+    while has_more_pages:
+        data = await session.get(url, {'customer_id': customer_id, 'page': page})
+        all_salesreturns.extend(data.get('salesreturns', []))
+        has_more_pages = data.get('page_context', {}).get('has_more_page', False)
+        print(f"  Fetched page {page}, total RMAs so far: {len(all_salesreturns)}")
+        page += 1
+
+    return all_salesreturns
+
+async def fetch_all_salesreturns(session):
+    """Fetch the organization-wide sales return list. Raises RuntimeError if a page fails."""
+    print("Fetching sales returns for all customers...")
+    url = f"{STEP1.ZOHO_API_BASE_URL}/salesreturns"
+    all_salesreturns = []
+    page = 1
+    has_more_pages = True
+
+    while has_more_pages:
+        data = await session.get(url, {'per_page': STEP1.LIST_PAGE_SIZE, 'page': page})
+        if not data:
+            raise RuntimeError(f"Failed to fetch sales return page {page} for all customers")
+        all_salesreturns.extend(data.get('salesreturns', []))
+        has_more_pages = data.get('page_context', {}).get('has_more_page', False)
+        print(f"  Fetched page {page}, total RMAs so far: {len(all_salesreturns)}")
+        page += 1
+
+    return all_salesreturns
+
+async def fetch_batched_lists(contact_ids, modified_since=None, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Async counterpart of STEP1.fetch_batched_lists (scans both org-wide lists concurrently)."""
+    config = await asyncio.to_thread(STEP1.load_config)
+    client = zoho_client.AsyncZohoClient()
+    try:
+        session = AsyncZohoSession(config, client, max_concurrency)
+        (salesorders, salesorders_complete), salesreturns = await gather_all(
+            fetch_salesorders_modified_since(session, None, modified_since),
+            fetch_all_salesreturns(session)
+        )
+    finally:
+        await client.aclose()
+    print(f"Batched lists: {len(salesorders)} sales orders, {len(salesreturns)} sales returns across the organization")
+    return STEP1.partition_batched_lists(salesorders, salesorders_complete, salesreturns, contact_ids)
+
+async def fetch_detail(session, endpoint, object_id, validator=None):
+    """
+    Async counterpart of STEP1.fetch_detail, sharing the same on-disk response cache.
+    Cache reads and writes (SQLite) run in a worker thread, off the event loop.
+    """
+    cache = zoho_cache.get_cache()
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, endpoint, object_id, validator)
+        if cached is not None:
+            return cached
+
+    data = await session.get(
+        f"{STEP1.ZOHO_API_BASE_URL}/{endpoint}/{object_id}",
+        {'organization_id': session.config['organization_id']}
+    )
+    if cache is not None and data and data.get('code', 0) == 0:
+        await asyncio.to_thread(cache.put, endpoint, object_id, data, validator)
+    return data
+
+async def fetch_salesorder_with_packages(session, salesorder_id, modified_time=None):
+    """Fetch a sales order's detail, then all of its package details concurrently."""
+    print(f"  Fetching details for SO ID: {salesorder_id}...")
+    so_detail = (await fetch_detail(session, 'salesorders', salesorder_id, modified_time)).get('salesorder', {})
+    if STEP1.mark_packages_skipped(so_detail):
+        return so_detail
+
+    so_modified_time = modified_time or so_detail.get('last_modified_time')
+    packages = [pkg for pkg in so_detail.get('packages', []) if pkg.get('package_id')]
+    pkg_details = await gather_all(*(
+        fetch_detail(session, 'packages', pkg['package_id'], STEP1.package_validator(so_modified_time, pkg))
+        for pkg in packages
+    ))
+    for pkg_from_so, pkg_detail_data in zip(packages, pkg_details):
+        STEP1.attach_package_line_items(pkg_from_so, pkg_detail_data)
+
+    return so_detail
+
+async def fetch_salesreturn_detail(session, salesreturn_id, validator=None):
+    """Fetch detailed information for a specific sales return."""
+    print(f"  Fetching details for RMA ID: {salesreturn_id}...")
+    return (await fetch_detail(session, 'salesreturns', salesreturn_id, validator)).get('salesreturn', {})
+
+async def fetch_with_checkpoint(session, kind, object_id, validator, fetch):
+    """
+    Async counterpart of STEP1.fetch_with_checkpoint; fetch is a coroutine function.
+    Journal reads and appends (file I/O) run in a worker thread, off the event loop.
+    """
+    if session.checkpoint is not None and session.checkpoint.contains(kind, object_id):
+        detail = await asyncio.to_thread(session.checkpoint.get, kind, object_id, validator)
+        if detail is not None:
+            return detail
+    detail = await fetch()
+    if session.checkpoint is not None and detail:
+        await asyncio.to_thread(session.checkpoint.record, kind, object_id, validator, detail)
+    return detail
+
+async def sync_contact_salesorders(session, customer_id, previous_state, previous_details, listed=None):
+    """Async counterpart of STEP1.sync_contact_salesorders. Returns (details, state, fetched_count)."""
+    if listed is not None:
+        salesorders, reached_end = listed
+    elif previous_state:
+        salesorders, reached_end = await fetch_salesorders_modified_since(
+            session, customer_id, previous_state.get('salesorders_watermark')
+        )
+    else:
+        salesorders, reached_end = await fetch_salesorders_for_customer(session, customer_id), True
+
+    to_fetch = STEP1.select_salesorders_to_fetch(salesorders, previous_state, previous_details)
+    print(f"Found {len(salesorders)} listed sales orders for {customer_id}; {len(to_fetch)} new or modified")
+
+    # Each detail is handed to fetched (spilled to the checkpoint) as soon as it completes
+    fetched = STEP1.FetchedDocuments('salesorders', session.checkpoint)
+
+    async def fetch_one(so):
+        so_detail = await fetch_with_checkpoint(
+            session, 'salesorders', so.get('salesorder_id'), so.get('last_modified_time'),
+            lambda: fetch_salesorder_with_packages(session, so.get('salesorder_id'), so.get('last_modified_time'))
+        )
+        STEP1.print_salesorder_detail(so, so_detail)
+        fetched.add(so.get('salesorder_id'), so_detail)
+
+    await gather_all(*(fetch_one(so) for so in to_fetch))
+
+    details, state = STEP1.merge_contact_salesorders(salesorders, reached_end, fetched, previous_state, previous_details)
+    return details, state, len(to_fetch)
+
+async def sync_contact_salesreturns(session, customer_id, previous_state, previous_details, listed=None):
+    """Async counterpart of STEP1.sync_contact_salesreturns. Returns (details, state, fetched_count)."""
+    if listed is not None:
+        salesreturns = listed
+    else:
+        salesreturns = await fetch_salesreturns_for_customer(session, customer_id)
+
+    to_fetch = STEP1.select_salesreturns_to_fetch(salesreturns, previous_state, previous_details)
+    print(f"Found {len(salesreturns)} sales returns for {customer_id}; {len(to_fetch)} new or modified")
+
+    fetched = STEP1.FetchedDocuments('salesreturns', session.checkpoint)
+
+    async def fetch_one(rma):
+        rma_detail = await fetch_with_checkpoint(
+            session, 'salesreturns', rma.get('salesreturn_id'), STEP1.salesreturn_change_key(rma),
+            lambda: fetch_salesreturn_detail(session, rma.get('salesreturn_id'), STEP1.salesreturn_change_key(rma))
+        )
+        STEP1.print_salesreturn_detail(rma, rma_detail)
+        fetched.add(rma.get('salesreturn_id'), rma_detail)
+
+    await gather_all(*(fetch_one(rma) for rma in to_fetch))
+
+    details, state = STEP1.merge_contact_salesreturns(salesreturns, fetched, previous_state, previous_details)
+    return details, state, len(to_fetch)
+
+async def sync_contact(session, customer_id, previous_state, previous_so_details, previous_rma_details, prefetched_lists=None):
+    """Syncs one contact's sales orders and sales returns concurrently."""
+    print(f"\n--- Processing Contact ID: {customer_id} ---")
+    listed_salesorders, listed_salesreturns = STEP1.prefetched_for_contact(prefetched_lists, customer_id, previous_state)
+
+    async def salesorders():
+        try:
+            return await sync_contact_salesorders(session, customer_id, previous_state, previous_so_details, listed_salesorders)
+        except RuntimeError as e:
+            if not previous_state:
+                raise
+            # Keep the last synced sales orders for this contact rather than dropping them
+            print(f"WARNING: {e}. Keeping previously synced sales orders for {customer_id}.")
+            return (*STEP1.previous_contact_salesorders(previous_state, previous_so_details), 0)
+
+    return await gather_all(
+        salesorders(),
+        sync_contact_salesreturns(session, customer_id, previous_state, previous_rma_details, listed_salesreturns)
+    )
+
+def write_step1_output(output_json_path, contact_ids, results, sync_mode):
+    """Writes the sync_contact results, in contact_ids order, to the Step 1 output."""
+    writer = step1_output.open_step1_writer(output_json_path, contact_ids)
+    try:
+        skipped = []
+        contacts_state = {}
+        salesorders_fetched = 0
+        salesreturns_fetched = 0
+        for customer_id, ((so_details, so_state, so_count), (rma_details, rma_state, rma_count)) in zip(contact_ids, results):
+            skipped.extend(STEP1.write_contact_documents(writer, so_details, rma_details))
+            contacts_state[customer_id] = {**so_state, **rma_state}
+            salesorders_fetched += so_count
+            salesreturns_fetched += rma_count
+        STEP1.finish_step1_output(writer, skipped, contacts_state, sync_mode, salesorders_fetched, salesreturns_fetched)
+    except Exception:
+        writer.abort()
+        raise
+
+async def run_step1_async(contact_ids, output_json_path, max_concurrency=DEFAULT_MAX_CONCURRENCY, incremental=False,
+                          prefetched_lists=None, resume=True):
+    """
+    Asyncio counterpart of STEP1.run_step1: same arguments (max_concurrency in
+    place of max_workers) and the same output file and checkpoint journal.
+    All contacts are synced concurrently; results are assembled in contact_ids order.
+    """
+    checkpoint = None
+    try:
+        config = await asyncio.to_thread(STEP1.load_config)
+        print("Configuration loaded within run_step1_async.")
+
+        checkpoint_path = f"{output_json_path}{STEP1.CHECKPOINT_SUFFIX}"
+        if not resume and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        checkpoint = await asyncio.to_thread(STEP1.Step1Checkpoint, output_json_path)
+
+        previous_output = await asyncio.to_thread(STEP1.load_previous_step1_output, output_json_path) if incremental else None
+        previous_contacts, previous_so_details, previous_rma_details = STEP1.index_previous_output(previous_output)
+        sync_mode = 'incremental' if previous_output else 'full'
+
+        print(f"Starting async Step 1 processing ({sync_mode}) for contact IDs: {', '.join(contact_ids)} (max concurrency: {max_concurrency})")
+
+        client = zoho_client.AsyncZohoClient()
+        try:
+            session = AsyncZohoSession(config, client, max_concurrency, checkpoint)
+            results = await gather_all(*(
+                sync_contact(
+                    session, customer_id, previous_contacts.get(customer_id), previous_so_details, previous_rma_details,
+                    prefetched_lists
+                )
+                for customer_id in contact_ids
+            ))
+            print(f"HTTP client: {client.stats()}")
+        finally:
+            await client.aclose()
+
+        print(f"Documents resumed from checkpoint: {checkpoint.resumed}")
+        await asyncio.to_thread(
+            write_step1_output, output_json_path, contact_ids, results, sync_mode
+        )
+        checkpoint.remove()
+
+    except Exception as e:
+        print(f"\nAn error occurred: {e}")
+        traceback.print_exc()
+        if checkpoint is not None:
+            checkpoint.close()
+            print(f"Progress kept in {checkpoint.path}; the next run for this output will resume from it.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch Zoho Inventory data for specific contact IDs (asyncio engine).")
+    parser.add_argument('--contact-ids', required=True, nargs='+', help='List of Zoho contact IDs to process.')
+    parser.add_argument('--output-json', required=True, help='Path to save the aggregated data (.json, or .ndjson to stream documents as they complete).')
+    parser.add_argument('--max-concurrency', type=int, default=DEFAULT_MAX_CONCURRENCY, help='Maximum number of Zoho requests in flight.')
+    parser.add_argument('--incremental', action='store_true', help='Only re-fetch documents changed since the sync recorded in --output-json.')
+    parser.add_argument('--no-resume', action='store_true', help='Ignore any checkpoint left by an interrupted run.')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run_step1_async(
+            args.contact_ids, args.output_json, max_concurrency=args.max_concurrency,
+            incremental=args.incremental, resume=not args.no_resume
+        ))
+    except Exception as e:
+        print(f"An error occurred during script execution: {e}")
+        traceback.print_exc()
+        sys.exit(1)
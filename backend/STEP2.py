@@ -18,12 +18,20 @@ import sys
 import re
 from datetime import datetime, timedelta, date # Ensure date is imported
 from dateutil.relativedelta import relativedelta
+from bisect import bisect_left, bisect_right
 from collections import deque, defaultdict
 from io import StringIO
 import argparse # Add argparse
-from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, min_weight_full_bipartite_matching
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
 import numpy as np
 
+import step1_output
+from cohort_registry import CohortRegistry
+
 # Helper function to create the serial details map from Step 1 data
 def _create_serial_step1_details_map(sales_orders_data):
     serial_map = {}
@@ -72,12 +80,95 @@ def _create_serial_step1_details_map(sales_orders_data):
                         }
     return serial_map
 
+# Groups shipment events by serial in one pass. Each serial's events keep the
+# order of shipment_events, which is sorted by date with undated events last, so
+# a serial's first event is its earliest dated shipment (or, with no dated ones,
+# its first undated one).
+def _index_shipments_by_serial(shipment_events):
+    shipments_by_serial = {}
+    for event in shipment_events:
+        if event['serial']:
+            shipments_by_serial.setdefault(event['serial'], []).append(event)
+    return shipments_by_serial
+
+# Secondary index of shipmentInstanceMap: serial -> (ship_dates, instance_keys).
+# instance_keys lists every instance of the serial sorted by ship date, undated
+# instances last; ship_dates holds the dates of the dated ones, so it is a
+# sorted prefix aligned with instance_keys that can be searched with bisect.
+# Instances must be added in ship-date order (as shipment_events is sorted).
+def _add_instance_to_serial_index(instances_by_serial, instance_key, serial, ship_date):
+    ship_dates, instance_keys = instances_by_serial.setdefault(serial, ([], []))
+    if ship_date is not None:
+        ship_dates.append(ship_date)
+    instance_keys.append(instance_key)
+
+# Returns the key of the serial's most recently shipped instance that is still
+# inField and was shipped on or before the given date, or None. Among instances
+# shipped the same day, the first one added wins.
+def _most_recent_in_field_instance(instances_by_serial, shipmentInstanceMap, serial, before_date):
+    ship_dates, instance_keys = instances_by_serial.get(serial, ((), ()))
+    found = None
+    index = bisect_right(ship_dates, before_date)
+    while index > 0:
+        index -= 1
+        if found is not None and ship_dates[index] != ship_dates[found]:
+            break
+        if shipmentInstanceMap[instance_keys[index]]['currentStatus'] == 'inField':
+            found = index
+    return instance_keys[found] if found is not None else None
+
+# Returns how many scopes the replacedScope links of scopeMap reach from serial,
+# counting serial itself: the walk stops at a serial missing from scopeMap or at
+# one it already visited. Lengths are saved in chain_lengths for every serial on
+# the walk, so chains shared by many serials are walked once.
+def _replacement_chain_length(scopeMap, serial, chain_lengths):
+    path = []
+    position = {}
+    temp_sn = serial
+    while temp_sn and temp_sn in scopeMap and temp_sn not in chain_lengths and temp_sn not in position:
+        position[temp_sn] = len(path)
+        path.append(temp_sn)
+        temp_sn = scopeMap[temp_sn].get('replacedScope')
+    if temp_sn in position:
+        # The walk closed a loop: every serial on it reaches exactly the loop's serials
+        loop_start = position[temp_sn]
+        for sn in path[loop_start:]:
+            chain_lengths[sn] = len(path) - loop_start
+        path = path[:loop_start]
+        tail_length = len(position) - loop_start
+    else:
+        tail_length = chain_lengths.get(temp_sn, 0)
+    for index, sn in enumerate(path):
+        chain_lengths[sn] = tail_length + len(path) - index
+    return chain_lengths.get(serial, 0)
+
 # Target SKUs for filtering - support multiple endoscope types
 TARGET_ENDOSCOPE_SKUS = ['P313N00', 'P417N00']
 ENDOSCOPE_SKUS = set(TARGET_ENDOSCOPE_SKUS) # Use a set for efficient lookup
 # Keep backward compatibility
 TARGET_ENDOSCOPE_SKU = TARGET_ENDOSCOPE_SKUS[0] if TARGET_ENDOSCOPE_SKUS else None
 SPECULATIVE_REPLACEMENT_WINDOW_DAYS = 30 # Days to look forward for an orphan replacement
+# Cost of leaving a return without a replacement in the replacement and orphan
+# matchings (the cost the dense formulation gave infeasible pairs), so as many
+# returns as possible are matched before total cost is minimized.
+UNMATCHED_RETURN_COST = 1e6
+# Rows of the orphan cost matrix evaluated per NumPy block, bounding the size of
+# the (rows x shipments) temporaries.
+ORPHAN_COST_BLOCK_ROWS = 1024
+# The matchings are solved per connected component of their feasible-pair graph.
+# Components are spread over a process pool of ASSIGNMENT_POOL_WORKERS processes
+# once a matching has at least ASSIGNMENT_POOL_MIN_EDGES feasible pairs (set the
+# workers to 1 to always solve in-process). The pool is shared by every matching
+# in the process, so concurrent runs (the API solves clinic groups on worker
+# threads) never hold more than ASSIGNMENT_POOL_WORKERS solver processes. Its
+# processes are started by a forkserver (spawn where that is unavailable), not
+# forked from the multi-threaded caller.
+ASSIGNMENT_POOL_MIN_EDGES = int(os.environ.get('STEP2_ASSIGNMENT_POOL_MIN_EDGES', '200000'))
+ASSIGNMENT_POOL_WORKERS = int(os.environ.get('STEP2_ASSIGNMENT_POOL_WORKERS', str(min(os.cpu_count() or 1, 8))))
+ASSIGNMENT_POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+_assignment_pool = None
+_assignment_pool_lock = threading.Lock()
 
 
 # Create a class to capture output to both console and a string
@@ -252,6 +343,147 @@ def find_rma_or_serial_in_so_text(so_object, target_sn, target_rma_num):
 
 # --- NEW HELPER FUNCTIONS for ORPHAN ANALYSIS ---
 
+def _solve_assignment_component(component):
+    """
+    Solves one connected component of a matching: (rows, cols, costs) edges with
+    global indices, where every row may instead stay unmatched at unmatched_cost.
+    Returns the matched (row, col) pairs. Runs in a worker process for large
+    matchings, so it only takes and returns plain arrays and lists.
+    """
+    rows, cols, costs, unmatched_cost = component
+    local_rows, row_index = np.unique(rows, return_inverse=True)
+    local_cols, col_index = np.unique(cols, return_inverse=True)
+    n_rows = len(local_rows)
+    n_cols = len(local_cols)
+    # Each row gets its own "unmatched" column, so a full matching of the rows always
+    # exists. Shifting all costs by 1 leaves the optimum unchanged (every row is matched
+    # exactly once) and keeps zero-cost pairs from being read as missing edges.
+    graph = csr_matrix(
+        (
+            np.concatenate([costs, np.full(n_rows, unmatched_cost)]) + 1.0,
+            (np.concatenate([row_index, np.arange(n_rows)]), np.concatenate([col_index, n_cols + np.arange(n_rows)]))
+        ),
+        shape=(n_rows, n_cols + n_rows)
+    )
+    row_match, col_match = min_weight_full_bipartite_matching(graph)
+    matched = col_match < n_cols
+    return list(zip(local_rows[row_match[matched]].tolist(), local_cols[col_match[matched]].tolist()))
+
+def _get_assignment_pool():
+    """Returns the process-wide matching pool, creating it on first use."""
+    global _assignment_pool
+    with _assignment_pool_lock:
+        if _assignment_pool is None:
+            _assignment_pool = ProcessPoolExecutor(
+                max_workers=ASSIGNMENT_POOL_WORKERS,
+                mp_context=multiprocessing.get_context(ASSIGNMENT_POOL_START_METHOD)
+            )
+        return _assignment_pool
+
+def _discard_assignment_pool(pool):
+    """Drops a failed pool so the next large matching starts a fresh one."""
+    global _assignment_pool
+    with _assignment_pool_lock:
+        if _assignment_pool is pool:
+            _assignment_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _solve_assignment_by_component(n_rows, n_cols, edge_rows, edge_cols, edge_costs, unmatched_cost):
+    """
+    Min-cost matching of rows to columns over the given feasible edges, where a row
+    left unmatched costs unmatched_cost. The feasible-pair graph falls apart into
+    independent pieces (pairs only join the same SKU, and in the orphan matching
+    only dates inside one window), so it is split into connected components and each
+    is solved on its own; no edge joins two components, so the combined result is
+    globally optimal. Large matchings solve their components on a process pool.
+    Returns the matched (row, col) pairs in row order.
+    """
+    edge_rows = np.asarray(edge_rows, dtype=np.int64)
+    edge_cols = np.asarray(edge_cols, dtype=np.int64)
+    edge_costs = np.asarray(edge_costs, dtype=float)
+    if not len(edge_rows):
+        return []
+
+    # Rows are nodes 0..n_rows-1 and columns n_rows..n_rows+n_cols-1 of one undirected graph
+    adjacency = csr_matrix(
+        (np.ones(len(edge_rows)), (edge_rows, edge_cols + n_rows)), shape=(n_rows + n_cols, n_rows + n_cols)
+    )
+    _, labels = connected_components(adjacency, directed=False)
+    edge_labels = labels[edge_rows]
+    order = np.argsort(edge_labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(edge_labels[order])) + 1
+    components = [
+        (edge_rows[part], edge_cols[part], edge_costs[part], unmatched_cost)
+        for part in np.split(order, bounds)
+    ]
+    print(f"Solving {len(components)} independent matching components (largest: {max(len(c[0]) for c in components)} pairs)")
+
+    if len(edge_rows) >= ASSIGNMENT_POOL_MIN_EDGES and len(components) > 1 and ASSIGNMENT_POOL_WORKERS > 1:
+        # Biggest components first, so a large one does not start last
+        components.sort(key=lambda component: len(component[0]), reverse=True)
+        pool = _get_assignment_pool()
+        try:
+            results = list(pool.map(_solve_assignment_component, components))
+        except Exception as e:
+            print(f"Warning: process pool for matching failed ({e}); solving components in-process.", file=sys.stderr)
+            _discard_assignment_pool(pool)
+            results = [_solve_assignment_component(component) for component in components]
+    else:
+        results = [_solve_assignment_component(component) for component in components]
+    return sorted(pair for result in results for pair in result)
+
+def _orphan_cost_edges(valid_orphan_returns, valid_orphan_shipments, window_days):
+    """
+    Returns (rows, cols, costs) arrays with the cost of every feasible (return i,
+    shipment j) pair of the orphan matching. A pair is feasible when the shipment has
+    the same SKU, is a different serial, and ships 0..window_days days after the
+    return. Its cost is min(gap_days * 10, 1000) + i * 5 + j * 5 plus a hash-based
+    tie-break in [0, 1). Dates, SKUs and serials are compared as NumPy arrays of
+    day ordinals and integer codes, a block of rows at a time; only the tie-break
+    is computed per pair, and only for feasible pairs.
+    """
+    codes = {}
+    def encode(values):
+        return np.array([codes.setdefault(value, len(codes)) for value in values], dtype=np.int64)
+
+    return_days = np.array([rma['date'].toordinal() for rma in valid_orphan_returns], dtype=np.int64)
+    ship_days = np.array([ship['date'].toordinal() for ship in valid_orphan_shipments], dtype=np.int64)
+    return_skus = encode(('sku', rma['sku']) for rma in valid_orphan_returns)
+    ship_skus = encode(('sku', ship['sku']) for ship in valid_orphan_shipments)
+    return_serials = encode(('serial', rma['serial']) for rma in valid_orphan_returns)
+    ship_serials = encode(('serial', ship['serial']) for ship in valid_orphan_shipments)
+    shipment_date_cost = np.arange(len(valid_orphan_shipments), dtype=np.int64) * 5
+
+    edge_rows = []
+    edge_cols = []
+    edge_costs = []
+    for block_start in range(0, len(valid_orphan_returns), ORPHAN_COST_BLOCK_ROWS):
+        block = slice(block_start, block_start + ORPHAN_COST_BLOCK_ROWS)
+        time_gap_days = ship_days[None, :] - return_days[block, None]
+        feasible = (
+            (time_gap_days >= 0) & (time_gap_days <= window_days) &
+            (ship_skus[None, :] == return_skus[block, None]) &
+            (ship_serials[None, :] != return_serials[block, None])
+        )
+        rows, cols = np.nonzero(feasible)
+        if not len(rows):
+            continue
+        rows_global = rows + block_start
+        # Time gap penalty (capped), then earlier returns and shipments preferred for stability
+        pair_cost = np.minimum(time_gap_days[rows, cols] * 10, 1000) + rows_global * 5 + shipment_date_cost[cols]
+        random_cost = np.array([
+            hash(f"{valid_orphan_returns[i]['serial']}-{valid_orphan_shipments[j]['serial']}") % 100
+            for i, j in zip(rows_global.tolist(), cols.tolist())
+        ]) / 100.0
+        edge_rows.append(rows_global)
+        edge_cols.append(cols)
+        edge_costs.append(pair_cost + random_cost)
+
+    if not edge_rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return np.concatenate(edge_rows), np.concatenate(edge_cols), np.concatenate(edge_costs)
+
+
 def build_optimal_orphan_chains_bipartite(orphan_serials, scope_map, window_days):
     """
     Build optimal orphan chains using bipartite matching with Hungarian algorithm.
@@ -384,61 +616,20 @@ def build_optimal_orphan_chains_bipartite(orphan_serials, scope_map, window_days
     valid_orphan_returns.sort(key=lambda x: x['date'])
     valid_orphan_shipments.sort(key=lambda x: x['date'])
     
-    # Build cost matrix for bipartite matching
+    # Build the feasible pairs for bipartite matching. A return left unmatched costs
+    # UNMATCHED_RETURN_COST, as an infeasible cell of the dense matrix used to.
     n_returns = len(valid_orphan_returns)
     n_shipments = len(valid_orphan_shipments)
+    edge_rows, edge_cols, edge_costs = _orphan_cost_edges(valid_orphan_returns, valid_orphan_shipments, window_days)
+    print(f"Built orphan cost graph: {n_returns} returns, {n_shipments} shipments, {len(edge_costs)} feasible pairs")
     
-    # Use larger dimension for rectangular matrix
-    matrix_size = max(n_returns, n_shipments)
-    cost_matrix = np.full((matrix_size, matrix_size), 1e6)  # High cost for invalid pairs
-    
-    print(f"Building {matrix_size}x{matrix_size} cost matrix for orphan matching...")
-    
-    for i, rma in enumerate(valid_orphan_returns):
-        returned_sn = rma['serial']
-        rma_date = rma['date']
-        returned_sku = rma['sku']
-        
-        for j, ship in enumerate(valid_orphan_shipments):
-            replacement_sn = ship['serial']
-            ship_date = ship['date']
-            replacement_sku = ship['sku']
-            
-            # Hard constraints (infinite cost if violated)
-            window_end = rma_date + timedelta(days=window_days)
-            if (ship_date < rma_date or  # Temporal constraint
-                ship_date > window_end or  # Window constraint
-                replacement_sn == returned_sn or  # No self-replacement
-                returned_sku != replacement_sku):  # SKU compatibility
-                continue
-            
-            # Calculate cost for valid pairs
-            time_gap_days = (ship_date - rma_date).days
-            
-            # Cost components:
-            # 1. Time gap penalty (prefer shorter gaps)
-            time_cost = min(time_gap_days * 10, 1000)  # Cap at 1000
-            
-            # 2. Prefer earlier returns and shipments for stability
-            return_date_cost = i * 5  # Earlier returns get lower cost
-            shipment_date_cost = j * 5  # Earlier shipments get lower cost
-            
-            # 3. Small random factor for tie-breaking
-            random_cost = (hash(f"{returned_sn}-{replacement_sn}") % 100) / 100.0
-            
-            total_cost = time_cost + return_date_cost + shipment_date_cost + random_cost
-            cost_matrix[i, j] = total_cost
-    
-    # Apply Hungarian algorithm
-    print("Applying Hungarian algorithm for optimal orphan matching...")
-    row_indices, col_indices = linear_sum_assignment(cost_matrix)
-    
-    # Extract valid assignments
-    assignments = []
-    for i, j in zip(row_indices, col_indices):
-        if (i < n_returns and j < n_shipments and
-            cost_matrix[i, j] < 1e5):  # Valid assignment
-            assignments.append((valid_orphan_returns[i], valid_orphan_shipments[j]))
+    print("Applying min-weight bipartite matching for optimal orphan matching...")
+    assignments = [
+        (valid_orphan_returns[i], valid_orphan_shipments[j])
+        for i, j in _solve_assignment_by_component(
+            n_returns, n_shipments, edge_rows, edge_cols, edge_costs, UNMATCHED_RETURN_COST
+        )
+    ]
     
     print(f"Found {len(assignments)} optimal orphan replacement assignments")
     
@@ -704,11 +895,7 @@ def build_speculative_orphan_chains_new_logic(orphan_instance_keys, shipmentInst
                             shipmentInstanceMap[best_replacement_key]['cohort'] = returned_cohort_id
                             
                             # Decrement remaining replacements for the cohort
-                            for cohort in csa_cohorts:
-                                if cohort['orderId'] == returned_cohort_id:
-                                    if cohort['remainingReplacements'] > 0:
-                                        cohort['remainingReplacements'] -= 1
-                                    break
+                            csa_cohorts.use_replacement(csa_cohorts.get(returned_cohort_id))
                 else:
                     # No replacement found for this returned link
                     current_instance_key = None
@@ -782,18 +969,17 @@ def associate_orphans_to_cohorts_with_isolation(orphan_chains, scope_map, csa_co
         if original_cohort_id:
             print(f"    Orphan {starter_serial}: Checking original cohort {original_cohort_id}...")
             # Try original cohort first
-            original_cohort = next((c for c in csa_cohorts if c['orderId'] == original_cohort_id), None)
+            original_cohort = csa_cohorts.get(original_cohort_id)
             
             if original_cohort:
                 total_slots = original_cohort.get('total_CSA_slots', 0)
-                validated_count = original_cohort.get('current_validated_in_field_count', 0)
-                assigned_orphans = original_cohort.get('current_assigned_in_field_orphans', 0)
+                in_field_count = csa_cohorts.in_field_count(original_cohort)
                 
-                if (validated_count + assigned_orphans) < total_slots and final_status == 'inField':
+                if csa_cohorts.has_in_field_capacity(original_cohort) and final_status == 'inField':
                     assigned_cohort = original_cohort_id
                     assignment_reason = f"Assigned to original cohort {original_cohort_id}. Cohort isolation respected."
                     assignment_type = "same_cohort_preferred"
-                    original_cohort['current_assigned_in_field_orphans'] += 1
+                    csa_cohorts.assign_in_field_orphan(original_cohort)
                     isolation_stats['orphan_same_cohort_assignments'] += 1
                     print(f"    ✓ Orphan {starter_serial}: Assigned to original cohort {original_cohort_id}")
                 else:
@@ -803,7 +989,7 @@ def associate_orphans_to_cohorts_with_isolation(orphan_chains, scope_map, csa_co
                         assignment_type = "same_cohort_tracking"
                         isolation_stats['orphan_same_cohort_assignments'] += 1
                     else:
-                        assignment_reason = f"Original cohort {original_cohort_id} at capacity ({validated_count + assigned_orphans}/{total_slots}). Preserving isolation - not reassigned."
+                        assignment_reason = f"Original cohort {original_cohort_id} at capacity ({in_field_count}/{total_slots}). Preserving isolation - not reassigned."
                         assignment_type = "isolation_preserved"
                         isolation_stats['orphan_cross_cohort_blocked'] += 1
                         print(f"    🛡 Orphan {starter_serial}: Cohort isolation preserved (capacity constraint)")
@@ -817,24 +1003,16 @@ def associate_orphans_to_cohorts_with_isolation(orphan_chains, scope_map, csa_co
             if initial_ship_date_str != 'N/A' and final_status == 'inField':
                 initial_ship_date = parse_date_flexible(initial_ship_date_str)
                 
-                # Find best cohort by date (latest start <= ship date)
+                # Find best cohort by date (latest start <= ship date) with in-field capacity left
                 best_cohort = None
-                for cohort in csa_cohorts:
-                    cohort_start_obj = cohort.get('startDateObj')
-                    if cohort_start_obj and initial_ship_date and cohort_start_obj <= initial_ship_date:
-                        total_slots = cohort.get('total_CSA_slots', 0)
-                        validated_count = cohort.get('current_validated_in_field_count', 0)
-                        assigned_orphans = cohort.get('current_assigned_in_field_orphans', 0)
-                        
-                        if (validated_count + assigned_orphans) < total_slots:
-                            if not best_cohort or cohort_start_obj > best_cohort.get('startDateObj'):
-                                best_cohort = cohort
+                if initial_ship_date:
+                    best_cohort = csa_cohorts.latest_started_on_or_before(initial_ship_date, csa_cohorts.has_in_field_capacity)
                 
                 if best_cohort:
                     assigned_cohort = best_cohort['orderId']
                     assignment_reason = f"Initial ship date {initial_ship_date_str} is on or after cohort {assigned_cohort} start date {best_cohort.get('startDate', 'N/A')}. Assigned as in-field, capacity OK."
                     assignment_type = "date_based_new_assignment"
-                    best_cohort['current_assigned_in_field_orphans'] += 1
+                    csa_cohorts.assign_in_field_orphan(best_cohort)
                     print(f"    ✓ Orphan {starter_serial}: New assignment to cohort {assigned_cohort} (date-based)")
                 else:
                     assigned_cohort = "No Suitable Cohort Found (Capacity)"
@@ -996,8 +1174,7 @@ def build_optimal_replacement_chains_bipartite(rma_events, shipment_events, scop
             # Check if cohort has replacements available
             cohort_id = scopeMap[returned_sn]['cohort']
             if cohort_id:
-                cohort = next((c for c in csa_cohorts if c['orderId'] == cohort_id), None)
-                if cohort and cohort['remainingReplacements'] > 0:
+                if csa_cohorts.has_replacements(csa_cohorts.get(cohort_id)):
                     valid_returns.append(rma)
     
     # Filter valid shipments (potential replacements)
@@ -1025,32 +1202,45 @@ def build_optimal_replacement_chains_bipartite(rma_events, shipment_events, scop
     valid_returns.sort(key=lambda x: x['date'])
     valid_shipments.sort(key=lambda x: x['date'])
     
-    # Build cost matrix for bipartite matching
+    # Build the sparse cost graph for bipartite matching. Only feasible pairs get an
+    # edge: same SKU, a different serial, and shipped on or after the return. Shipments
+    # are grouped by SKU in date order, so each return's candidates start at a bisect
+    # on its date. A return left unmatched costs UNMATCHED_RETURN_COST.
     n_returns = len(valid_returns)
     n_shipments = len(valid_shipments)
-    
-    # Use larger dimension for rectangular matrix
-    matrix_size = max(n_returns, n_shipments)
-    cost_matrix = np.full((matrix_size, matrix_size), 1e6)  # High cost for invalid pairs
-    
-    print(f"Building {matrix_size}x{matrix_size} cost matrix...")
-    
+
+    shipments_by_sku = defaultdict(list)
+    for j, ship in enumerate(valid_shipments):
+        shipments_by_sku[scopeMap.get(ship['serial'], {}).get('csaItemSku')].append(j)
+    ship_dates_by_sku = {
+        sku: [valid_shipments[j]['date'] for j in indices] for sku, indices in shipments_by_sku.items()
+    }
+
+    # Chain length balancing (prefer orphan scopes, chain length 1, as replacements).
+    # scopeMap does not change while the graph is built, so each candidate's
+    # replacedScope chain is measured once rather than once per return.
+    chain_lengths = {}
+    chain_length_costs = [
+        (_replacement_chain_length(scopeMap, ship['serial'], chain_lengths) - 1) * 50 for ship in valid_shipments
+    ]
+
+    edge_rows = []
+    edge_cols = []
+    edge_costs = []
     for i, rma in enumerate(valid_returns):
         returned_sn = rma['serial']
         rma_date = rma['date']
         returned_sku = scopeMap[returned_sn].get('csaItemSku')
-        
-        for j, ship in enumerate(valid_shipments):
+        candidates = shipments_by_sku.get(returned_sku, [])
+        first_candidate = bisect_left(ship_dates_by_sku.get(returned_sku, []), rma_date) # Temporal constraint
+
+        for j in candidates[first_candidate:]:
+            ship = valid_shipments[j]
             replacement_sn = ship['serial']
             ship_date = ship['date']
-            replacement_sku = scopeMap.get(replacement_sn, {}).get('csaItemSku')
-            
-            # Hard constraints (infinite cost if violated)
-            if (ship_date < rma_date or  # Temporal constraint
-                replacement_sn == returned_sn or  # No self-replacement
-                returned_sku != replacement_sku):  # SKU compatibility
+            if replacement_sn == returned_sn: # No self-replacement
                 continue
-            
+
             # Calculate cost for valid pairs
             time_gap_days = (ship_date - rma_date).days
             
@@ -1059,33 +1249,25 @@ def build_optimal_replacement_chains_bipartite(rma_events, shipment_events, scop
             time_cost = min(time_gap_days * 10, 1000)  # Cap at 1000
             
             # 2. Chain length balancing (prefer orphan scopes as replacements)
-            replacement_chain_length = 0
-            temp_sn = replacement_sn
-            visited = set()
-            while temp_sn and temp_sn not in visited and temp_sn in scopeMap:
-                visited.add(temp_sn)
-                temp_sn = scopeMap[temp_sn].get('replacedScope')
-                replacement_chain_length += 1
-            
-            # Prefer orphans (chain length 1) as replacements
-            chain_length_cost = (replacement_chain_length - 1) * 50
+            chain_length_cost = chain_length_costs[j]
             
             # 3. Small random factor for tie-breaking
             random_cost = (hash(f"{returned_sn}-{replacement_sn}") % 100) / 100.0
             
-            total_cost = time_cost + chain_length_cost + random_cost
-            cost_matrix[i, j] = total_cost
-    
-    # Apply Hungarian algorithm
-    print("Applying Hungarian algorithm for optimal matching...")
-    row_indices, col_indices = linear_sum_assignment(cost_matrix)
-    
-    # Extract valid assignments
-    assignments = []
-    for i, j in zip(row_indices, col_indices):
-        if (i < n_returns and j < n_shipments and
-            cost_matrix[i, j] < 1e5):  # Valid assignment
-            assignments.append((valid_returns[i], valid_shipments[j]))
+            edge_rows.append(i)
+            edge_cols.append(j)
+            edge_costs.append(time_cost + chain_length_cost + random_cost)
+
+    print(f"Built sparse cost graph: {n_returns} returns, {n_shipments} shipments, {len(edge_costs)} feasible pairs")
+
+    print("Applying sparse min-weight bipartite matching for optimal assignment...")
+    # Assignments of returns to a real shipment, in return order
+    assignments = [
+        (valid_returns[i], valid_shipments[j])
+        for i, j in _solve_assignment_by_component(
+            n_returns, n_shipments, edge_rows, edge_cols, edge_costs, UNMATCHED_RETURN_COST
+        )
+    ]
     
     print(f"Found {len(assignments)} optimal replacement assignments")
     
@@ -1106,9 +1288,9 @@ def build_optimal_replacement_chains_bipartite(rma_events, shipment_events, scop
         
         # Find and update cohort
         cohort_id = scopeMap[returned_sn]['cohort']
-        cohort = next((c for c in csa_cohorts if c['orderId'] == cohort_id), None)
+        cohort = csa_cohorts.get(cohort_id)
         
-        if cohort and cohort['remainingReplacements'] > 0:
+        if csa_cohorts.use_replacement(cohort):
             # Update returned scope
             scopeMap[returned_sn]['currentStatus'] = 'returned_replaced'
             scopeMap[returned_sn]['replacedBy'] = replacement_sn
@@ -1122,8 +1304,6 @@ def build_optimal_replacement_chains_bipartite(rma_events, shipment_events, scop
             scopeMap[replacement_sn]['replacedScope'] = returned_sn
             scopeMap[replacement_sn]['cohort'] = cohort_id
             
-            # Update cohort
-            cohort['remainingReplacements'] -= 1
             used_replacement_serials.add(replacement_sn)
             
             print(f"  Assigned: {returned_sn} (returned {dt_to_str(rma_date_obj)}) → {replacement_sn} (shipped {dt_to_str(ship_date_obj)})")
@@ -1134,12 +1314,12 @@ def build_optimal_replacement_chains_bipartite(rma_events, shipment_events, scop
         if scopeMap[returned_sn]['currentStatus'] == 'inField':  # Not processed
             rma_date_obj = rma['date']
             cohort_id = scopeMap[returned_sn]['cohort']
-            cohort = next((c for c in csa_cohorts if c['orderId'] == cohort_id), None)
+            cohort = csa_cohorts.get(cohort_id)
             
             scopeMap[returned_sn]['rmaDate'] = dt_to_str(rma_date_obj)
             scopeMap[returned_sn]['rmaDateObj'] = rma_date_obj
             
-            if cohort and cohort['remainingReplacements'] > 0:
+            if csa_cohorts.has_replacements(cohort):
                 scopeMap[returned_sn]['currentStatus'] = 'returned_no_replacement_found'
                 # Note: Do NOT decrement remainingReplacements here - only when replacement is actually made
             else:
@@ -1174,8 +1354,9 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
         return
 
     try:
-        with open(input_json_path, 'r') as f:
-            data = json.load(f)
+        # Step 1 output may be a single JSON object or streamed NDJSON (*.ndjson),
+        # which is read one document per line.
+        data = step1_output.load_step1_output(input_json_path)
     except Exception as e:
         print(f"Error reading or parsing JSON file {input_json_path}: {e}", file=sys.stderr)
         return
@@ -1261,18 +1442,15 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
     # Sort events: put events with None dates last, then by date
     shipment_events.sort(key=lambda x: (x['date'] is None, x['date']))
     print(f"Extracted {len(shipment_events)} shipment events for SKUs {', '.join(TARGET_ENDOSCOPE_SKUS)}.")
-    all_shipped_target_serials = {evt['serial'] for evt in shipment_events if evt['serial']}
+    shipments_by_serial = _index_shipments_by_serial(shipment_events)
+    all_shipped_target_serials = set(shipments_by_serial)
 
     # --- Step 2: Initialize scopeMap with ALL shipped target serials ---
     scopeMap = {} # Stores details for every serial involved
-    for sn in all_shipped_target_serials:
-        # Find the earliest shipment event for this serial to get its initial ship date
-        initial_shipment = min(
-            (ship for ship in shipment_events if ship['serial'] == sn and ship['date'] is not None),
-            key=lambda x: x['date'],
-            # Fallback: find *any* shipment event if none have dates (less ideal)
-            default=next((ship for ship in shipment_events if ship['serial'] == sn), None)
-        )
+    for sn, serial_shipments in shipments_by_serial.items():
+        # The earliest shipment event for this serial gives its initial ship date
+        # (falling back to an undated event if none have dates)
+        initial_shipment = serial_shipments[0]
         initial_ship_date = dt_to_str(initial_shipment['date']) if initial_shipment and initial_shipment['date'] else 'N/A'
         initial_ship_date_obj = initial_shipment['date'] if initial_shipment and initial_shipment['date'] else None
 
@@ -1296,6 +1474,7 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
     # --- Step 2b: Initialize shipmentInstanceMap for instance-based tracking ---
     # This is needed for the enhanced orphan chain logic that tracks individual shipment instances
     shipmentInstanceMap = {}
+    instances_by_serial = {} # See _add_instance_to_serial_index
     for event in shipment_events:
         sn = event.get('serial')
         so_num = event.get('so_number')
@@ -1330,6 +1509,7 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
             'csaItemSku': sku,
             'csaItemName': sku
         }
+        _add_instance_to_serial_index(instances_by_serial, instance_key, sn, ship_dt)
     
     print(f"Initialized shipmentInstanceMap with {len(shipmentInstanceMap)} unique shipment instances.")
 
@@ -1377,14 +1557,10 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
                     # This requires all_shipped_target_serials to store (serial, sku) tuples or a dict.
                     # For now, let's assume all_shipped_target_serials will be enhanced.
                     # The SKU for the RMA event should be the SKU of the *original shipment* of that serial.
-                    original_shipment_sku = None
-                    # Find the original shipment SKU for this serial
-                    for ship_event in shipment_events:
-                        if ship_event['serial'] == sn:
-                            original_shipment_sku = ship_event['sku']
-                            break
-                    
-                    if sn in all_shipped_target_serials and original_shipment_sku:
+                    serial_shipments = shipments_by_serial.get(sn)
+                    original_shipment_sku = serial_shipments[0]['sku'] if serial_shipments else None
+
+                    if original_shipment_sku:
                         rma_events.append({
                             'date': dt, # date obj
                             'rma_number': rma_number,
@@ -1406,19 +1582,10 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
         rma_dt_str = dt_to_str(rma_dt)
         
         # Find the most recently shipped instance of this serial that is still inField
-        most_recent_instance_key = None
-        most_recent_ship_date = None
-        
-        for instance_key, instance_data in shipmentInstanceMap.items():
-            if (instance_data['serial'] == rma_sn and
-                instance_data['currentStatus'] == 'inField' and
-                instance_data['originalShipmentDateObj']):
-                
-                ship_dt = instance_data['originalShipmentDateObj']
-                if ship_dt <= rma_dt:  # Only consider instances shipped before or on the RMA date
-                    if most_recent_ship_date is None or ship_dt > most_recent_ship_date:
-                        most_recent_instance_key = instance_key
-                        most_recent_ship_date = ship_dt
+        # (only instances shipped before or on the RMA date are considered)
+        most_recent_instance_key = _most_recent_in_field_instance(
+            instances_by_serial, shipmentInstanceMap, rma_sn, rma_dt
+        )
         
         # Update the most recent instance with RMA information
         if most_recent_instance_key:
@@ -1431,7 +1598,7 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
 
     # --- Step 4: Identify CSA cohorts and Update scopeMap ---
     csa_sku_keywords = ['HiFCSA-1yr', 'HiFCSA-2yr']
-    csa_cohorts = []
+    csa_cohorts = CohortRegistry() # Cohorts by orderId and start date (see cohort_registry)
     serial_to_cohort_map = {} # Use this specific map for original cohort members only
     # COHORT ISOLATION FIX: Track original cohort membership
     original_cohort_membership = {}  # serial -> original_cohort_id
@@ -1614,17 +1781,14 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
         # --- ALSO: Update shipmentInstanceMap with cohort assignments ---
         for sn in cohort_data['csaScopes']:
             # Find all instances of this serial and assign them to the cohort
-            for instance_key, instance_data in shipmentInstanceMap.items():
-                if instance_data['serial'] == sn:
-                    if instance_data['cohort'] is not None and instance_data['cohort'] != so_number:
-                        print(f"Warning: Instance {instance_key} reassigned from cohort {instance_data['cohort']} to {so_number}. Check data.", file=sys.stderr)
-                    instance_data['cohort'] = so_number
+            for instance_key in instances_by_serial.get(sn, ((), ()))[1]:
+                instance_data = shipmentInstanceMap[instance_key]
+                if instance_data['cohort'] is not None and instance_data['cohort'] != so_number:
+                    print(f"Warning: Instance {instance_key} reassigned from cohort {instance_data['cohort']} to {so_number}. Check data.", file=sys.stderr)
+                instance_data['cohort'] = so_number
 
     # Initialize new fields for cohort capacity and tracking (Phase 0)
-    for cohort_obj in csa_cohorts:
-        cohort_obj['total_CSA_slots'] = cohort_obj.get('initialScopeCount', 0)
-        cohort_obj['current_validated_in_field_count'] = 0
-        cohort_obj['current_assigned_in_field_orphans'] = 0
+    csa_cohorts.reset_capacity()
 
     print(f"Identified {len(csa_cohorts)} relevant CSA cohorts for SKUs {', '.join(TARGET_ENDOSCOPE_SKUS)}.")
     if not csa_cohorts:
@@ -1708,9 +1872,7 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
                     if starter_instance:
                         cohort_id = starter_instance.get('cohort')
                         if cohort_id:
-                            target_cohort = next((c for c in csa_cohorts if c['orderId'] == cohort_id), None)
-                            if target_cohort:
-                                target_cohort['current_validated_in_field_count'] += 1
+                            csa_cohorts.add_validated_in_field(cohort_id)
             print(f"Calculated current_validated_in_field_count for {len(csa_cohorts)} cohorts.")
 
     else:
@@ -1783,9 +1945,7 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
     # This fixes the flawed calculation from lines 1524-1537 and ensures orphan assignment uses correct counts
     for cohort_id, chains in chains_by_cohort.items():
         correct_in_field_count = sum(1 for chain in chains if chain.get('final_status') == 'inField')
-        target_cohort = next((c for c in csa_cohorts if c['orderId'] == cohort_id), None)
-        if target_cohort:
-            target_cohort['current_validated_in_field_count'] = correct_in_field_count
+        csa_cohorts.set_validated_in_field(cohort_id, correct_in_field_count)
     print(f"Recalculated correct current_validated_in_field_count for {len(chains_by_cohort)} cohorts using actual chain data.")
     
     # Sort and print validated chains - separated by SKU
@@ -1798,7 +1958,7 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
             status = item["final_status"]; sort_order = {"inField": 0, "returned_replaced": 1, "returned_no_replacement_found": 2, "returned_no_replacement_available": 3, "returned_error_no_cohort": 98, "Unknown": 99}.get(status, 100); return (sort_order, item["chain"][0]["serial"])
         chains_to_process.sort(key=chain_sort_key)
         # Fetch the definitive cohort data from csa_cohorts list, which has updated counts
-        definitive_cohort_data = next((c for c in csa_cohorts if c['orderId'] == cohort_id), None)
+        definitive_cohort_data = csa_cohorts.get(cohort_id)
         
         if not definitive_cohort_data:
             print(f"Critical Error: Definitive cohort data not found for cohort_id {cohort_id} in csa_cohorts list. Skipping.", file=sys.stderr)
@@ -1912,11 +2072,10 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
             if original_cohort_id:
                 print(f"  SRO {sro_serial}: Checking original cohort {original_cohort_id} first...")
                 # Try to assign to original cohort first
-                original_cohort = next((c for c in csa_cohorts if c['orderId'] == original_cohort_id), None)
+                original_cohort = csa_cohorts.get(original_cohort_id)
                 
-                if original_cohort and original_cohort['remainingReplacements'] > 0:
+                if csa_cohorts.use_replacement(original_cohort):
                     # PREFERRED: Assign to original cohort
-                    original_cohort['remainingReplacements'] -= 1
                     instance_data['cohort'] = original_cohort['orderId']
                     instance_data['currentStatus'] = 'SRO_slot_consumed'
                     
@@ -1942,22 +2101,13 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
             
             if not assigned:
                 # FALLBACK: Find best alternative cohort by date
-                best_cohort_for_sro = None
-                latest_start_date_for_sro = None
-
-                for cohort_obj in csa_cohorts:
-                    cohort_start_date_obj = cohort_obj.get('startDateObj')
-                    if (cohort_start_date_obj and
-                        cohort_start_date_obj <= sro_initial_ship_date_obj and
-                        cohort_obj['remainingReplacements'] > 0):
-                        
-                        if latest_start_date_for_sro is None or cohort_start_date_obj > latest_start_date_for_sro:
-                            latest_start_date_for_sro = cohort_start_date_obj
-                            best_cohort_for_sro = cohort_obj
+                best_cohort_for_sro = csa_cohorts.latest_started_on_or_before(
+                    sro_initial_ship_date_obj, csa_cohorts.has_replacements
+                )
                 
                 if best_cohort_for_sro:
                     # CROSS-COHORT ASSIGNMENT - Track as violation
-                    best_cohort_for_sro['remainingReplacements'] -= 1
+                    csa_cohorts.use_replacement(best_cohort_for_sro)
                     instance_data['cohort'] = best_cohort_for_sro['orderId']
                     instance_data['currentStatus'] = 'SRO_slot_consumed'
                     
@@ -2235,7 +2385,7 @@ def build_csa_replacement_chains(input_json_path, output_json_path, output_md_pa
 if __name__ == "__main__":
     # Setup argument parser for direct execution/testing
     parser = argparse.ArgumentParser(description=f"Analyze CSA replacement chains for SKUs: {', '.join(TARGET_ENDOSCOPE_SKUS)}.")
-    parser.add_argument('--input-json', required=True, help='Path to the input JSON file from STEP1.')
+    parser.add_argument('--input-json', required=True, help='Path to the STEP1 output file (.json, or streamed .ndjson).')
     parser.add_argument('--output-json', required=True, help='Path to save the analysis JSON output.')
     parser.add_argument('--output-md', required=True, help='Path to save the analysis report/log.')
 
@@ -2,9 +2,13 @@ from fastapi import APIRouter, Request, HTTPException
 import logging
 import traceback
 import asyncio
+import functools
 import os
 import json
-from process_clinics import get_aggregated_clinic_data
+from process_clinics import get_aggregated_clinic_data, get_aggregated_clinic_data_async
+import zoho_client
+import zoho_rate_limit
+import zoho_telemetry
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO) # Ensure basicConfig is called if not already configured globally
@@ -81,16 +85,24 @@ async def get_step2_analysis(customer_name: str):
         raise HTTPException(status_code=500, detail=f"Failed to load Step2 analysis: {str(e)}")
 
 @router.post("/sync-now")
-async def sync_clinic_data_now(request: Request):
+async def sync_clinic_data_now(request: Request, full: bool = False, engine: str = "async"):
     """
     Endpoint to manually trigger clinic data sync.
-    This will fetch fresh data from Zoho and update app.state.clinic_data.
+    This will fetch changed data from Zoho and update app.state.clinic_data.
+    Pass ?full=true to re-download every document instead of syncing incrementally.
+    The sync runs on the event loop (engine=async); engine=threaded runs the
+    threaded STEP1 in an executor thread instead.
     """
-    logger.info("Manual sync endpoint /sync-now hit.")
+    logger.info(f"Manual sync endpoint /sync-now hit (full={full}, engine={engine}).")
+    if engine not in ("async", "threaded"):
+        raise HTTPException(status_code=400, detail=f"Unknown sync engine: {engine}")
     try:
         logger.info("Starting manual clinic data sync...")
-        loop = asyncio.get_event_loop()
-        clinic_data = await loop.run_in_executor(None, get_aggregated_clinic_data)
+        if engine == "async":
+            clinic_data = await get_aggregated_clinic_data_async(incremental=not full)
+        else:
+            loop = asyncio.get_event_loop()
+            clinic_data = await loop.run_in_executor(None, functools.partial(get_aggregated_clinic_data, incremental=not full))
         request.app.state.clinic_data = clinic_data
         logger.info("Manual sync completed successfully.")
         return {
@@ -101,4 +113,19 @@ async def sync_clinic_data_now(request: Request):
     except Exception as e:
         logger.error(f"Error during manual sync: {e}")
         logger.error(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=f"Manual sync failed: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Manual sync failed: {str(e)}")
+
+
+@router.get("/zoho-telemetry")
+async def get_zoho_telemetry():
+    """
+    Returns the Zoho API call counters of this server process (per endpoint and
+    clinic group), the report of the most recent sync it ran, and the current
+    state of the shared HTTP client and rate limiter.
+    """
+    return {
+        "process": zoho_telemetry.snapshot(),
+        "last_sync": zoho_telemetry.last_report,
+        "client": zoho_client.get_client().stats(),
+        "rate_limiter": zoho_rate_limit.get_rate_limiter().stats(),
+    }
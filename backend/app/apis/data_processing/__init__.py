@@ -7,6 +7,7 @@ from datetime import datetime, timedelta, date
 from dateutil.relativedelta import relativedelta
 from collections import deque, defaultdict
 from app.apis.zoho_data_extractor import generate_serial_history_data
+from cohort_registry import CohortRegistry
 import sys
 
 router = APIRouter()
@@ -169,13 +170,12 @@ def associate_orphans_to_cohorts(orphan_chains, shipmentInstanceMap, csa_cohorts
             chain['assigned_cohort'] = "No CSA Cohorts Defined"
             chain['assignment_reason'] = "N/A"
         return orphan_chains
-    valid_cohorts = [c for c in csa_cohorts if isinstance(c.get('startDateObj'), date)]
+    valid_cohorts = csa_cohorts.by_start_date()
     if not valid_cohorts:
          for chain in orphan_chains:
             chain['assigned_cohort'] = "No Valid CSA Cohorts Found"
             chain['assignment_reason'] = "N/A"
          return orphan_chains
-    valid_cohorts.sort(key=lambda x: x['startDateObj'])
 
     for chain_data in orphan_chains:
         starter_instance_key = chain_data.get('starter_instance_key')
@@ -192,11 +192,7 @@ def associate_orphans_to_cohorts(orphan_chains, shipmentInstanceMap, csa_cohorts
              continue
 
 
-        best_cohort = None
-        for cohort in reversed(valid_cohorts):
-            if cohort['startDateObj'] <= initial_ship_dt:
-                best_cohort = cohort
-                break
+        best_cohort = next(csa_cohorts.started_on_or_before(initial_ship_dt), None)
         if best_cohort:
             chain_data['assigned_cohort'] = best_cohort['orderId']
             chain_data['assignment_reason'] = (f"Initial ship date {dt_to_str(initial_ship_dt)} >= cohort {best_cohort['orderId']} start {dt_to_str(best_cohort['startDateObj'])}.")
@@ -571,7 +567,7 @@ def process_sales_data_logic(raw_data: dict) -> dict:
 
     # --- Start of User's Script Integration ---
     print("Step 4: Defining CSA Cohorts based on new logic...")
-    csa_cohorts = [] # This will be a list of cohort_info dicts
+    csa_cohorts = CohortRegistry() # cohort_info dicts by orderId and start date (see cohort_registry)
     # serial_to_cohort_map = {} # Not directly used in the final structure, cohortId is on instance
 
     # Using global CSA_SKU_KEYWORDS, CSA_ITEM_NAME_KEYWORDS, TARGET_ENDOSCOPE_SKU from module level
@@ -807,7 +803,7 @@ def process_sales_data_logic(raw_data: dict) -> dict:
             returned_item_cohort_id_user = returned_item_instance_data_user.get('cohort')
             cohort_for_this_return_user = None
             if returned_item_cohort_id_user:
-                cohort_for_this_return_user = next((c_user for c_user in csa_cohorts if c_user['orderId'] == returned_item_cohort_id_user), None)
+                cohort_for_this_return_user = csa_cohorts.get(returned_item_cohort_id_user)
                 print(f"DEBUG (Step 6 - RMA Item SN {returned_sn_from_rma_user}): Returned item belongs to Cohort {returned_item_cohort_id_user}. Found cohort data: {cohort_for_this_return_user is not None}")
             else:
                 print(f"DEBUG (Step 6 - RMA Item SN {returned_sn_from_rma_user}): Returned item does not belong to any cohort.")
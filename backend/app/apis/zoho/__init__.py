@@ -5,6 +5,8 @@ import databutton as db
 from pydantic import BaseModel
 from typing import Dict, Any, List, Optional
 
+import zoho_client
+
 router = APIRouter()
 
 # Fixed configuration values
@@ -63,7 +65,7 @@ def refresh_zoho_token():
         "grant_type": "refresh_token"
     }
     
-    response = requests.post(url, data=data)  # Changed params to data
+    response = zoho_client.get_client().post(url, data=data)  # Changed params to data
     if response.status_code != 200:
         raise HTTPException(status_code=response.status_code, 
                             detail=f"Failed to refresh token: {response.text}")
@@ -104,12 +106,12 @@ def zoho_get(url, params=None):
     headers = get_headers(access_token)
     
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = zoho_client.get_client().get(url, headers=headers, params=params)
         if response.status_code == 401:
             print("Token expired, refreshing...")
             access_token = refresh_zoho_token().get("access_token")
             headers = get_headers(access_token)
-            response = requests.get(url, headers=headers, params=params)
+            response = zoho_client.get_client().get(url, headers=headers, params=params)
         
         response.raise_for_status()
         return response.json()
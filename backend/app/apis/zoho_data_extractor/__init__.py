@@ -1,14 +1,22 @@
 
 import databutton as db
 import json
+import os
 import requests
 import sys
 from datetime import datetime
 from collections import defaultdict
+
+import zoho_client
+import zoho_store
+from generate_serial_history import build_serial_history_from_store
 # from dateutil.relativedelta import relativedelta # Keep if CSA calculations are ever re-introduced
 
 # ZOHO_API_BASE_URL remains the same
 ZOHO_API_BASE_URL = "https://www.zohoapis.com/inventory/v1"
+# Same setting as process_clinics: with 'store', the serial history is derived from
+# the local document store (when it was recently synced, item serial numbers included).
+CLINIC_SYNC_SOURCE = os.environ.get('CLINIC_SYNC_SOURCE', 'zoho').lower()
 
 def get_zoho_config_from_secrets():
     """Loads Zoho configuration from Databutton secrets."""
@@ -45,7 +53,7 @@ def refresh_and_get_new_access_token(config):
         "grant_type": "refresh_token"
     }
     try:
-        response = requests.post(url, data=data)
+        response = zoho_client.get_client().post(url, data=data)
         response.raise_for_status()
         tokens = response.json()
         if "access_token" in tokens:
@@ -79,7 +87,7 @@ def zoho_get(url, config, current_access_token, params=None):
 
     updated_token_in_session = current_access_token
     try:
-        response = requests.get(url, headers=headers, params=params or {})
+        response = zoho_client.get_client().get(url, headers=headers, params=params or {})
         if response.status_code == 401:
             print("Token expired (401), refreshing...")
             new_token = refresh_and_get_new_access_token(config)
@@ -88,7 +96,7 @@ def zoho_get(url, config, current_access_token, params=None):
             updated_token_in_session = new_token
             headers = get_headers(updated_token_in_session, config["organization_id"])
             if not headers: raise Exception("Failed to get headers after refresh.")
-            response = requests.get(url, headers=headers, params=params or {})
+            response = zoho_client.get_client().get(url, headers=headers, params=params or {})
         response.raise_for_status()
         return response.json(), updated_token_in_session
     except requests.exceptions.RequestException as e:
@@ -224,6 +232,17 @@ def aggregate_and_sort_events(all_events_lists):
     return dict(serial_map)
 
 def generate_serial_history_data():
+    if CLINIC_SYNC_SOURCE == 'store':
+        store = zoho_store.get_store()
+        # InStock events come from the item serial numbers, which a --no-stock sync leaves out
+        if store.synced_within('synced_at') and store.synced_within('stock_synced_at'):
+            try:
+                return build_serial_history_from_store(store)
+            except Exception as e:
+                print(f"Error building serial history from the document store ({e}); fetching from Zoho instead.", file=sys.stderr)
+        else:
+            print(f"WARNING: Document store (or its item serial numbers) not synced in the last {zoho_store.MAX_SYNC_AGE_HOURS:g} hours; fetching serial history from Zoho.", file=sys.stderr)
+
     print("Serial Number History Generation Started (Databutton Adapted).")
     config = get_zoho_config_from_secrets()
     if not config: return None
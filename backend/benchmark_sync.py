@@ -0,0 +1,127 @@
+# Offline sync benchmark.
+#
+# Replays a fixture archive recorded with ZOHO_HTTP_MODE=record (see
+# zoho_fixtures) through STEP1, STEP1_async or generate_serial_history, so
+# worker counts, concurrency and rate-limit settings can be compared without
+# touching Zoho. Example:
+#
+#   ZOHO_HTTP_MODE=record python STEP1.py --contact-ids 3565249000001061039 --output-json /tmp/oasis.json
+#   python benchmark_sync.py --target step1 --contact-ids 3565249000001061039 \
+#       --workers 4 8 16 --latency-ms 150 --quota-per-minute 100 --rate-limit-per-minute 100
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import STEP1
+import STEP1_async
+import generate_serial_history
+import zoho_cache
+import zoho_client
+import zoho_concurrency
+import zoho_fixtures
+import zoho_rate_limit
+
+TARGETS = ('step1', 'step1-async', 'serial-history')
+
+
+def run_target(target, contact_ids, workers, work_dir):
+    """Runs one sync against the replay transport with stdout suppressed."""
+    output_path = os.path.join(work_dir, f"{target}-{workers}.json")
+    with contextlib.redirect_stdout(io.StringIO()):
+        if target == 'step1':
+            STEP1.run_step1(contact_ids, output_path, max_workers=workers, resume=False)
+        elif target == 'step1-async':
+            asyncio.run(STEP1_async.run_step1_async(contact_ids, output_path, max_concurrency=workers, resume=False))
+        else:
+            argv = sys.argv
+            sys.argv = ['generate_serial_history.py', '--output-json', output_path,
+                        '--raw-output', os.path.join(work_dir, f"{target}-{workers}-raw.jsonl.gz"),
+                        '--max-workers', str(workers)]
+            try:
+                generate_serial_history.main()
+            except SystemExit:
+                pass
+            finally:
+                sys.argv = argv
+
+
+def benchmark(args):
+    # Replay answers token refreshes itself, so a placeholder config is enough.
+    work_dir = tempfile.mkdtemp(prefix='zoho-benchmark-')
+    config_path = os.path.join(work_dir, 'config_inventory.json')
+    with open(config_path, 'w') as f:
+        json.dump({"access_token": "replay-token", "refresh_token": "replay", "client_id": "replay",
+                   "client_secret": "replay", "organization_id": "replay"}, f)
+    STEP1.CONFIG_PATH = config_path
+    generate_serial_history.CONFIG_PATH = config_path
+    if not args.use_cache:
+        zoho_cache.CACHE_ENABLED = False
+
+    results = []
+    for workers in args.workers:
+        # A fresh transport, limiter and client per run so quota windows and counters start empty
+        transport = zoho_fixtures.configure(
+            'replay', args.fixture_path, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate, quota_per_minute=args.quota_per_minute, seed=args.seed
+        )
+        limiter = zoho_rate_limit.configure_rate_limiter(
+            requests_per_minute=args.rate_limit_per_minute, requests_per_day=args.rate_limit_per_day
+        )
+        concurrency = zoho_concurrency.configure_concurrency_limiter(
+            initial_limit=workers, adaptive=not args.fixed_concurrency
+        )
+        zoho_client.configure_client(pool_size=max(workers, zoho_client.DEFAULT_POOL_SIZE))
+
+        started = time.monotonic()
+        run_target(args.target, args.contact_ids, workers, work_dir)
+        elapsed = time.monotonic() - started
+
+        replay_stats = transport.stats()
+        limiter_stats = limiter.stats()
+        requests_sent = sum(replay_stats.values())
+        result = {
+            "workers": workers,
+            "seconds": round(elapsed, 2),
+            "requests": requests_sent,
+            "requests_per_second": round(requests_sent / elapsed, 1) if elapsed else None,
+            **replay_stats,
+            "limiter_wait_seconds": limiter_stats["total_wait_seconds"],
+            "concurrency": concurrency.stats(),
+        }
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Zoho sync settings against a recorded fixture archive.")
+    parser.add_argument('--target', choices=TARGETS, default='step1', help='Which sync to run.')
+    parser.add_argument('--contact-ids', nargs='+', default=[], help='Contact IDs for the STEP1 targets (as recorded).')
+    parser.add_argument('--fixture-path', default=zoho_fixtures.DEFAULT_FIXTURE_PATH, help='Fixture archive to replay.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[STEP1.DEFAULT_MAX_WORKERS],
+                        help='Worker counts (STEP1) or concurrency limits (STEP1_async) to compare.')
+    parser.add_argument('--latency-ms', default=zoho_fixtures.REPLAY_LATENCY_MS,
+                        help='Per-request latency; omit to use the recorded latency of each response.')
+    parser.add_argument('--jitter-ms', type=float, default=zoho_fixtures.REPLAY_JITTER_MS, help='Random extra latency per request.')
+    parser.add_argument('--error-rate', type=float, default=zoho_fixtures.REPLAY_429_RATE, help='Fraction of requests answered with a 429.')
+    parser.add_argument('--quota-per-minute', type=int, default=zoho_fixtures.REPLAY_QUOTA_PER_MINUTE,
+                        help="Emulated Zoho per-minute quota (0 = unlimited).")
+    parser.add_argument('--rate-limit-per-minute', type=int, default=zoho_rate_limit.DEFAULT_REQUESTS_PER_MINUTE,
+                        help='Client-side limiter budget per minute.')
+    parser.add_argument('--rate-limit-per-day', type=int, default=zoho_rate_limit.DEFAULT_REQUESTS_PER_DAY,
+                        help='Client-side limiter budget per day.')
+    parser.add_argument('--seed', default=zoho_fixtures.REPLAY_SEED, help='Seed for jitter and 429 injection.')
+    parser.add_argument('--fixed-concurrency', action='store_true',
+                        help='Disable the adaptive concurrency limit, so the worker count alone bounds requests in flight.')
+    parser.add_argument('--use-cache', action='store_true', help='Let STEP1 use the response cache (off by default).')
+    args = parser.parse_args()
+
+    if args.target != 'serial-history' and not args.contact_ids:
+        parser.error('--contact-ids is required for the STEP1 targets')
+    benchmark(args)
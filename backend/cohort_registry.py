@@ -0,0 +1,140 @@
+# Registry of CSA cohorts shared by STEP2 and the data_processing API.
+#
+# A cohort is the dict STEP2 (or data_processing) builds for a CSA order, keyed
+# by its 'orderId'. CohortRegistry keeps them in the order they were added (it
+# iterates, indexes and counts like the list it replaces) and adds:
+#   - O(1) lookup by orderId (the first cohort added wins for duplicate ids);
+#   - a view sorted by start date, searched with bisect for "latest cohort
+#     started on or before a date";
+#   - the capacity counters STEP2 keeps on each cohort (in-field slots and
+#     replacement events), updated through one set of methods.
+# The cohort dicts stay the single source of truth, so anything reading them
+# (reports, JSON output) sees the same values as before.
+from bisect import bisect_right
+from datetime import date
+
+
+class CohortRegistry:
+    """CSA cohort dicts in insertion order, indexed by orderId and by start date."""
+
+    def __init__(self, cohorts=()):
+        self._cohorts = []
+        self._by_id = {}
+        self._start_dates = None # Sorted start dates of _by_start; rebuilt after changes
+        self._by_start = None
+        for cohort in cohorts:
+            self.append(cohort)
+
+    def append(self, cohort):
+        self._cohorts.append(cohort)
+        self._by_id.setdefault(cohort['orderId'], cohort)
+        self._start_dates = self._by_start = None
+
+    def sort(self, key=None, reverse=False):
+        """Reorders the cohorts in place, like list.sort."""
+        self._cohorts.sort(key=key, reverse=reverse)
+        self._start_dates = self._by_start = None
+
+    def __iter__(self):
+        return iter(self._cohorts)
+
+    def __len__(self):
+        return len(self._cohorts)
+
+    def __getitem__(self, index):
+        return self._cohorts[index]
+
+    def get(self, order_id, default=None):
+        """Returns the cohort with this orderId, or default."""
+        return self._by_id.get(order_id, default)
+
+    def order_ids(self):
+        return set(self._by_id)
+
+    # --- Start-date view ---
+
+    def _start_view(self):
+        # Cohorts without a start date cannot be matched by date and are left out.
+        # The sort is stable, so cohorts starting the same day keep insertion order.
+        if self._by_start is None:
+            self._by_start = sorted(
+                (cohort for cohort in self._cohorts if isinstance(cohort.get('startDateObj'), date)),
+                key=lambda cohort: cohort['startDateObj']
+            )
+            self._start_dates = [cohort['startDateObj'] for cohort in self._by_start]
+        return self._start_dates, self._by_start
+
+    def by_start_date(self):
+        """Returns the cohorts that have a start date, earliest first."""
+        return list(self._start_view()[1])
+
+    def started_on_or_before(self, day):
+        """Yields the cohorts started on or before day, latest start first (later-added first on ties)."""
+        start_dates, by_start = self._start_view()
+        for index in range(bisect_right(start_dates, day) - 1, -1, -1):
+            yield by_start[index]
+
+    def latest_started_on_or_before(self, day, accept=None):
+        """
+        Returns the cohort with the latest start date on or before day for which
+        accept(cohort) is true (any cohort if accept is None), or None. Among
+        cohorts started the same day, the one added first wins.
+        """
+        start_dates, by_start = self._start_view()
+        end = bisect_right(start_dates, day)
+        while end > 0:
+            # [begin, end) is the group of cohorts sharing the latest remaining start date
+            begin = end - 1
+            while begin > 0 and start_dates[begin - 1] == start_dates[end - 1]:
+                begin -= 1
+            for cohort in by_start[begin:end]:
+                if accept is None or accept(cohort):
+                    return cohort
+            end = begin
+        return None
+
+    # --- Capacity counters ---
+
+    def reset_capacity(self):
+        """Sets every cohort's in-field slots to its initial scope count, with none used."""
+        for cohort in self._cohorts:
+            cohort['total_CSA_slots'] = cohort.get('initialScopeCount', 0)
+            cohort['current_validated_in_field_count'] = 0
+            cohort['current_assigned_in_field_orphans'] = 0
+
+    @staticmethod
+    def in_field_count(cohort):
+        """Validated chains plus orphans currently counted in the field for a cohort."""
+        return cohort.get('current_validated_in_field_count', 0) + cohort.get('current_assigned_in_field_orphans', 0)
+
+    @staticmethod
+    def has_in_field_capacity(cohort):
+        return CohortRegistry.in_field_count(cohort) < cohort.get('total_CSA_slots', 0)
+
+    def set_validated_in_field(self, order_id, count):
+        cohort = self.get(order_id)
+        if cohort is not None:
+            cohort['current_validated_in_field_count'] = count
+        return cohort
+
+    def add_validated_in_field(self, order_id):
+        cohort = self.get(order_id)
+        if cohort is not None:
+            cohort['current_validated_in_field_count'] = cohort.get('current_validated_in_field_count', 0) + 1
+        return cohort
+
+    @staticmethod
+    def assign_in_field_orphan(cohort):
+        cohort['current_assigned_in_field_orphans'] = cohort.get('current_assigned_in_field_orphans', 0) + 1
+
+    @staticmethod
+    def has_replacements(cohort):
+        return cohort is not None and cohort['remainingReplacements'] > 0
+
+    @staticmethod
+    def use_replacement(cohort):
+        """Consumes one of the cohort's replacement events. Returns False if none were left."""
+        if not CohortRegistry.has_replacements(cohort):
+            return False
+        cohort['remainingReplacements'] -= 1
+        return True
@@ -0,0 +1,225 @@
+# Keeps the local Zoho document store (zoho_store) current.
+#
+# This is the one place that fetches sales orders, packages, sales returns and
+# item serial numbers for the consumers that derive their inputs from the store
+# (STEP1.write_step1_output_from_store, generate_serial_history
+# .build_serial_history_from_store). Each sync pages the organization-wide lists
+# and only fetches the details of documents that changed since they were stored:
+#   - sales orders: listed newest-modified first and paged back to the
+#     watermark of the last clean sync; an order is re-fetched when its
+#     last_modified_time moved;
+#   - packages: re-fetched with their order, as a package can be edited
+#     without its status moving (see STEP1.package_validator);
+#   - sales returns: re-fetched when STEP1.salesreturn_change_key moved;
+#   - item serial numbers (optional): every inventory item's serial list is
+#     re-read, as Zoho gives no way to tell which ones changed.
+# Documents that disappear from a fully paged list are deleted from the store.
+# Requests go through STEP1.zoho_get, so they share the HTTP client, rate
+# limiter, concurrency limiter, response cache and telemetry of a STEP1 run.
+import argparse
+import os
+import sys
+import traceback
+from datetime import datetime
+
+import STEP1
+import zoho_client
+import zoho_store
+
+DEFAULT_MAX_WORKERS = int(os.environ.get('DOCUMENT_SYNC_MAX_WORKERS', str(STEP1.DEFAULT_MAX_WORKERS)))
+
+
+def fetch_list(config, endpoint, list_key, params=None):
+    """Pages through an organization-wide list. Raises RuntimeError if a page fails."""
+    url = f"{STEP1.ZOHO_API_BASE_URL}/{endpoint}"
+    params = dict(params or {}, per_page=STEP1.LIST_PAGE_SIZE)
+    rows = []
+    page = 1
+    has_more_pages = True
+    while has_more_pages:
+        params['page'] = page
+        data = STEP1.zoho_get(url, config, params)
+        if not data:
+            raise RuntimeError(f"Failed to fetch {endpoint} page {page}")
+        rows.extend(data.get(list_key, []))
+        has_more_pages = data.get('page_context', {}).get('has_more_page', False)
+        page += 1
+    return rows
+
+
+def store_salesorder(config, store, so, known_packages):
+    """
+    Fetches a listed sales order, and each of its packages whose validator
+    (STEP1.package_validator) moved, and stores them. The order is stored last, so an interrupted sync fetches it
+    again. Returns False if a fetch failed.
+    """
+    so_id = so['salesorder_id']
+    modified_time = so.get('last_modified_time')
+    try:
+        so_detail = STEP1.fetch_detail(config, 'salesorders', so_id, modified_time).get('salesorder')
+        if not so_detail:
+            print(f"  Warning: could not fetch sales order {so_id}")
+            return False
+        customer_id = so_detail.get('customer_id') or so.get('customer_id')
+        so_modified_time = modified_time or so_detail.get('last_modified_time')
+        for pkg_from_so in so_detail.get('packages', []):
+            pkg_id = pkg_from_so.get('package_id')
+            validator = STEP1.package_validator(so_modified_time, pkg_from_so)
+            if not pkg_id or (pkg_id in known_packages and known_packages[pkg_id] == validator):
+                continue
+            pkg_detail = STEP1.fetch_detail(config, 'packages', pkg_id, validator).get('package')
+            if not pkg_detail:
+                print(f"  Warning: could not fetch package {pkg_id} of sales order {so_id}")
+                return False
+            store.put('packages', pkg_id, pkg_detail, validator, customer_id)
+        store.put('salesorders', so_id, so_detail, modified_time, customer_id)
+        return True
+    except Exception as e:
+        print(f"  Error fetching sales order {so_id}: {e}")
+        return False
+
+
+def sync_salesorders(config, store, incremental=True, max_workers=DEFAULT_MAX_WORKERS):
+    """Brings the stored sales orders and packages up to date. Returns counts for the summary."""
+    watermark = store.get_meta('salesorders_watermark') if incremental else None
+    salesorders, reached_end = STEP1.fetch_salesorders_modified_since(config, None, watermark)
+    known = store.modified_times('salesorders')
+    to_fetch = [
+        so for so in salesorders
+        if so.get('salesorder_id') and known.get(so['salesorder_id']) != so.get('last_modified_time')
+    ]
+    print(f"Sales orders: {len(salesorders)} listed, {len(to_fetch)} new or modified")
+
+    known_packages = store.modified_times('packages')
+    results = list(STEP1.map_concurrently(
+        lambda so: store_salesorder(config, store, so, known_packages), to_fetch, max_workers
+    ))
+    failed = results.count(False)
+
+    deleted = 0
+    if reached_end:
+        deleted = store.delete_missing('salesorders', [so.get('salesorder_id') for so in salesorders])
+        package_ids = [
+            pkg.get('package_id')
+            for _, _, so_detail in store.iter_documents('salesorders')
+            for pkg in so_detail.get('packages', [])
+        ]
+        deleted += store.delete_missing('packages', package_ids)
+
+    if not failed:
+        # Failed orders keep their stored timestamp, so only a clean sync may move the watermark past them.
+        listed_times = [so.get('last_modified_time') for so in salesorders]
+        store.set_meta('salesorders_watermark', STEP1.latest_zoho_timestamp(listed_times + [watermark]))
+    return {"listed": len(salesorders), "fetched": len(to_fetch) - failed, "failed": failed, "deleted": deleted}
+
+
+def store_salesreturn(config, store, rma):
+    """Fetches a listed sales return and stores it. Returns False if the fetch failed."""
+    rma_id = rma['salesreturn_id']
+    change_key = STEP1.salesreturn_change_key(rma)
+    try:
+        rma_detail = STEP1.fetch_detail(config, 'salesreturns', rma_id, change_key).get('salesreturn')
+        if not rma_detail:
+            print(f"  Warning: could not fetch sales return {rma_id}")
+            return False
+        store.put('salesreturns', rma_id, rma_detail, change_key, rma_detail.get('customer_id') or rma.get('customer_id'))
+        return True
+    except Exception as e:
+        print(f"  Error fetching sales return {rma_id}: {e}")
+        return False
+
+
+def sync_salesreturns(config, store, max_workers=DEFAULT_MAX_WORKERS):
+    """Brings the stored sales returns up to date. Returns counts for the summary."""
+    salesreturns = STEP1.fetch_all_salesreturns(config)
+    known = store.modified_times('salesreturns')
+    to_fetch = [
+        rma for rma in salesreturns
+        if rma.get('salesreturn_id') and known.get(rma['salesreturn_id']) != STEP1.salesreturn_change_key(rma)
+    ]
+    print(f"Sales returns: {len(salesreturns)} listed, {len(to_fetch)} new or modified")
+    results = list(STEP1.map_concurrently(lambda rma: store_salesreturn(config, store, rma), to_fetch, max_workers))
+    failed = results.count(False)
+    deleted = store.delete_missing('salesreturns', [rma.get('salesreturn_id') for rma in salesreturns])
+    return {"listed": len(salesreturns), "fetched": len(to_fetch) - failed, "failed": failed, "deleted": deleted}
+
+
+def store_item_serialnumbers(config, store, item):
+    """Reads an inventory item's serial number list and stores it. Returns False if a page failed."""
+    item_id = item['item_id']
+    try:
+        serial_numbers = fetch_list(config, 'items/serialnumbers', 'serial_numbers', {'item_id': item_id})
+    except Exception as e:
+        print(f"  Error fetching serial numbers for item {item_id}: {e}")
+        return False
+    document = {
+        "item": {"item_id": item_id, "sku": item.get('sku'), "name": item.get('name')},
+        "serial_numbers": serial_numbers,
+    }
+    store.put('item_serialnumbers', item_id, document)
+    return True
+
+
+def sync_stock(config, store, max_workers=DEFAULT_MAX_WORKERS):
+    """Re-reads the serial numbers of every inventory item. Returns counts for the summary."""
+    items = [
+        item for item in fetch_list(config, 'items', 'items')
+        if item.get('item_type') == 'inventory' and item.get('item_id')
+    ]
+    print(f"Items: {len(items)} inventory items")
+    results = list(STEP1.map_concurrently(lambda item: store_item_serialnumbers(config, store, item), items, max_workers))
+    failed = results.count(False)
+    deleted = store.delete_missing('item_serialnumbers', [item['item_id'] for item in items])
+    store.set_meta('stock_synced_at', datetime.now().isoformat())
+    return {"listed": len(items), "fetched": len(items) - failed, "failed": failed, "deleted": deleted}
+
+
+def sync_documents(config=None, store=None, incremental=True, include_stock=True, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Brings the document store up to date with Zoho. With incremental=False every
+    listed document is compared again (details are still only re-fetched when
+    they changed). include_stock=False skips the item serial number lists,
+    which only the serial history needs. Returns the counts per document type.
+    """
+    config = config or STEP1.load_config()
+    store = store or zoho_store.get_store()
+    zoho_client.get_client().concurrency_limiter.start_at(max_workers)
+    print(f"Syncing Zoho documents into {store.path} ({'incremental' if incremental else 'full'})...")
+    summary = {
+        "salesorders": sync_salesorders(config, store, incremental, max_workers),
+        "salesreturns": sync_salesreturns(config, store, max_workers),
+    }
+    if include_stock:
+        summary["item_serialnumbers"] = sync_stock(config, store, max_workers)
+    store.set_meta('synced_at', datetime.now().isoformat())
+    for doc_type, counts in summary.items():
+        print(f"  {doc_type}: {counts}")
+    print(f"Document store: {store.stats()}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bring the local Zoho document store up to date.")
+    parser.add_argument('--full', action='store_true',
+                        help='Compare every listed sales order, not just those modified since the last sync.')
+    parser.add_argument('--no-stock', action='store_true', help='Skip the item serial number lists.')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help='Maximum number of concurrent Zoho detail requests.')
+    parser.add_argument('--store-path', default=None,
+                        help=f'SQLite file of the document store (default: {zoho_store.DEFAULT_STORE_PATH}).')
+    args = parser.parse_args()
+    if args.store_path:
+        zoho_store.configure_store(args.store_path)
+    if args.max_workers > zoho_client.DEFAULT_POOL_SIZE:
+        # Keep one pooled connection per worker so requests don't queue on the pool.
+        zoho_client.configure_client(pool_size=args.max_workers)
+    try:
+        sync_documents(incremental=not args.full, include_stock=not args.no_stock, max_workers=args.max_workers)
+    except Exception as e:
+        print(f"Document sync failed: {e}", file=sys.stderr)
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
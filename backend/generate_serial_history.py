@@ -2,14 +2,55 @@ import os
 import json
 import requests
 import sys
+import tempfile
+import time
+import threading
 from datetime import datetime
 from collections import defaultdict
 from dateutil.relativedelta import relativedelta # For CSA calculations if needed later
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import zoho_auth
+import zoho_client
+import zoho_concurrency
+import zoho_fixtures
+import zoho_store
+import zoho_telemetry
+from STEP1 import map_concurrently
 
 # CONFIGURATION
 CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config_inventory.json')
 ZOHO_API_BASE_URL = "https://www.zohoapis.com/inventory/v1"
+# Concurrent requests per phase (item serials, sales orders, sales returns). The three
+# phases run at the same time and share the process-wide Zoho rate limiter.
+DEFAULT_MAX_WORKERS = int(os.environ.get('SERIAL_HISTORY_MAX_WORKERS', '8'))
+
+class FailedFetches:
+    """
+    Thread-safe tally of the documents and list pages a run could not fetch, so a
+    run with missing events is reported (and exits non-zero) instead of passing
+    for a complete history.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = []
+
+    def record(self, what, error):
+        with self._lock:
+            self._failures.append((what, str(error)))
+
+    def reset(self):
+        with self._lock:
+            self._failures = []
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._failures)
+
+
+failed_fetches = FailedFetches()
 
 def load_config():
     """Loads configuration from the JSON file."""
@@ -19,6 +60,18 @@ def load_config():
     with open(CONFIG_PATH, 'r') as f:
         return json.load(f)
 
+def use_replay_config():
+    """
+    Points CONFIG_PATH at a throwaway placeholder config. Replay answers token
+    refreshes with a dummy token, which must not overwrite the real credentials.
+    """
+    global CONFIG_PATH
+    config_path = os.path.join(tempfile.mkdtemp(prefix='zoho-replay-'), 'config_inventory.json')
+    with open(config_path, 'w') as f:
+        json.dump({"access_token": "replay-token", "refresh_token": "replay", "client_id": "replay",
+                   "client_secret": "replay", "organization_id": "replay"}, f)
+    CONFIG_PATH = config_path
+
 def get_headers(config):
     """Generates authorization headers."""
     return {
@@ -26,63 +79,67 @@ def get_headers(config):
         'X-com-zoho-organizationid': config['organization_id']
     }
 
-def refresh_access_token(config):
-    """Refreshes the Zoho OAuth access token."""
-    print("Refreshing access token...")
-    url = "https://accounts.zoho.com/oauth/v2/token"
-    data = {
-        'refresh_token': config['refresh_token'],
-        'client_id': config['client_id'],
-        'client_secret': config['client_secret'],
-        'grant_type': 'refresh_token'
-    }
+def refresh_access_token(config, stale_token=None):
+    """
+    Refreshes the Zoho OAuth access token in config (and the config file) unless
+    another worker already replaced stale_token. Returns None on failure.
+    """
+    if stale_token is None:
+        stale_token = config.get('access_token')
     try:
-        response = requests.post(url, data=data)
-        response.raise_for_status()
-        tokens = response.json()
-        if 'access_token' not in tokens:
-            print(f"Error: Failed to refresh token. Response: {tokens}", file=sys.stderr)
-            # Attempt to provide more specific error messages from Zoho
-            if "error" in tokens:
-                print(f"Zoho Error: {tokens['error']}", file=sys.stderr)
-            return None # Indicate failure
-        config['access_token'] = tokens['access_token']
-        with open(CONFIG_PATH, 'w') as f:
-            json.dump(config, f, indent=2)
-        print("Access token refreshed successfully.")
-        return config['access_token']
-    except requests.exceptions.RequestException as e:
+        return zoho_auth.get_token_manager(CONFIG_PATH).refresh(config, stale_token)
+    except (requests.exceptions.RequestException, zoho_auth.TokenRefreshError) as e:
         print(f"Error refreshing access token: {e}", file=sys.stderr)
-        if response is not None:
-            print(f"Response status: {response.status_code}", file=sys.stderr)
-            print(f"Response body: {response.text}", file=sys.stderr)
         return None # Indicate failure
 
-def zoho_get(url, config, raw_data_accumulator, params=None):
-    """Makes a GET request to the Zoho API, handling token refresh and storing raw response."""
+def zoho_get(url, config, raw_archive, params=None, max_retries=5, backoff_factor=2):
+    """
+    Makes a GET request to the Zoho API, handling token refresh and 429 rate limits.
+    The raw response is appended to raw_archive (a zoho_fixtures.FixtureRecorder), if
+    given. Raises once the retries are used up, so callers can count the failure.
+    """
+    access_token = config.get('access_token')
+    if zoho_auth.get_token_manager(CONFIG_PATH).needs_refresh(config):
+        access_token = refresh_access_token(config, access_token) or access_token
     headers = get_headers(config)
-    try:
-        response = requests.get(url, headers=headers, params=params or {})
-        if response.status_code == 401: # Unauthorized
-            print("Token expired or invalid, attempting to refresh...")
-            if not refresh_access_token(config):
-                 print("Failed to refresh token. Cannot proceed with API call.", file=sys.stderr)
-                 raise Exception("Zoho token refresh failed.") # Critical error
-            headers = get_headers(config) # Get updated headers
-            response = requests.get(url, headers=headers, params=params or {}) # Retry request
-
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx) other than 401
-        data = response.json()
-        raw_data_accumulator.append({"url": url, "params": params, "response": data, "timestamp": datetime.now().isoformat()})
-        return data
-    except requests.exceptions.RequestException as e:
-        print(f"Error during Zoho API GET request to {url}: {e}", file=sys.stderr)
-        if 'response' in locals() and response is not None:
-            print(f"Response status: {response.status_code}", file=sys.stderr)
-            print(f"Response body: {response.text}", file=sys.stderr)
-        # Depending on the error, you might want to re-raise or handle differently
-        # For now, re-raising to make it evident if something goes wrong during fetching
-        raise
+    retries = 0
+    while True:
+        started = time.monotonic()
+        response = None
+        try:
+            response = zoho_client.get_client().get(url, headers=headers, params=params or {})
+            if response.status_code == 401: # Unauthorized
+                print("Token expired or invalid, attempting to refresh...")
+                if not refresh_access_token(config, access_token):
+                     print("Failed to refresh token. Cannot proceed with API call.", file=sys.stderr)
+                     raise Exception("Zoho token refresh failed.") # Critical error
+                access_token = config.get('access_token')
+                headers = get_headers(config) # Get updated headers
+                zoho_telemetry.record_retry(zoho_client.endpoint_label(url), token_refresh=True)
+                response = zoho_client.get_client().get(url, headers=headers, params=params or {}) # Retry request
+
+            response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx) other than 401
+            data = response.json()
+            if raw_archive is not None:
+                raw_archive.record('GET', url, params, response.status_code, response.text, time.monotonic() - started)
+            return data
+        except requests.exceptions.RequestException as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status == 429 and retries < max_retries:
+                # Honour Zoho's Retry-After; fall back to exponential backoff without one
+                wait_time = zoho_concurrency.retry_after_seconds(e.response)
+                if wait_time is None:
+                    wait_time = backoff_factor ** retries
+                print(f"Rate limit hit (429) for {url}. Waiting {wait_time} seconds before retrying (attempt {retries+1}/{max_retries})...")
+                time.sleep(wait_time)
+                zoho_telemetry.record_retry(zoho_client.endpoint_label(url), throttle_wait=wait_time)
+                retries += 1
+                continue
+            print(f"Error during Zoho API GET request to {url}: {e}", file=sys.stderr)
+            if response is not None:
+                print(f"Response status: {response.status_code}", file=sys.stderr)
+                print(f"Response body: {response.text}", file=sys.stderr)
+            raise
 
 def parse_date_string(date_str, date_format='%Y-%m-%d'):
     """Safely parses a date string to a datetime object."""
@@ -102,7 +159,7 @@ def format_date_for_output(dt_obj):
 
 # --- Phase 1: Data Extraction and Event Generation ---
 
-def fetch_all_items(config, raw_data_accumulator):
+def fetch_all_items(config, raw_archive):
     """Fetches all inventory items from Zoho Inventory."""
     print("Fetching all items...")
     all_items_list = []
@@ -113,7 +170,7 @@ def fetch_all_items(config, raw_data_accumulator):
     while has_more_pages:
         params = {'page': page, 'per_page': 200} # Max per_page is 200
         try:
-            data = zoho_get(url, config, raw_data_accumulator, params)
+            data = zoho_get(url, config, raw_archive, params)
             items = data.get('items', [])
             all_items_list.extend(items)
             print(f"  Fetched page {page} of items, total items so far: {len(all_items_list)}")
@@ -121,6 +178,7 @@ def fetch_all_items(config, raw_data_accumulator):
             page += 1
         except Exception as e:
             print(f"  Error fetching page {page} of items: {e}")
+            failed_fetches.record(f"items page {page}", e)
             has_more_pages = False # Stop on error
 
     # Filter for inventory items
@@ -131,7 +189,44 @@ def fetch_all_items(config, raw_data_accumulator):
     print(f"Finished fetching items. Found {len(all_items_list)} total items, {len(inventory_items)} are inventory items.")
     return inventory_items
 
-def fetch_in_stock_serials_for_item(config, item_id, item_sku, item_name, raw_data_accumulator):
+def in_stock_events_for_item(item_id, item_sku, item_name, serial_numbers_data, event_date):
+    """Returns the 'InStock' events for an item's serial number records that are not transacted out."""
+    in_stock_events = []
+    for sn_data in serial_numbers_data:
+        # DEBUG: Print details for each serial number record from API
+        print(f"    DEBUG sn_data: {sn_data}")
+        is_transacted_out = sn_data.get('is_transacted_out', False)
+        print(f"    DEBUG is_transacted_out: {is_transacted_out}")
+
+        # Try 'serial_number_formatted' first, then fallback to 'serialnumber'
+        serial_to_use = sn_data.get('serial_number_formatted') or sn_data.get('serialnumber')
+        print(f"    DEBUG serial_to_use (from 'serial_number_formatted' or 'serialnumber'): {serial_to_use}")
+
+        if not is_transacted_out: # Corrected in-stock logic
+            if not serial_to_use:
+                print(f"    DEBUG: Skipped InStock event creation - serial_to_use is missing.")
+                continue
+
+            event = {
+                "event_type": "InStock",
+                "event_date": event_date,
+                "serial_number": serial_to_use, # Use the resolved serial number
+                "details": {
+                    "item_id": item_id,
+                    "item_sku": item_sku,
+                    "item_name": item_name,
+                    "status": sn_data.get('status'),
+                    "warehouse_name": sn_data.get('warehouse_name')
+                    # Add other relevant fields from sn_data if needed
+                }
+            }
+            in_stock_events.append(event)
+            print(f"    DEBUG: Created InStock event for SN: {serial_to_use}")
+        else:
+            print(f"    DEBUG: Skipped InStock event for SN: {serial_to_use} (is_transacted_out: {is_transacted_out})")
+    return in_stock_events
+
+def fetch_in_stock_serials_for_item(config, item_id, item_sku, item_name, raw_archive):
     """Fetches in-stock serial numbers for a given item_id."""
     print(f"  Fetching in-stock serials for item ID: {item_id} (SKU: {item_sku}, Name: {item_name})...") # DEBUG: Added item_name
     in_stock_events = []
@@ -143,238 +238,289 @@ def fetch_in_stock_serials_for_item(config, item_id, item_sku, item_name, raw_da
     while has_more_pages:
         params = {'item_id': item_id, 'page': page, 'per_page': 200} # Fetch all serials for the item
         try:
-            data = zoho_get(url, config, raw_data_accumulator, params)
+            data = zoho_get(url, config, raw_archive, params)
             serial_numbers_data = data.get('serial_numbers', [])
-
-            for sn_data in serial_numbers_data:
-                # DEBUG: Print details for each serial number record from API
-                print(f"    DEBUG sn_data: {sn_data}")
-                is_transacted_out = sn_data.get('is_transacted_out', False)
-                print(f"    DEBUG is_transacted_out: {is_transacted_out}")
-                
-                # Try 'serial_number_formatted' first, then fallback to 'serialnumber'
-                serial_to_use = sn_data.get('serial_number_formatted') or sn_data.get('serialnumber')
-                print(f"    DEBUG serial_to_use (from 'serial_number_formatted' or 'serialnumber'): {serial_to_use}")
-
-                if not is_transacted_out: # Corrected in-stock logic
-                    if not serial_to_use:
-                        print(f"    DEBUG: Skipped InStock event creation - serial_to_use is missing.")
-                        continue
-
-                    event = {
-                        "event_type": "InStock",
-                        "event_date": script_execution_date, # Using script execution date as planned
-                        "serial_number": serial_to_use, # Use the resolved serial number
-                        "details": {
-                            "item_id": item_id,
-                            "item_sku": item_sku,
-                            "item_name": item_name,
-                            "status": sn_data.get('status'),
-                            "warehouse_name": sn_data.get('warehouse_name')
-                            # Add other relevant fields from sn_data if needed
-                        }
-                    }
-                    in_stock_events.append(event)
-                    print(f"    DEBUG: Created InStock event for SN: {serial_to_use}")
-                else:
-                    print(f"    DEBUG: Skipped InStock event for SN: {serial_to_use} (is_transacted_out: {is_transacted_out})")
+            # Using script execution date as planned
+            in_stock_events.extend(
+                in_stock_events_for_item(item_id, item_sku, item_name, serial_numbers_data, script_execution_date)
+            )
 
             print(f"    Fetched page {page} of serials for item {item_id}. Found {len(serial_numbers_data)} serials on page, {len(in_stock_events)} in-stock events so far for this item.")
             has_more_pages = data.get('page_context', {}).get('has_more_page', False)
             page += 1
         except Exception as e:
             print(f"    Error fetching page {page} of serial numbers for item ID {item_id}: {e}")
+            failed_fetches.record(f"serial numbers page {page} of item {item_id}", e)
             has_more_pages = False # Stop for this item on error
     return in_stock_events
 
-def fetch_all_sales_orders_detailed(config, raw_data_accumulator):
-    """Fetches all sales orders and their details, generating 'Sale' events."""
-    print("Fetching all sales orders...")
-    sale_events = []
+def fetch_in_stock_serials(config, tracked_items, raw_archive, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Fetches in-stock serial events for every tracked item. Each item's serial pages
+    are walked in order, with up to max_workers items in progress at once.
+    """
+    items = [item for item in tracked_items if item.get('item_id')]
+    in_stock_serial_events = []
+    for events in map_concurrently(
+        lambda item: fetch_in_stock_serials_for_item(
+            config, item.get('item_id'), item.get('sku'), item.get('name'), raw_archive
+        ),
+        items,
+        max_workers
+    ):
+        in_stock_serial_events.extend(events)
+    return in_stock_serial_events
+
+def fetch_all_summaries(config, url, list_key, label, raw_archive):
+    """Pages through a Zoho list endpoint and returns every row under list_key."""
+    summaries = []
     page = 1
     has_more_pages = True
-    url_so_list = f"{ZOHO_API_BASE_URL}/salesorders"
 
     while has_more_pages:
         params_list = {'page': page, 'per_page': 200}
         try:
-            so_list_data = zoho_get(url_so_list, config, raw_data_accumulator, params_list)
-            sales_orders_summary = so_list_data.get('salesorders', [])
-            print(f"  Fetched page {page} of SO summaries, {len(sales_orders_summary)} orders on this page.")
-
-            for so_summary in sales_orders_summary:
-                so_id = so_summary.get('salesorder_id')
-                if not so_id:
-                    continue
-                
-                print(f"    Processing SO ID: {so_id} (Number: {so_summary.get('salesorder_number')})")
-                try:
-                    so_detail_data = zoho_get(f"{ZOHO_API_BASE_URL}/salesorders/{so_id}", config, raw_data_accumulator)
-                    so_detail = so_detail_data.get('salesorder')
-                    if not so_detail:
-                        print(f"      Warning: Could not fetch details for SO ID: {so_id}")
-                        continue
-
-                    so_number = so_detail.get('salesorder_number')
-                    so_date_obj = parse_date_string(so_detail.get('date'))
-                    # Use shipment date as primary event date if available, else SO date
-                    event_date_obj = parse_date_string(so_detail.get('shipment_date')) or so_date_obj
-                    
-                    customer_id = so_detail.get('customer_id')
-                    customer_name = so_detail.get('customer_name')
-
-                    # Simplified CSA check (can be expanded later if needed from process_all_sales_serial_numbers.py)
-                    # For now, we focus on serials from packages. CSA details can be added to sale event if required.
-
-                    for package_summary in so_detail.get('packages', []):
-                        package_id = package_summary.get('package_id')
-                        if not package_id:
-                            continue
-                        
-                        # print(f"      Fetching package details for Package ID: {package_id}")
-                        pkg_detail_data = zoho_get(f"{ZOHO_API_BASE_URL}/packages/{package_id}", config, raw_data_accumulator)
-                        pkg_detail = pkg_detail_data.get('package')
-                        if not pkg_detail:
-                            print(f"        Warning: Could not fetch details for Package ID: {package_id}")
-                            continue
-                        
-                        package_number = pkg_detail.get('package_number')
-                        pkg_shipment_date_obj = parse_date_string(pkg_detail.get('shipment_date'))
-                        pkg_delivery_date_obj = parse_date_string(pkg_detail.get('shipment_order', {}).get('delivery_date'))
-
-                        for line_item in pkg_detail.get('line_items', []):
-                            item_sku = line_item.get('sku')
-                            item_name = line_item.get('name')
-                            # product_type = get_product_type(item_name) # Placeholder if needed
-
-                            serials = line_item.get('serial_numbers', [])
-                            # Fallback for serials in inventory_detail (from process_all_sales_serial_numbers.py)
-                            if not serials:
-                                inventory_detail = line_item.get('inventory_detail', {})
-                                if isinstance(inventory_detail, list) and inventory_detail:
-                                     inventory_detail = inventory_detail[0]
-                                if isinstance(inventory_detail, dict):
-                                    serials = inventory_detail.get('serial_numbers', [])
-
-                            for serial_number in serials:
-                                if not serial_number: continue
-                                sale_event = {
-                                    "event_type": "Sale",
-                                    "event_date": format_date_for_output(pkg_shipment_date_obj or event_date_obj), # Prioritize package shipment date
-                                    "serial_number": serial_number,
-                                    "details": {
-                                        "sales_order_id": so_id,
-                                        "sales_order_number": so_number,
-                                        "sales_order_date": format_date_for_output(so_date_obj),
-                                        "customer_id": customer_id,
-                                        "customer_name": customer_name,
-                                        "item_sku": item_sku,
-                                        "item_name": item_name,
-                                        # "product_type": product_type,
-                                        "package_id": package_id,
-                                        "package_number": package_number,
-                                        "shipment_date": format_date_for_output(pkg_shipment_date_obj or parse_date_string(so_detail.get('shipment_date'))),
-                                        "delivery_date": format_date_for_output(pkg_delivery_date_obj),
-                                        # Add CSA details here if parsed
-                                    }
-                                }
-                                sale_events.append(sale_event)
-                                # print(f"          Added Sale event for SN: {serial_number}")
-                except Exception as e_so_detail:
-                    print(f"      Error processing detail for SO ID {so_id}: {e_so_detail}")
-            
-            has_more_pages = so_list_data.get('page_context', {}).get('has_more_page', False)
+            list_data = zoho_get(url, config, raw_archive, params_list)
+            page_summaries = list_data.get(list_key, [])
+            summaries.extend(page_summaries)
+            print(f"  Fetched page {page} of {label} summaries, {len(page_summaries)} on this page.")
+
+            has_more_pages = list_data.get('page_context', {}).get('has_more_page', False)
             page += 1
-            if not sales_orders_summary and page > 1 and not has_more_pages : # Break if empty page and no more pages
-                 print("  No more sales orders found in subsequent pages.")
+            if not page_summaries and page > 1 and not has_more_pages: # Break if empty page and no more pages
+                 print(f"  No more {label} summaries found in subsequent pages.")
                  break
-        except Exception as e_so_list:
-            print(f"  Error fetching page {page} of sales order summaries: {e_so_list}")
+        except Exception as e_list:
+            print(f"  Error fetching page {page} of {label} summaries: {e_list}")
+            failed_fetches.record(f"{label} summaries page {page}", e_list)
             has_more_pages = False # Stop on error
+    return summaries
+
+def sale_events_for_salesorder(config, so_summary, raw_archive):
+    """Fetches one sales order and its packages and returns its 'Sale' events."""
+    so_id = so_summary.get('salesorder_id')
+    print(f"    Processing SO ID: {so_id} (Number: {so_summary.get('salesorder_number')})")
+    try:
+        so_detail_data = zoho_get(f"{ZOHO_API_BASE_URL}/salesorders/{so_id}", config, raw_archive)
+        so_detail = so_detail_data.get('salesorder')
+        if not so_detail:
+            print(f"      Warning: Could not fetch details for SO ID: {so_id}")
+            failed_fetches.record(f"SO {so_id}", "no salesorder in response")
+            return []
+        return sale_events_from_documents(
+            so_id, so_detail,
+            lambda package_id: zoho_get(f"{ZOHO_API_BASE_URL}/packages/{package_id}", config, raw_archive).get('package')
+        )
+    except Exception as e_so_detail:
+        print(f"      Error processing detail for SO ID {so_id}: {e_so_detail}")
+        failed_fetches.record(f"SO {so_id}", e_so_detail)
+        return []
+
+def sale_events_from_documents(so_id, so_detail, get_package):
+    """
+    Returns the 'Sale' events of a sales order detail. get_package(package_id)
+    returns the package's detail (from Zoho or the document store), or None.
+    """
+    sale_events = []
+    so_number = so_detail.get('salesorder_number')
+    so_date_obj = parse_date_string(so_detail.get('date'))
+    # Use shipment date as primary event date if available, else SO date
+    event_date_obj = parse_date_string(so_detail.get('shipment_date')) or so_date_obj
     
+    customer_id = so_detail.get('customer_id')
+    customer_name = so_detail.get('customer_name')
+
+    # Simplified CSA check (can be expanded later if needed from process_all_sales_serial_numbers.py)
+    # For now, we focus on serials from packages. CSA details can be added to sale event if required.
+
+    for package_summary in so_detail.get('packages', []):
+        package_id = package_summary.get('package_id')
+        if not package_id:
+            continue
+        
+        # print(f"      Fetching package details for Package ID: {package_id}")
+        pkg_detail = get_package(package_id)
+        if not pkg_detail:
+            print(f"        Warning: Could not fetch details for Package ID: {package_id}")
+            continue
+        
+        package_number = pkg_detail.get('package_number')
+        pkg_shipment_date_obj = parse_date_string(pkg_detail.get('shipment_date'))
+        pkg_delivery_date_obj = parse_date_string(pkg_detail.get('shipment_order', {}).get('delivery_date'))
+
+        for line_item in pkg_detail.get('line_items', []):
+            item_sku = line_item.get('sku')
+            item_name = line_item.get('name')
+            # product_type = get_product_type(item_name) # Placeholder if needed
+
+            serials = line_item.get('serial_numbers', [])
+            # Fallback for serials in inventory_detail (from process_all_sales_serial_numbers.py)
+            if not serials:
+                inventory_detail = line_item.get('inventory_detail', {})
+                if isinstance(inventory_detail, list) and inventory_detail:
+                     inventory_detail = inventory_detail[0]
+                if isinstance(inventory_detail, dict):
+                    serials = inventory_detail.get('serial_numbers', [])
+
+            for serial_number in serials:
+                if not serial_number: continue
+                sale_event = {
+                    "event_type": "Sale",
+                    "event_date": format_date_for_output(pkg_shipment_date_obj or event_date_obj), # Prioritize package shipment date
+                    "serial_number": serial_number,
+                    "details": {
+                        "sales_order_id": so_id,
+                        "sales_order_number": so_number,
+                        "sales_order_date": format_date_for_output(so_date_obj),
+                        "customer_id": customer_id,
+                        "customer_name": customer_name,
+                        "item_sku": item_sku,
+                        "item_name": item_name,
+                        # "product_type": product_type,
+                        "package_id": package_id,
+                        "package_number": package_number,
+                        "shipment_date": format_date_for_output(pkg_shipment_date_obj or parse_date_string(so_detail.get('shipment_date'))),
+                        "delivery_date": format_date_for_output(pkg_delivery_date_obj),
+                        # Add CSA details here if parsed
+                    }
+                }
+                sale_events.append(sale_event)
+                # print(f"          Added Sale event for SN: {serial_number}")
+    return sale_events
+
+def fetch_all_sales_orders_detailed(config, raw_archive, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Fetches all sales orders and their details, generating 'Sale' events.
+    Order details are fetched by up to max_workers threads; events keep list order.
+    """
+    print("Fetching all sales orders...")
+    url_so_list = f"{ZOHO_API_BASE_URL}/salesorders"
+    sales_orders_summary = [
+        so_summary for so_summary in fetch_all_summaries(config, url_so_list, 'salesorders', 'SO', raw_archive)
+        if so_summary.get('salesorder_id')
+    ]
+
+    sale_events = []
+    for events in map_concurrently(
+        lambda so_summary: sale_events_for_salesorder(config, so_summary, raw_archive),
+        sales_orders_summary,
+        max_workers
+    ):
+        sale_events.extend(events)
+
     print(f"Finished fetching sales orders. Generated {len(sale_events)} sale events.")
     return sale_events
 
-def fetch_all_sales_returns_detailed(config, raw_data_accumulator):
-    """Fetches all sales returns and their details, generating 'Return' events."""
-    print("Fetching all sales returns...")
+def return_events_for_salesreturn(config, sr_summary, raw_archive):
+    """Fetches one sales return and returns its 'Return' events."""
+    sr_id = sr_summary.get('salesreturn_id')
+    print(f"    Processing SR ID: {sr_id} (Number: {sr_summary.get('salesreturn_number')})")
+    try:
+        sr_detail_data = zoho_get(f"{ZOHO_API_BASE_URL}/salesreturns/{sr_id}", config, raw_archive)
+        sr_detail = sr_detail_data.get('salesreturn')
+        if not sr_detail:
+            print(f"      Warning: Could not fetch details for SR ID: {sr_id}")
+            failed_fetches.record(f"SR {sr_id}", "no salesreturn in response")
+            return []
+        return return_events_from_salesreturn(sr_id, sr_detail)
+    except Exception as e_sr_detail:
+        print(f"      Error processing detail for SR ID {sr_id}: {e_sr_detail}")
+        failed_fetches.record(f"SR {sr_id}", e_sr_detail)
+        return []
+
+def return_events_from_salesreturn(sr_id, sr_detail):
+    """Returns the 'Return' events of a sales return detail."""
     return_events = []
-    page = 1
-    has_more_pages = True
-    url_sr_list = f"{ZOHO_API_BASE_URL}/salesreturns"
+    rma_number = sr_detail.get('salesreturn_number')
+    customer_id = sr_detail.get('customer_id')
+    customer_name = sr_detail.get('customer_name')
+    # Original SO ID if linked on the return
+    linked_sales_order_id = sr_detail.get('salesorder_id') 
+    linked_sales_order_number = sr_detail.get('salesorder_number')
+
+    for receive_info in sr_detail.get('salesreturnreceives', []):
+        # specific_receive_id_attempt = receive_info.get('receive_id') # Old debug logic, now integrated below
+        receive_date_obj = parse_date_string(receive_info.get('date'))
+        receive_number = receive_info.get('receive_number')
+
+        for line_item in receive_info.get('line_items', []):
+            item_sku = line_item.get('sku')
+            item_name = line_item.get('name')
+            
+            serials = line_item.get('serial_numbers', [])
+            for serial_number in serials:
+                if not serial_number: continue
+                return_event = {
+                    "event_type": "Return",
+                    "event_date": format_date_for_output(receive_date_obj),
+                    "serial_number": serial_number,
+                    "details": {
+                        "sales_return_id": receive_info.get('receive_id') or sr_id, # Use specific 'receive_id' or fallback
+                        "rma_number": rma_number,
+                        "receive_number": receive_number,
+                        "customer_id": customer_id,
+                        "customer_name": customer_name,
+                        "item_sku": item_sku,
+                        "item_name": item_name,
+                        "linked_sales_order_id": linked_sales_order_id,
+                        "linked_sales_order_number": linked_sales_order_number,
+                    }
+                }
+                return_events.append(return_event)
+                # print(f"          Added Return event for SN: {serial_number}")
+    return return_events
 
-    while has_more_pages:
-        params_list = {'page': page, 'per_page': 200}
-        try:
-            sr_list_data = zoho_get(url_sr_list, config, raw_data_accumulator, params_list)
-            sales_returns_summary = sr_list_data.get('salesreturns', [])
-            print(f"  Fetched page {page} of SR summaries, {len(sales_returns_summary)} returns on this page.")
+def fetch_all_sales_returns_detailed(config, raw_archive, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Fetches all sales returns and their details, generating 'Return' events.
+    Return details are fetched by up to max_workers threads; events keep list order.
+    """
+    print("Fetching all sales returns...")
+    url_sr_list = f"{ZOHO_API_BASE_URL}/salesreturns"
+    sales_returns_summary = [
+        sr_summary for sr_summary in fetch_all_summaries(config, url_sr_list, 'salesreturns', 'SR', raw_archive)
+        if sr_summary.get('salesreturn_id')
+    ]
 
-            for sr_summary in sales_returns_summary:
-                sr_id = sr_summary.get('salesreturn_id')
-                if not sr_id:
-                    continue
+    return_events = []
+    for events in map_concurrently(
+        lambda sr_summary: return_events_for_salesreturn(config, sr_summary, raw_archive),
+        sales_returns_summary,
+        max_workers
+    ):
+        return_events.extend(events)
 
-                print(f"    Processing SR ID: {sr_id} (Number: {sr_summary.get('salesreturn_number')})")
-                try:
-                    sr_detail_data = zoho_get(f"{ZOHO_API_BASE_URL}/salesreturns/{sr_id}", config, raw_data_accumulator)
-                    sr_detail = sr_detail_data.get('salesreturn')
-                    if not sr_detail:
-                        print(f"      Warning: Could not fetch details for SR ID: {sr_id}")
-                        continue
-                    
-                    rma_number = sr_detail.get('salesreturn_number')
-                    customer_id = sr_detail.get('customer_id')
-                    customer_name = sr_detail.get('customer_name')
-                    # Original SO ID if linked on the return
-                    linked_sales_order_id = sr_detail.get('salesorder_id') 
-                    linked_sales_order_number = sr_detail.get('salesorder_number')
-
-                    for receive_info in sr_detail.get('salesreturnreceives', []):
-                        # specific_receive_id_attempt = receive_info.get('receive_id') # Old debug logic, now integrated below
-                        receive_date_obj = parse_date_string(receive_info.get('date'))
-                        receive_number = receive_info.get('receive_number')
-
-                        for line_item in receive_info.get('line_items', []):
-                            item_sku = line_item.get('sku')
-                            item_name = line_item.get('name')
-                            
-                            serials = line_item.get('serial_numbers', [])
-                            for serial_number in serials:
-                                if not serial_number: continue
-                                return_event = {
-                                    "event_type": "Return",
-                                    "event_date": format_date_for_output(receive_date_obj),
-                                    "serial_number": serial_number,
-                                    "details": {
-                                        "sales_return_id": receive_info.get('receive_id') or sr_id, # Use specific 'receive_id' or fallback
-                                        "rma_number": rma_number,
-                                        "receive_number": receive_number,
-                                        "customer_id": customer_id,
-                                        "customer_name": customer_name,
-                                        "item_sku": item_sku,
-                                        "item_name": item_name,
-                                        "linked_sales_order_id": linked_sales_order_id,
-                                        "linked_sales_order_number": linked_sales_order_number,
-                                    }
-                                }
-                                return_events.append(return_event)
-                                # print(f"          Added Return event for SN: {serial_number}")
-                except Exception as e_sr_detail:
-                    print(f"      Error processing detail for SR ID {sr_id}: {e_sr_detail}")
-
-            has_more_pages = sr_list_data.get('page_context', {}).get('has_more_page', False)
-            page += 1
-            if not sales_returns_summary and page > 1 and not has_more_pages:
-                 print("  No more sales returns found in subsequent pages.")
-                 break
-        except Exception as e_sr_list:
-            print(f"  Error fetching page {page} of sales return summaries: {e_sr_list}")
-            has_more_pages = False # Stop on error
-            
     print(f"Finished fetching sales returns. Generated {len(return_events)} return events.")
     return return_events
 
+def events_from_store(store):
+    """
+    Returns the (InStock, Sale, Return) event lists built from the document store
+    (kept current by document_sync) instead of Zoho. InStock events are dated by
+    the store's last stock sync.
+    """
+    stock_synced_at = store.get_meta('stock_synced_at')
+    stock_date = stock_synced_at[:10] if stock_synced_at else datetime.now().strftime('%Y-%m-%d')
+    in_stock_events = []
+    for item_id, _, document in store.iter_documents('item_serialnumbers'):
+        item = document.get('item', {})
+        in_stock_events.extend(in_stock_events_for_item(
+            item_id, item.get('sku'), item.get('name'), document.get('serial_numbers', []), stock_date
+        ))
+    sale_events = []
+    for so_id, _, so_detail in store.iter_documents('salesorders'):
+        sale_events.extend(sale_events_from_documents(so_id, so_detail, lambda package_id: store.get('packages', package_id)))
+    return_events = []
+    for sr_id, _, sr_detail in store.iter_documents('salesreturns'):
+        return_events.extend(return_events_from_salesreturn(sr_id, sr_detail))
+    return in_stock_events, sale_events, return_events
+
+def build_serial_history_from_store(store=None):
+    """Builds the serial number history from the document store without calling Zoho."""
+    store = store or zoho_store.get_store()
+    print(f"Building serial number history from the document store ({store.path})...")
+    return aggregate_and_sort_events(events_from_store(store))
+
 # --- Phase 2: Data Aggregation and Structuring ---
 def aggregate_and_sort_events(all_events_lists):
     """Aggregates all events by serial number and sorts them chronologically."""
@@ -427,22 +573,51 @@ def main():
     parser = argparse.ArgumentParser(description="Generate a chronological history for all serial numbers from Zoho Inventory.")
     parser.add_argument('--output-json', default='Programs/serial_number_history.json',
                         help='Path to save the aggregated JSON data (default: Programs/serial_number_history.json).')
-    parser.add_argument('--raw-output-json', default='Programs/zoho_raw_output.json',
-                        help='Path to save all raw JSON responses from Zoho API (default: Programs/zoho_raw_output.json).')
+    parser.add_argument('--raw-output', '--raw-output-json', dest='raw_output', default='Programs/zoho_raw_output.jsonl.gz',
+                        help='Path of the gzip JSON-lines archive of raw Zoho API responses, streamed as they arrive '
+                             '(default: Programs/zoho_raw_output.jsonl.gz).')
+    parser.add_argument('--replay-raw', default=None,
+                        help='Rebuild the history from a raw response archive of an earlier run instead of calling Zoho.')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help='Maximum concurrent Zoho requests per phase (item serials, sales orders, sales returns).')
+    parser.add_argument('--from-store', action='store_true',
+                        help='Build the history from the local document store (see document_sync.py) instead of calling Zoho.')
     args = parser.parse_args()
+    max_workers = args.max_workers
+    if args.replay_raw:
+        # Serve every GET from the earlier run's archive (no latency, no network)
+        zoho_fixtures.configure('replay', args.replay_raw, latency_ms=0)
+        use_replay_config()
+    if args.replay_raw or 3 * max_workers > zoho_client.DEFAULT_POOL_SIZE:
+        # A fresh client picks up the replay transport; keep one pooled connection
+        # per worker across the three concurrent phases.
+        zoho_client.configure_client(pool_size=max(3 * max_workers, zoho_client.DEFAULT_POOL_SIZE))
+    zoho_client.get_client().concurrency_limiter.start_at(3 * max_workers)
 
     output_json_path = args.output_json
     if not os.path.isabs(output_json_path):
         output_json_path = os.path.join(os.getcwd(), output_json_path)
 
-    raw_output_json_path = args.raw_output_json
-    if not os.path.isabs(raw_output_json_path):
-        raw_output_json_path = os.path.join(os.getcwd(), raw_output_json_path)
+    if args.from_store:
+        save_to_json(build_serial_history_from_store(), output_json_path)
+        print("\nSerial Number History Generation Completed Successfully.")
+        return
+
+    raw_output_path = args.raw_output
+    if not os.path.isabs(raw_output_path):
+        raw_output_path = os.path.join(os.getcwd(), raw_output_path)
     
     print(f"Serial Number History Generation Started. Output will be: {output_json_path}")
-    print(f"Raw Zoho API output will be saved to: {raw_output_json_path}")
+    print(f"Raw Zoho API output will be saved to: {raw_output_path}")
+    if args.replay_raw and os.path.abspath(args.replay_raw) == raw_output_path:
+        print("Error: --raw-output must differ from --replay-raw.", file=sys.stderr)
+        sys.exit(1)
 
-    raw_zoho_data_accumulator = [] # Initialize accumulator for raw data
+    raw_output_dir = os.path.dirname(raw_output_path)
+    if raw_output_dir:
+        os.makedirs(raw_output_dir, exist_ok=True)
+    # Raw responses are streamed to this archive as they arrive; it can later be passed to --replay-raw
+    raw_archive = zoho_fixtures.FixtureRecorder(raw_output_path, append=False)
 
     try:
         config = load_config()
@@ -452,30 +627,27 @@ def main():
                 sys.exit(1)
         
         all_events_master_list = []
+        failed_fetches.reset()
+
+        def in_stock_phase():
+            tracked_items = fetch_all_items(config, raw_archive)
+            return fetch_in_stock_serials(config, tracked_items, raw_archive, max_workers)
+
+        # 1-3. Fetch In-Stock Serial, Sale and Return events. The three walks are independent,
+        # so they run concurrently; the shared rate limiter keeps the total within Zoho's quota.
+        print("\n--- Fetching In-Stock Serial, Sale and Return Events ---")
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            in_stock_future = executor.submit(in_stock_phase)
+            sale_future = executor.submit(fetch_all_sales_orders_detailed, config, raw_archive, max_workers)
+            return_future = executor.submit(fetch_all_sales_returns_detailed, config, raw_archive, max_workers)
+            in_stock_serial_events = in_stock_future.result()
+            sale_events = sale_future.result()
+            return_events = return_future.result()
 
-        # 1. Fetch In-Stock Serials
-        print("\n--- Fetching In-Stock Serial Events ---")
-        tracked_items = fetch_all_items(config, raw_zoho_data_accumulator)
-        in_stock_serial_events = []
-        for item in tracked_items:
-            item_id = item.get('item_id')
-            item_sku = item.get('sku')
-            item_name = item.get('name')
-            if item_id:
-                in_stock_events_for_item = fetch_in_stock_serials_for_item(config, item_id, item_sku, item_name, raw_zoho_data_accumulator)
-                in_stock_serial_events.extend(in_stock_events_for_item)
         all_events_master_list.append(in_stock_serial_events)
         print(f"Total InStock events generated: {len(in_stock_serial_events)}")
-
-        # 2. Fetch Sales Events
-        print("\n--- Fetching Sales Events ---")
-        sale_events = fetch_all_sales_orders_detailed(config, raw_zoho_data_accumulator)
         all_events_master_list.append(sale_events)
         print(f"Total Sale events generated: {len(sale_events)}")
-
-        # 3. Fetch Return Events
-        print("\n--- Fetching Return Events ---")
-        return_events = fetch_all_sales_returns_detailed(config, raw_zoho_data_accumulator)
         all_events_master_list.append(return_events)
         print(f"Total Return events generated: {len(return_events)}")
 
@@ -486,10 +658,18 @@ def main():
         # 5. Save to JSON
         save_to_json(final_serial_history, output_json_path)
         
-        # 6. Save Raw Zoho Data
-        print(f"\n--- Saving Raw Zoho API Responses to {raw_output_json_path} ---")
-        save_to_json(raw_zoho_data_accumulator, raw_output_json_path)
-
+        # 6. Finish the raw Zoho response archive
+        raw_archive.close()
+        print(f"\n--- Saved {raw_archive.recorded} Raw Zoho API Responses to {raw_output_path} ---")
+
+        failures = failed_fetches.snapshot()
+        if failures:
+            print(f"\nWARNING: {len(failures)} Zoho document(s) or page(s) could not be fetched; "
+                  f"the history in {output_json_path} is missing their events:", file=sys.stderr)
+            for what, error in failures:
+                print(f"  {what}: {error}", file=sys.stderr)
+            print("Serial Number History Generation Completed With Errors.", file=sys.stderr)
+            sys.exit(1)
 
         print("\nSerial Number History Generation Completed Successfully.")
 
@@ -498,6 +678,8 @@ def main():
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        raw_archive.close() # Also keeps what was fetched before a failure
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import re
 import json
@@ -9,7 +10,11 @@ import shutil # Added for file copying
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import STEP1
+import STEP1_async
 import STEP2
+import document_sync
+import step1_output
+import zoho_telemetry
 
 # Define Clinic Groupings (as per clinic_processing_plan.md)
 CLINIC_GROUPS = {
@@ -79,6 +84,23 @@ CLINIC_GROUPS = {
 # Base directory for all output
 BASE_OUTPUT_DIR = "clinic_output"
 
+# Page the organization-wide sales order and sales return lists once per sync and
+# partition them by contact, instead of listing each contact's documents separately.
+BATCH_LIST_FETCH = os.environ.get('CLINIC_SYNC_BATCH_LISTS', '1').lower() not in ('0', 'false', 'no')
+# Format of each group's Step 1 file: 'json' (one object) or 'ndjson' (streamed one
+# document per line, so a sync's memory use does not grow with clinic history).
+STEP1_OUTPUT_FORMAT = os.environ.get('STEP1_OUTPUT_FORMAT', 'json').lower()
+# Zoho call telemetry of the latest sync (see zoho_telemetry), written to BASE_OUTPUT_DIR.
+SYNC_TELEMETRY_FILENAME = "zoho_sync_telemetry.json"
+# Telemetry group of the organization-wide list scan shared by all clinic groups.
+BATCHED_LISTS_GROUP = "batched_lists"
+# Where the groups' Step 1 files come from: 'zoho' (each group's STEP1 run calls Zoho)
+# or 'store' (one document_sync run updates the local document store, then every
+# group's Step 1 file is written from it without further Zoho calls).
+CLINIC_SYNC_SOURCE = os.environ.get('CLINIC_SYNC_SOURCE', 'zoho').lower()
+# Telemetry group of that document_sync run.
+DOCUMENT_SYNC_GROUP = "document_sync"
+
 def sanitize_filename(name):
     """Removes invalid characters and replaces spaces for filenames."""
     name = name.lower()
@@ -86,6 +108,11 @@ def sanitize_filename(name):
     name = re.sub(r'[^\w\-]+', '', name) # Remove non-alphanumeric characters (except underscore and hyphen)
     return name
 
+def step1_output_path(clinic_output_dir, sanitized_name):
+    """Returns the group's Step 1 output path for STEP1_OUTPUT_FORMAT."""
+    extension = step1_output.NDJSON_SUFFIX if STEP1_OUTPUT_FORMAT == 'ndjson' else '.json'
+    return os.path.join(clinic_output_dir, f"{sanitized_name}_step1_data{extension}")
+
 def load_data_from_disk():
     """Attempts to load aggregated clinic data from existing _step2_analysis.json files."""
     print("Attempting to load aggregated clinic data from disk...")
@@ -95,7 +122,7 @@ def load_data_from_disk():
     for clinic_name in CLINIC_GROUPS.keys():
         sanitized_name = sanitize_filename(clinic_name)
         clinic_output_dir = os.path.join(BASE_OUTPUT_DIR, sanitized_name)
-        step1_json_path = os.path.join(clinic_output_dir, f"{sanitized_name}_step1_data.json")
+        step1_json_path = step1_output_path(clinic_output_dir, sanitized_name)
         step2_json_path = os.path.join(clinic_output_dir, f"{sanitized_name}_step2_analysis.json")
 
         clinic_data_loaded_for_group = False
@@ -108,8 +135,7 @@ def load_data_from_disk():
                 step1_data = None
                 if os.path.exists(step1_json_path):
                     try:
-                        with open(step1_json_path, 'r') as f1:
-                            step1_data = json.load(f1)
+                        step1_data = step1_output.load_step1_output(step1_json_path)
                     except Exception as e:
                         print(f"WARNING: Could not load Step 1 data for {clinic_name}: {e}", file=sys.stderr)
                 
@@ -142,8 +168,7 @@ def load_data_from_disk():
                         step1_data = None
                         if os.path.exists(step1_json_path):
                             try:
-                                with open(step1_json_path, 'r') as f1:
-                                    step1_data = json.load(f1)
+                                step1_data = step1_output.load_step1_output(step1_json_path)
                             except Exception as e:
                                 print(f"WARNING: Could not load Step 1 data for {clinic_name}: {e}", file=sys.stderr)
                         
@@ -180,13 +205,80 @@ def load_data_from_disk():
         print(f"Successfully loaded partial clinic data from disk: {list(all_clinics_csa_data.keys())}")
     return all_clinics_csa_data
 
-def get_aggregated_clinic_data():
+def all_clinic_contact_ids():
+    """Returns every contact id across CLINIC_GROUPS."""
+    return [contact_id for contact_ids in CLINIC_GROUPS.values() for contact_id in contact_ids]
+
+def batched_list_watermark():
+    """
+    Returns the oldest sales order watermark recorded for any clinic contact, so one
+    batched scan covers every contact's changes. Returns None (scan the full list)
+    if any contact has no saved sync_state yet.
+    """
+    watermarks = []
+    for clinic_name, contact_ids in CLINIC_GROUPS.items():
+        sanitized_name = sanitize_filename(clinic_name)
+        step1_json_path = step1_output_path(os.path.join(BASE_OUTPUT_DIR, sanitized_name), sanitized_name)
+        previous_output = STEP1.load_previous_step1_output(step1_json_path)
+        contacts_state = previous_output['sync_state'].get('contacts', {}) if previous_output else {}
+        for contact_id in contact_ids:
+            if contact_id not in contacts_state:
+                return None
+            watermark = contacts_state[contact_id].get('salesorders_watermark')
+            watermark_dt = STEP1.parse_zoho_timestamp(watermark)
+            if watermark_dt: # Contacts without any orders have no watermark; any new order is newer than the others'
+                watermarks.append((watermark_dt, watermark))
+    return min(watermarks)[1] if watermarks else None
+
+def fetch_batched_lists_for_groups(incremental):
+    """Runs one organization-wide list scan for all groups. Returns None if it fails."""
+    try:
+        watermark = batched_list_watermark() if incremental else None
+        with zoho_telemetry.clinic_group(BATCHED_LISTS_GROUP):
+            return STEP1.fetch_batched_lists(STEP1.load_config(), all_clinic_contact_ids(), watermark)
+    except Exception as e:
+        print(f"WARNING: Batched list fetch failed ({e}); falling back to per-contact list calls.", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        return None
+
+def sync_document_store(incremental):
+    """
+    Updates the document store once for all groups (without item serial numbers,
+    which STEP2 does not use). On failure the groups are written from what the
+    store already holds.
+    """
+    try:
+        with zoho_telemetry.clinic_group(DOCUMENT_SYNC_GROUP):
+            document_sync.sync_documents(incremental=incremental, include_stock=False)
+    except Exception as e:
+        print(f"WARNING: Document store sync failed ({e}); writing Step 1 files from the stored documents.", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+
+def finish_sync_telemetry(report):
+    """Prints a sync's Zoho call summary and writes its full report to BASE_OUTPUT_DIR."""
+    zoho_telemetry.print_summary(report)
+    try:
+        zoho_telemetry.write_report(report, os.path.join(BASE_OUTPUT_DIR, SYNC_TELEMETRY_FILENAME))
+    except OSError as e:
+        print(f"WARNING: Could not write Zoho sync telemetry: {e}", file=sys.stderr)
+
+def get_aggregated_clinic_data(incremental=False, batch_lists=BATCH_LIST_FETCH):
     """
-    Orchestrates FRESH data fetching from Zoho and processing for all defined clinic groups.
+    Orchestrates data fetching from Zoho and processing for all defined clinic groups.
     This will always run STEP1 and STEP2, overwriting existing JSON files.
+    With incremental=True, STEP1 only re-fetches sales orders and returns that changed
+    since the sync recorded in each group's existing Step 1 output file.
+    With batch_lists=True, the sales order and sales return lists are paged once for
+    the whole organization and shared by every group's STEP1 run.
     Returns the aggregated data.
     """
-    print("Starting FRESH clinic data sync from Zoho and processing for API...")
+    with zoho_telemetry.collect('sync') as report:
+        all_clinics_csa_data = _sync_clinic_groups(incremental, batch_lists)
+    finish_sync_telemetry(report)
+    return all_clinics_csa_data
+
+def _sync_clinic_groups(incremental, batch_lists):
+    print(f"Starting {'INCREMENTAL' if incremental else 'FRESH'} clinic data sync from Zoho and processing for API...")
     all_clinics_csa_data = {} # Initialize aggregator for all clinic data
 
     # Ensure base output directory exists (still needed for intermediate files)
@@ -209,6 +301,11 @@ def get_aggregated_clinic_data():
         print(f"Warning: Zoho configuration loading issue (details: {e}). STEP1 will attempt to load.", file=sys.stderr)
 
 
+    from_store = CLINIC_SYNC_SOURCE == 'store'
+    if from_store:
+        sync_document_store(incremental)
+    prefetched_lists = fetch_batched_lists_for_groups(incremental) if batch_lists and not from_store else None
+
     # Process each clinic group
     for clinic_name, contact_ids in CLINIC_GROUPS.items():
         print(f"\n{'='*20} Processing Group: {clinic_name} {'='*20}")
@@ -221,7 +318,7 @@ def get_aggregated_clinic_data():
             print(f"Created output directory for intermediate files: {clinic_output_dir}")
 
         # Define file paths for this group (intermediate files)
-        step1_json_path = os.path.join(clinic_output_dir, f"{sanitized_name}_step1_data.json")
+        step1_json_path = step1_output_path(clinic_output_dir, sanitized_name)
         # step1_md_path = os.path.join(clinic_output_dir, f"{sanitized_name}_step1_log.md") # Log files might not be needed for API
         step2_json_path = os.path.join(clinic_output_dir, f"{sanitized_name}_step2_analysis.json")
         # step2_md_path = os.path.join(clinic_output_dir, f"{sanitized_name}_step2_report.md") # Log files might not be needed for API
@@ -229,7 +326,11 @@ def get_aggregated_clinic_data():
         try:
             # --- Run Step 1 ---
             print(f"\n--- Running Step 1 for {clinic_name} ---")
-            STEP1.run_step1(contact_ids, step1_json_path) # Assuming config is handled within
+            if from_store:
+                STEP1.write_step1_output_from_store(contact_ids, step1_json_path)
+            else:
+                with zoho_telemetry.clinic_group(clinic_name):
+                    STEP1.run_step1(contact_ids, step1_json_path, incremental=incremental, prefetched_lists=prefetched_lists) # Assuming config is handled within
             print(f"--- Step 1 completed for {clinic_name} ---")
 
             # --- Run Step 2 ---
@@ -251,38 +352,109 @@ def get_aggregated_clinic_data():
             # continue
         else:
             # If processing was successful, read the step2_analysis.json and add to aggregator if exists
-            if os.path.exists(step2_json_path):
-                try:
-                    with open(step2_json_path, 'r') as f:
-                        clinic_csa_data = json.load(f)
-                    
-                    # Also load Step 1 data for CSA quantity extraction
-                    step1_data = None
-                    if os.path.exists(step1_json_path):
-                        try:
-                            with open(step1_json_path, 'r') as f1:
-                                step1_data = json.load(f1)
-                        except Exception as e:
-                            print(f"WARNING: Could not load Step 1 data for {clinic_name}: {e}", file=sys.stderr)
-                    
-                    # Combine Step 1 and Step 2 data
-                    combined_data = {
-                        **clinic_csa_data,
-                        'step1_data': step1_data
-                    }
-                    all_clinics_csa_data[clinic_name] = combined_data
-                    print(f"Successfully aggregated CSA data for {clinic_name}")
-                except Exception as e:
-                    print(f"ERROR reading or aggregating {step2_json_path} for {clinic_name}", file=sys.stderr)
-                    print(f"Error details: {e}", file=sys.stderr)
-                    traceback.print_exc(file=sys.stderr)
-            else:
-                print(f"WARNING: No analysis file found for {clinic_name}, skipping aggregation.", file=sys.stderr)
+            combined_data = load_combined_clinic_data(clinic_name, step1_json_path, step2_json_path)
+            if combined_data is not None:
+                all_clinics_csa_data[clinic_name] = combined_data
 
     print(f"\n{'='*20} All clinic processing finished. Returning data. {'='*20}")
     # print(f"Check the '{BASE_OUTPUT_DIR}' directory for intermediate output files if needed.")
     return all_clinics_csa_data
 
+def load_combined_clinic_data(clinic_name, step1_json_path, step2_json_path):
+    """Reads a group's Step 2 analysis and Step 1 data and combines them. Returns None if unavailable."""
+    if not os.path.exists(step2_json_path):
+        print(f"WARNING: No analysis file found for {clinic_name}, skipping aggregation.", file=sys.stderr)
+        return None
+    try:
+        with open(step2_json_path, 'r') as f:
+            clinic_csa_data = json.load(f)
+
+        # Also load Step 1 data for CSA quantity extraction
+        step1_data = None
+        if os.path.exists(step1_json_path):
+            try:
+                step1_data = step1_output.load_step1_output(step1_json_path)
+            except Exception as e:
+                print(f"WARNING: Could not load Step 1 data for {clinic_name}: {e}", file=sys.stderr)
+
+        # Combine Step 1 and Step 2 data
+        combined_data = {
+            **clinic_csa_data,
+            'step1_data': step1_data
+        }
+        print(f"Successfully aggregated CSA data for {clinic_name}")
+        return combined_data
+    except Exception as e:
+        print(f"ERROR reading or aggregating {step2_json_path} for {clinic_name}", file=sys.stderr)
+        print(f"Error details: {e}", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        return None
+
+async def get_aggregated_clinic_data_async(incremental=False, batch_lists=BATCH_LIST_FETCH):
+    """
+    Asyncio counterpart of get_aggregated_clinic_data for use on the API's event loop.
+    STEP1 runs through STEP1_async for all clinic groups concurrently (sharing one
+    rate-limit budget); STEP2 and file reads run in worker threads.
+    """
+    with zoho_telemetry.collect('sync') as report:
+        all_clinics_csa_data = await _sync_clinic_groups_async(incremental, batch_lists)
+    finish_sync_telemetry(report)
+    return all_clinics_csa_data
+
+async def _sync_clinic_groups_async(incremental, batch_lists):
+    print(f"Starting {'INCREMENTAL' if incremental else 'FRESH'} async clinic data sync from Zoho...")
+    os.makedirs(BASE_OUTPUT_DIR, exist_ok=True)
+
+    from_store = CLINIC_SYNC_SOURCE == 'store'
+    if from_store:
+        await asyncio.to_thread(sync_document_store, incremental)
+
+    prefetched_lists = None
+    if batch_lists and not from_store:
+        try:
+            watermark = await asyncio.to_thread(batched_list_watermark) if incremental else None
+            with zoho_telemetry.clinic_group(BATCHED_LISTS_GROUP):
+                prefetched_lists = await STEP1_async.fetch_batched_lists(all_clinic_contact_ids(), watermark)
+        except Exception as e:
+            print(f"WARNING: Batched list fetch failed ({e}); falling back to per-contact list calls.", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+
+    async def process_group(clinic_name, contact_ids):
+        sanitized_name = sanitize_filename(clinic_name)
+        clinic_output_dir = os.path.join(BASE_OUTPUT_DIR, sanitized_name)
+        os.makedirs(clinic_output_dir, exist_ok=True)
+        step1_json_path = step1_output_path(clinic_output_dir, sanitized_name)
+        step2_json_path = os.path.join(clinic_output_dir, f"{sanitized_name}_step2_analysis.json")
+
+        try:
+            if from_store:
+                print(f"\n--- Writing Step 1 for {clinic_name} from the document store ---")
+                await asyncio.to_thread(STEP1.write_step1_output_from_store, contact_ids, step1_json_path)
+            else:
+                print(f"\n--- Running async Step 1 for {clinic_name} ---")
+                with zoho_telemetry.clinic_group(clinic_name):
+                    await STEP1_async.run_step1_async(contact_ids, step1_json_path, incremental=incremental, prefetched_lists=prefetched_lists)
+            print(f"\n--- Running Step 2 for {clinic_name} ---")
+            await asyncio.to_thread(STEP2.build_csa_replacement_chains, step1_json_path, step2_json_path, None)
+            print(f"\nSuccessfully processed group: {clinic_name}")
+        except Exception as e:
+            print(f"\nERROR processing group: {clinic_name}", file=sys.stderr)
+            print(f"Error details: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return None
+        return await asyncio.to_thread(load_combined_clinic_data, clinic_name, step1_json_path, step2_json_path)
+
+    results = await asyncio.gather(*(
+        process_group(clinic_name, contact_ids) for clinic_name, contact_ids in CLINIC_GROUPS.items()
+    ))
+    all_clinics_csa_data = {
+        clinic_name: combined_data
+        for clinic_name, combined_data in zip(CLINIC_GROUPS, results)
+        if combined_data is not None
+    }
+    print(f"\n{'='*20} All clinic processing finished. Returning data. {'='*20}")
+    return all_clinics_csa_data
+
 if __name__ == "__main__":
     print("Running process_clinics.py as a standalone script for testing...")
     data = get_aggregated_clinic_data()
@@ -0,0 +1,223 @@
+# Reading and writing Step 1 output files.
+#
+# Step 1 output comes in two formats, chosen by the file extension:
+#
+#   *.json    The original single JSON object:
+#             {"contact_ids_processed": [...], "salesorders": [...],
+#              "salesreturns": [...], "skipped_package_fetches": [...],
+#              "sync_state": {...}}
+#             The whole document is built in memory before it is written.
+#
+#   *.ndjson  One JSON record per line, written as documents are produced so
+#             the writer never holds a clinic's history in memory:
+#               {"type": "header", "contact_ids_processed": [...]}
+#               {"type": "salesorders", "document": {...}}    (one per order)
+#               {"type": "salesreturns", "document": {...}}   (one per return)
+#               {"type": "footer", "skipped_package_fetches": [...], "sync_state": {...}}
+#             Order and return records may be interleaved; within each type
+#             they appear in the same order as the lists of the JSON format.
+#
+# Both writers write to a temporary file and os.replace it into place, so a
+# reader never sees a partial file. load_step1_output returns the JSON-format
+# dict for either format, which is what STEP2 and the clinic data API consume.
+import json
+import os
+import threading
+from collections.abc import Mapping
+
+NDJSON_SUFFIX = '.ndjson'
+DOCUMENT_TYPES = ('salesorders', 'salesreturns')
+# Key that identifies a document of each type.
+DOCUMENT_ID_KEYS = {'salesorders': 'salesorder_id', 'salesreturns': 'salesreturn_id'}
+
+
+def is_ndjson_path(path):
+    return path.endswith(NDJSON_SUFFIX)
+
+
+class Step1JsonWriter:
+    """Collects documents in memory and writes the single-object JSON format on close()."""
+
+    def __init__(self, path, contact_ids):
+        self.path = path
+        self.contact_ids = list(contact_ids)
+        self.documents = {doc_type: [] for doc_type in DOCUMENT_TYPES}
+        self.counts = {doc_type: 0 for doc_type in DOCUMENT_TYPES}
+
+    def write(self, doc_type, document):
+        self.documents[doc_type].append(document)
+        self.counts[doc_type] += 1
+
+    def close(self, footer):
+        """Writes the output with the footer fields (sync_state, ...) after the document lists."""
+        output_data = {"contact_ids_processed": self.contact_ids, **self.documents, **footer}
+        # Write to a temporary file first so an interrupted write never corrupts the saved sync state
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(output_data, f, indent=4)
+        os.replace(temp_path, self.path)
+
+    def abort(self):
+        self.documents = {doc_type: [] for doc_type in DOCUMENT_TYPES}
+
+
+class Step1NdjsonWriter:
+    """Streams each document to disk as one line as soon as it is written."""
+
+    def __init__(self, path, contact_ids):
+        self.path = path
+        self.counts = {doc_type: 0 for doc_type in DOCUMENT_TYPES}
+        self._temp_path = f"{path}.tmp"
+        self._file = open(self._temp_path, 'w')
+        self._write_record({"type": "header", "contact_ids_processed": list(contact_ids)})
+
+    def _write_record(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def write(self, doc_type, document):
+        self._write_record({"type": doc_type, "document": document})
+        self.counts[doc_type] += 1
+
+    def close(self, footer):
+        """Writes the footer record and moves the finished file into place."""
+        self._write_record({"type": "footer", **footer})
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+
+    def abort(self):
+        """Discards a partially written file."""
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+def open_step1_writer(path, contact_ids):
+    """Returns the writer for path's format (NDJSON for *.ndjson, JSON otherwise)."""
+    if is_ndjson_path(path):
+        return Step1NdjsonWriter(path, contact_ids)
+    return Step1JsonWriter(path, contact_ids)
+
+
+def iter_step1_records(path):
+    """
+    Yields the records of a Step 1 output file in NDJSON record form (header,
+    one record per document, footer), reading NDJSON files one line at a time.
+    Raises ValueError if an NDJSON file has no footer (it was cut short).
+    """
+    if not is_ndjson_path(path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        yield {"type": "header", "contact_ids_processed": data.get('contact_ids_processed', [])}
+        for doc_type in DOCUMENT_TYPES:
+            for document in data.get(doc_type, []):
+                yield {"type": doc_type, "document": document}
+        footer = {key: value for key, value in data.items() if key not in DOCUMENT_TYPES and key != 'contact_ids_processed'}
+        yield {"type": "footer", **footer}
+        return
+
+    seen_footer = False
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            seen_footer = record.get('type') == 'footer'
+            yield record
+    if not seen_footer:
+        raise ValueError(f"Step 1 output {path} is incomplete (no footer record)")
+
+
+def load_step1_output(path):
+    """Returns the contents of a Step 1 output file of either format as the JSON-format dict."""
+    if not is_ndjson_path(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    data = {"contact_ids_processed": [], **{doc_type: [] for doc_type in DOCUMENT_TYPES}}
+    for record in iter_step1_records(path):
+        record_type = record.pop('type', None)
+        if record_type in DOCUMENT_TYPES:
+            data[record_type].append(record.get('document'))
+        elif record_type in ('header', 'footer'):
+            data.update(record)
+    return data
+
+
+class Step1DocumentIndex(Mapping):
+    """
+    Read-only mapping of document id -> document over one type of document in
+    an NDJSON Step 1 output. Only byte offsets are kept in memory; each lookup
+    reads and parses the document's line.
+    """
+
+    def __init__(self, path, offsets):
+        self.path = path
+        self._offsets = offsets
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, object_id):
+        offset = self._offsets[object_id]
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'rb')
+            self._file.seek(offset)
+            line = self._file.readline()
+        return json.loads(line)['document']
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, object_id):
+        return object_id in self._offsets
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load_step1_documents_by_id(path):
+    """
+    Returns (footer, salesorders by id, salesreturns by id) for an existing Step 1
+    output. For NDJSON files the id mappings are Step1DocumentIndex instances, so
+    only ids and offsets are loaded; for JSON files they are plain dicts.
+    """
+    if not is_ndjson_path(path):
+        data = load_step1_output(path)
+        footer = {key: value for key, value in data.items() if key not in DOCUMENT_TYPES}
+        by_id = {
+            doc_type: {doc.get(DOCUMENT_ID_KEYS[doc_type]): doc for doc in data.get(doc_type, []) if doc}
+            for doc_type in DOCUMENT_TYPES
+        }
+        return footer, by_id['salesorders'], by_id['salesreturns']
+
+    footer = None
+    offsets = {doc_type: {} for doc_type in DOCUMENT_TYPES}
+    with open(path, 'rb') as f:
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record_type = record.get('type')
+            if record_type in DOCUMENT_TYPES:
+                document = record.get('document')
+                if document:
+                    offsets[record_type][document.get(DOCUMENT_ID_KEYS[record_type])] = offset
+            elif record_type == 'footer':
+                footer = record
+    if footer is None:
+        raise ValueError(f"Step 1 output {path} is incomplete (no footer record)")
+    footer.pop('type', None)
+    return (
+        footer,
+        Step1DocumentIndex(path, offsets['salesorders']),
+        Step1DocumentIndex(path, offsets['salesreturns']),
+    )
@@ -0,0 +1,173 @@
+# Shared OAuth access token management for the Zoho scripts.
+#
+# STEP1, STEP1_async and generate_serial_history read their credentials from a
+# config_inventory.json file and keep the current access token in that dict.
+# ZohoTokenManager owns refreshing it:
+#   - the token's expiry (from the refresh response's expires_in) is stored in
+#     the config as access_token_expires_at, and ensure_fresh() refreshes a
+#     few minutes before it instead of waiting for a 401;
+#   - refresh() is single-flight: one thread per process (and, through a lock
+#     file next to the config, one process per config file) asks Zoho for a
+#     new token while the others wait and then adopt it;
+#   - the config file is rewritten atomically (temp file + os.replace), so a
+#     reader never sees a torn file.
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows; refreshes are then only coordinated within a process
+    fcntl = None
+
+import zoho_client
+
+TOKEN_URL = "https://accounts.zoho.com/oauth/v2/token"
+EXPIRES_AT_KEY = 'access_token_expires_at'
+# Refresh this many seconds before the recorded expiry.
+DEFAULT_REFRESH_MARGIN_SECONDS = int(os.environ.get('ZOHO_TOKEN_REFRESH_MARGIN_SECONDS', '300'))
+# Zoho access tokens last an hour; used if the response has no expires_in.
+DEFAULT_TOKEN_LIFETIME_SECONDS = 3600
+
+
+class TokenRefreshError(Exception):
+    """Raised when Zoho does not return a new access token."""
+
+
+@contextmanager
+def _file_lock(path):
+    """Holds an exclusive lock on path (created if needed) for the duration of the block."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class ZohoTokenManager:
+    """Refreshes and persists the access token stored in one config file."""
+
+    def __init__(self, config_path, refresh_margin=DEFAULT_REFRESH_MARGIN_SECONDS):
+        self.config_path = config_path
+        self.lock_path = f"{config_path}.lock"
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = None
+        self.refreshes = 0
+        self.adopted = 0 # Refreshes avoided by picking up a token another thread or process obtained
+
+    def _is_current(self, access_token, expires_at):
+        if not access_token:
+            return False
+        return expires_at is None or time.time() < expires_at - self.refresh_margin
+
+    def needs_refresh(self, config):
+        """True if config has no access token or its token expires within the refresh margin."""
+        return not self._is_current(config.get('access_token'), config.get(EXPIRES_AT_KEY))
+
+    def ensure_fresh(self, config):
+        """Refreshes the token in config first if it is missing or about to expire. Returns the token."""
+        if self.needs_refresh(config):
+            self.refresh(config, config.get('access_token'))
+        return config['access_token']
+
+    def refresh(self, config, stale_token=None):
+        """
+        Replaces stale_token (the token a caller saw rejected or expiring) in config
+        with a current one and returns it. If another thread or process already
+        replaced it, that token is adopted without calling Zoho.
+        """
+        with self._lock:
+            if self._access_token != stale_token and self._is_current(self._access_token, self._expires_at):
+                self.adopted += 1
+                return self._apply(config, self._access_token, self._expires_at)
+
+            with _file_lock(self.lock_path):
+                stored = self._read_config()
+                access_token, expires_at = stored.get('access_token'), stored.get(EXPIRES_AT_KEY)
+                if access_token != stale_token and self._is_current(access_token, expires_at):
+                    print("Using access token refreshed by another process.")
+                    self.adopted += 1
+                    return self._apply(config, access_token, expires_at)
+
+                tokens = self._request_token(stored or config)
+                access_token = tokens['access_token']
+                expires_at = time.time() + int(tokens.get('expires_in', DEFAULT_TOKEN_LIFETIME_SECONDS))
+                self._write_config({**(stored or config), 'access_token': access_token, EXPIRES_AT_KEY: expires_at})
+                self.refreshes += 1
+                return self._apply(config, access_token, expires_at)
+
+    def _apply(self, config, access_token, expires_at):
+        self._access_token = access_token
+        self._expires_at = expires_at
+        config['access_token'] = access_token
+        config[EXPIRES_AT_KEY] = expires_at
+        return access_token
+
+    def _request_token(self, config):
+        print("Refreshing access token...")
+        data = {
+            'refresh_token': config['refresh_token'],
+            'client_id': config['client_id'],
+            'client_secret': config['client_secret'],
+            'grant_type': 'refresh_token'
+        }
+        response = zoho_client.get_client().post(TOKEN_URL, data=data)
+        if response.status_code >= 400:
+            print(f"Response status: {response.status_code}")
+            print(f"Response body: {response.text}")
+        response.raise_for_status()
+        tokens = response.json()
+        if 'access_token' not in tokens:
+            raise TokenRefreshError(f"Failed to refresh token. Response: {tokens}")
+        print("Access token refreshed successfully.")
+        return tokens
+
+    def _read_config(self):
+        """Returns the config currently on disk, or {} if it is missing or unreadable."""
+        try:
+            with open(self.config_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_config(self, config):
+        """Atomically replaces the config file, keeping its permissions."""
+        directory = os.path.dirname(os.path.abspath(self.config_path))
+        fd, temp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(config, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.config_path):
+                os.chmod(temp_path, os.stat(self.config_path).st_mode & 0o777)
+            os.replace(temp_path, self.config_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def stats(self):
+        expires_in = None if self._expires_at is None else round(self._expires_at - time.time())
+        return {"refreshes": self.refreshes, "adopted": self.adopted, "expires_in_seconds": expires_in}
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+def get_token_manager(config_path):
+    """Returns the process-wide token manager for a config file, creating it on first use."""
+    key = os.path.abspath(config_path)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = ZohoTokenManager(key)
+        return _managers[key]
@@ -0,0 +1,202 @@
+# Persistent on-disk cache for Zoho detail responses.
+#
+# Package details, and sales order / sales return details that have not been
+# modified, do not change between syncs. STEP1 stores each detail response here
+# keyed by (endpoint, object id) together with a validator (the document's
+# last_modified_time, or another value that changes when the document does).
+# A lookup only hits when the stored validator matches the one the caller got
+# from the cheap list call and the entry is younger than the TTL. The cache is
+# a single SQLite file, bounded in size by evicting least-recently-used entries
+# (the entry count and total size are kept as running totals, so a put does not
+# rescan the table).
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    'ZOHO_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zoho_response_cache.sqlite3')
+)
+DEFAULT_MAX_BYTES = int(float(os.environ.get('ZOHO_CACHE_MAX_MB', '256')) * 1024 * 1024)
+DEFAULT_MAX_ENTRIES = int(os.environ.get('ZOHO_CACHE_MAX_ENTRIES', '200000'))
+# Entries older than this are refetched even if their validator still matches.
+DEFAULT_TTL_SECONDS = int(os.environ.get('ZOHO_CACHE_TTL_SECONDS', str(7 * 24 * 60 * 60)))
+CACHE_ENABLED = os.environ.get('ZOHO_CACHE_DISABLED', '').lower() not in ('1', 'true', 'yes')
+# Hits only update an entry's last_access in memory; they are written back in
+# batches of this size (and before every put, so eviction sees them).
+ACCESS_FLUSH_SIZE = int(os.environ.get('ZOHO_CACHE_ACCESS_FLUSH_SIZE', '256'))
+
+
+class ZohoResponseCache:
+    """SQLite-backed response cache with validator checks, TTL and LRU eviction."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES,
+                 max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # One connection shared by all worker threads; every access holds self._lock.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                endpoint TEXT NOT NULL,
+                object_id TEXT NOT NULL,
+                validator TEXT,
+                payload TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (endpoint, object_id)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.commit()
+        # Running totals, so puts don't rescan the table to check the size limits
+        self._count, self._total_size = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        self._pending_access = {} # (endpoint, object_id) -> last_access not yet written
+
+    def get(self, endpoint, object_id, validator=None):
+        """
+        Returns the cached payload, or None on a miss. An entry whose validator
+        differs from the given one, or that is older than the TTL, is discarded.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT validator, payload, fetched_at, size FROM responses WHERE endpoint = ? AND object_id = ?",
+                (endpoint, str(object_id))
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            stored_validator, payload, fetched_at, size = row
+            if stored_validator != _validator_text(validator) or now - fetched_at > self.ttl_seconds:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE endpoint = ? AND object_id = ?", (endpoint, str(object_id))
+                )
+                self._conn.commit()
+                self._pending_access.pop((endpoint, str(object_id)), None)
+                self._count -= 1
+                self._total_size -= size
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._pending_access[(endpoint, str(object_id))] = now
+            if len(self._pending_access) >= ACCESS_FLUSH_SIZE:
+                self._flush_access()
+                self._conn.commit()
+            self.hits += 1
+        return json.loads(payload)
+
+    def put(self, endpoint, object_id, payload, validator=None):
+        """Stores a response, then evicts least-recently-used entries beyond the size limits."""
+        data = json.dumps(payload, separators=(',', ':'))
+        now = time.time()
+        with self._lock:
+            self._pending_access.pop((endpoint, str(object_id)), None)
+            self._flush_access()
+            replaced = self._conn.execute(
+                "SELECT size FROM responses WHERE endpoint = ? AND object_id = ?", (endpoint, str(object_id))
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (endpoint, str(object_id), _validator_text(validator), data, len(data), now, now)
+            )
+            if replaced:
+                self._count -= 1
+                self._total_size -= replaced[0]
+            self._count += 1
+            self._total_size += len(data)
+            self._evict()
+            self._conn.commit()
+
+    def _flush_access(self):
+        """Writes the last_access times of recent hits (the caller holds the lock and commits)."""
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE responses SET last_access = ? WHERE endpoint = ? AND object_id = ?",
+                [(last_access, endpoint, object_id) for (endpoint, object_id), last_access in self._pending_access.items()]
+            )
+            self._pending_access = {}
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache is within max_bytes and max_entries."""
+        if self._count <= self.max_entries and self._total_size <= self.max_bytes:
+            return
+        # Walk the last_access index from the oldest entry just far enough to get back within the limits
+        evict_count = 0
+        freed = 0
+        oldest = self._conn.execute("SELECT size FROM responses ORDER BY last_access, rowid")
+        for (size,) in oldest:
+            if self._count - evict_count <= self.max_entries and self._total_size - freed <= self.max_bytes:
+                break
+            evict_count += 1
+            freed += size
+        oldest.close()
+        self._conn.execute(
+            "DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY last_access, rowid LIMIT ?)",
+            (evict_count,)
+        )
+        self._count -= evict_count
+        self._total_size -= freed
+        self.evictions += evict_count
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._pending_access = {}
+            self._count = self._total_size = 0
+
+    def stats(self):
+        """Returns hit/miss counters and current size for logging."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": self._count,
+                "bytes": self._total_size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._flush_access()
+            self._conn.commit()
+            self._conn.close()
+
+
+def _validator_text(validator):
+    return None if validator is None else str(validator)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Returns the process-wide response cache, or None if caching is disabled."""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ZohoResponseCache()
+    return _cache
@@ -0,0 +1,255 @@
+# Shared HTTP client for Zoho API calls.
+#
+# All zoho_get implementations send their requests through one ZohoClient so
+# that TCP+TLS connections to www.zohoapis.com are kept alive and reused across
+# the thousands of detail calls a sync makes, and so that every request passes
+# through the shared rate limiter in zoho_rate_limit and the adaptive
+# concurrency limit in zoho_concurrency. Concurrent GETs for the
+# same document (a package shared by several orders, contacts in one clinic
+# group sharing records) are coalesced into a single network call. Every GET
+# sent is recorded in zoho_telemetry.
+# AsyncZohoClient provides the same behaviour on httpx for the asyncio engine
+# in STEP1_async. With ZOHO_HTTP_MODE=record or replay, both clients send their
+# requests through the fixture transports in zoho_fixtures instead.
+import asyncio
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import zoho_concurrency
+import zoho_fixtures
+import zoho_rate_limit
+import zoho_telemetry
+
+# Connection pool and timeout settings (seconds). The pool should be at least
+# as large as the number of worker threads issuing requests concurrently.
+DEFAULT_POOL_SIZE = int(os.environ.get('ZOHO_HTTP_POOL_SIZE', '16'))
+DEFAULT_CONNECT_TIMEOUT = float(os.environ.get('ZOHO_HTTP_CONNECT_TIMEOUT', '10'))
+DEFAULT_READ_TIMEOUT = float(os.environ.get('ZOHO_HTTP_READ_TIMEOUT', '60'))
+# Share one network call between concurrent identical GETs (set ZOHO_HTTP_COALESCE=0 to disable).
+COALESCE_REQUESTS = os.environ.get('ZOHO_HTTP_COALESCE', '1').lower() not in ('0', 'false', 'no')
+
+
+def endpoint_label(url):
+    """
+    Names the API operation a URL calls, with document ids replaced by {id}:
+    'salesorders' (list), 'salesorders/{id}' (detail), 'items/serialnumbers'.
+    """
+    endpoint, object_id = zoho_fixtures.endpoint_and_id(url)
+    if object_id is None:
+        return endpoint
+    if object_id.isalpha() and object_id.islower(): # A sub-resource such as items/serialnumbers
+        return f"{endpoint}/{object_id}"
+    return f"{endpoint}/{{id}}"
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller runs the
+    function, later callers wait for it and receive the same result (or
+    exception). Once the call finishes the key is forgotten, so this never
+    serves stale data; it only removes duplicate work that is in flight.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _InFlightCall()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class ZohoClient:
+    """A requests.Session with a keep-alive connection pool and default timeouts."""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, rate_limiter=None, coalesce=COALESCE_REQUESTS,
+                 concurrency_limiter=None):
+        self.pool_size = pool_size
+        self.coalesce = coalesce
+        self._in_flight = SingleFlight()
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limiter = rate_limiter or zoho_rate_limit.get_rate_limiter()
+        self.concurrency_limiter = concurrency_limiter or zoho_concurrency.get_concurrency_limiter()
+        self.session = requests.Session()
+        # Retries are handled by the callers (401 refresh, 429 backoff), not by urllib3.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # In record/replay mode this is a fixture transport with the same get/post/close methods
+        self.session = zoho_fixtures.wrap_session(self.session)
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        """
+        Sends a rate-limited GET over the pooled session and returns the Response.
+        Concurrent GETs for the same URL, params and credentials share one request.
+        """
+        if not self.coalesce:
+            return self._send_get(url, headers, params, timeout)
+        key = (
+            url,
+            tuple(sorted((k, str(v)) for k, v in (params or {}).items())),
+            (headers or {}).get('Authorization'),
+        )
+        return self._in_flight.do(key, lambda: self._send_get(url, headers, params, timeout))
+
+    def _send_get(self, url, headers, params, timeout):
+        sent_at = self.concurrency_limiter.acquire()
+        response = None
+        rate_limit_wait = 0.0
+        try:
+            self.rate_limiter.acquire()
+            rate_limit_wait = time.monotonic() - sent_at
+            sent_at = time.monotonic()
+            response = self.session.get(url, headers=headers, params=params, timeout=timeout or self.timeout)
+            response.content # Read the body now so callers sharing this Response never race on the stream
+            return response
+        finally:
+            endpoint = endpoint_label(url)
+            self.concurrency_limiter.release(sent_at, response, endpoint)
+            zoho_telemetry.record_request(endpoint, response, time.monotonic() - sent_at, rate_limit_wait)
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        """Sends a POST over the pooled session (used for OAuth token refresh, not rate limited)."""
+        return self.session.post(url, data=data, headers=headers, timeout=timeout or self.timeout)
+
+    def stats(self):
+        """Returns request coalescing and concurrency counters for logging."""
+        return {"coalesced_requests": self._in_flight.coalesced, "concurrency": self.concurrency_limiter.stats()}
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncZohoClient:
+    """
+    httpx.AsyncClient counterpart of ZohoClient for STEP1_async. It shares the
+    process-wide rate limiter with the threaded clients. An instance is bound to
+    the event loop it is used on, so create one per run and close it with aclose().
+    """
+
+    def __init__(self, max_connections=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, rate_limiter=None, coalesce=COALESCE_REQUESTS,
+                 concurrency_limiter=None):
+        import httpx # Only the asyncio engine needs httpx
+        self.rate_limiter = rate_limiter or zoho_rate_limit.get_rate_limiter()
+        self.concurrency_limiter = concurrency_limiter or zoho_concurrency.get_concurrency_limiter()
+        self.coalesce = coalesce
+        self.coalesced = 0
+        self._in_flight = {}
+        # pool=None: requests queued behind the connection limit wait instead of timing out
+        self.client = zoho_fixtures.wrap_async_client(lambda: httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None),
+        ))
+
+    async def get(self, url, headers=None, params=None):
+        """Sends a rate-limited GET; concurrent identical GETs share one request."""
+        if not self.coalesce:
+            return await self._send_get(url, headers, params)
+        key = (
+            url,
+            tuple(sorted((k, str(v)) for k, v in (params or {}).items())),
+            (headers or {}).get('Authorization'),
+        )
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            response = await self._send_get(url, headers, params)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # Mark retrieved so an unawaited future doesn't log a warning
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            del self._in_flight[key]
+
+    async def _send_get(self, url, headers, params):
+        sent_at = await self.concurrency_limiter.acquire_async()
+        response = None
+        rate_limit_wait = 0.0
+        try:
+            await self.rate_limiter.acquire_async()
+            rate_limit_wait = time.monotonic() - sent_at
+            sent_at = time.monotonic()
+            response = await self.client.get(url, headers=headers, params=params)
+            return response
+        finally:
+            endpoint = endpoint_label(url)
+            self.concurrency_limiter.release(sent_at, response, endpoint)
+            zoho_telemetry.record_request(endpoint, response, time.monotonic() - sent_at, rate_limit_wait)
+
+    def stats(self):
+        return {"coalesced_requests": self.coalesced, "concurrency": self.concurrency_limiter.stats()}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Returns the process-wide ZohoClient, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ZohoClient()
+    return _client
+
+def configure_client(**kwargs):
+    """
+    Replaces the process-wide client with one built from kwargs (pool_size,
+    connect_timeout, read_timeout). Intended for CLI entry points that want a
+    pool sized to their worker count.
+    """
+    global _client
+    with _client_lock:
+        old_client = _client
+        _client = ZohoClient(**kwargs)
+    if old_client is not None:
+        old_client.close()
+    return _client
@@ -0,0 +1,300 @@
+# Adaptive limit on the number of Zoho requests in flight.
+#
+# zoho_rate_limit spreads requests over Zoho's per-minute and per-day budgets,
+# but how many requests can usefully be outstanding at once depends on how
+# Zoho is coping at the moment. ZohoConcurrencyLimiter finds that number with
+# AIMD (additive increase, multiplicative decrease), as TCP does for its
+# congestion window:
+#   - every healthy response raises the limit by 1/limit, i.e. by about one
+#     request per round of responses;
+#   - a 429, or a response much slower than the endpoint's usual latency,
+#     multiplies the limit by DECREASE_FACTOR. Responses to requests sent
+#     before the last cut do not cut it again, so a burst of 429s from one
+#     round counts as a single signal;
+#   - a Retry-After header on a 429 holds back every new request until it
+#     has passed.
+# ZohoClient and AsyncZohoClient take a slot before each GET and release it
+# with the response. Worker counts (STEP1_MAX_WORKERS, --max-concurrency) are
+# the upper bound; each engine starts the limit at its worker count (start_at)
+# and this limiter decides how much of it is used from there. Threads and
+# asyncio tasks waiting for a slot are queued together and served in order: a
+# released slot is handed to the oldest waiter, which is woken directly.
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Set ZOHO_CONCURRENCY_ADAPTIVE=0 to keep the limit fixed at its maximum (Retry-After is still honoured).
+ADAPTIVE = os.environ.get('ZOHO_CONCURRENCY_ADAPTIVE', '1').lower() not in ('0', 'false', 'no')
+# Limit until an engine calls start_at with its worker count (e.g. for callers that never do).
+DEFAULT_INITIAL_LIMIT = float(os.environ.get('ZOHO_CONCURRENCY_INITIAL', '4'))
+DEFAULT_MIN_LIMIT = float(os.environ.get('ZOHO_CONCURRENCY_MIN', '1'))
+DEFAULT_MAX_LIMIT = float(os.environ.get('ZOHO_CONCURRENCY_MAX', '32'))
+DECREASE_FACTOR = float(os.environ.get('ZOHO_CONCURRENCY_DECREASE_FACTOR', '0.5'))
+# A response counts as a latency spike when it takes this many times the
+# endpoint's average latency, and at least LATENCY_SPIKE_MIN_SECONDS.
+LATENCY_SPIKE_FACTOR = float(os.environ.get('ZOHO_CONCURRENCY_LATENCY_FACTOR', '3'))
+LATENCY_SPIKE_MIN_SECONDS = float(os.environ.get('ZOHO_CONCURRENCY_LATENCY_MIN_SECONDS', '1'))
+# Weight of the newest healthy response in an endpoint's average latency.
+LATENCY_SMOOTHING = 0.1
+# Longest Retry-After pause honoured (seconds); longer values are capped.
+MAX_RETRY_AFTER_SECONDS = 120
+
+
+def retry_after_seconds(response):
+    """
+    Returns the Retry-After header of a response in seconds (either form: a
+    number of seconds or an HTTP date), or None if it is absent or unparseable.
+    """
+    value = (getattr(response, 'headers', None) or {}).get('Retry-After')
+    if value in (None, ''):
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class _Waiter:
+    """A thread (event) or asyncio task (loop, future) queued for a slot."""
+
+    def __init__(self, event=None, loop=None, future=None):
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve_future, self.future)
+
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ZohoConcurrencyLimiter:
+    """
+    Limits concurrent Zoho requests to `limit`, which AIMD adjusts from the
+    responses. acquire() blocks until a slot is free (and any Retry-After pause
+    has passed) and returns the send time to pass back to release().
+    """
+
+    def __init__(self, initial_limit=DEFAULT_INITIAL_LIMIT, min_limit=DEFAULT_MIN_LIMIT,
+                 max_limit=DEFAULT_MAX_LIMIT, adaptive=ADAPTIVE):
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.adaptive = adaptive
+        self.limit = min(self.max_limit, max(self.min_limit, float(initial_limit))) if adaptive else self.max_limit
+        self._lock = threading.Lock()
+        self._waiters = deque() # _Waiter objects, oldest first
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._latency = {} # endpoint -> average latency of healthy responses (seconds)
+        self.peak_in_flight = 0
+        self.throttled_responses = 0 # 429s received
+        self.latency_backoffs = 0
+        self.decreases = 0
+        self.retry_after_pauses = 0
+        self.total_pause_seconds = 0.0 # Time callers spent held back by Retry-After
+
+    # The methods below starting with an underscore are called with self._lock held.
+
+    def _slot_free(self):
+        return time.monotonic() >= self._paused_until and self._in_flight < max(1, int(self.limit))
+
+    def _take_slot(self):
+        self._in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self._in_flight)
+
+    def _grant(self):
+        """Hands free slots to the oldest waiters and wakes them."""
+        while self._waiters and self._slot_free():
+            waiter = self._waiters.popleft()
+            self._take_slot()
+            waiter.granted = True
+            waiter.wake()
+
+    def _recheck_waiters(self):
+        """Wakes every waiter without a slot, so each re-reads how long to wait (a pause began)."""
+        for waiter in self._waiters:
+            waiter.wake()
+
+    def _pause_remaining(self):
+        """
+        How long a waiter should wait before checking again itself: until a
+        Retry-After pause ends (no release() may come to wake it then), or None
+        to wait until woken by release() or _recheck_waiters.
+        """
+        remaining = self._paused_until - time.monotonic()
+        return remaining if remaining > 0 else None
+
+    def _enqueue(self, waiter, started):
+        """Takes a slot at once if nobody is queued and one is free (returns True), or queues waiter."""
+        if not self._waiters and self._slot_free():
+            self._take_slot()
+            self._record_pause(started)
+            return True
+        self._waiters.append(waiter)
+        return False
+
+    def acquire(self):
+        """Blocks until a request may be sent; returns its send time for release()."""
+        started = time.monotonic()
+        waiter = _Waiter(event=threading.Event())
+        with self._lock:
+            if self._enqueue(waiter, started):
+                return time.monotonic()
+            timeout = self._pause_remaining()
+        while True:
+            waiter.event.wait(timeout)
+            with self._lock:
+                self._grant()
+                if waiter.granted:
+                    self._record_pause(started)
+                    return time.monotonic()
+                waiter.event.clear()
+                timeout = self._pause_remaining()
+
+    async def acquire_async(self):
+        """Same as acquire(), but waits on a future so the event loop keeps running."""
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop=loop, future=loop.create_future())
+        with self._lock:
+            if self._enqueue(waiter, started):
+                return time.monotonic()
+            timeout = self._pause_remaining()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                with self._lock:
+                    self._grant()
+                    if waiter.granted:
+                        self._record_pause(started)
+                        return time.monotonic()
+                    if waiter.future.done():
+                        waiter.future = loop.create_future()
+                    timeout = self._pause_remaining()
+        except asyncio.CancelledError:
+            # Give back a slot granted just as the task was cancelled, or leave the queue
+            with self._lock:
+                if waiter.granted:
+                    self._in_flight -= 1
+                else:
+                    self._waiters.remove(waiter)
+                self._grant()
+            raise
+
+    def start_at(self, concurrency):
+        """
+        Raises the limit to a caller's configured concurrency (capped at max_limit),
+        so a run starts at the worker count it was configured with rather than at
+        DEFAULT_INITIAL_LIMIT. Once AIMD has cut the limit in response to Zoho, the
+        limit is left to AIMD.
+        """
+        with self._lock:
+            if self.adaptive and not self.decreases:
+                self.limit = max(self.limit, min(self.max_limit, float(concurrency)))
+                self._grant()
+
+    def _record_pause(self, started):
+        if self._paused_until > started:
+            self.total_pause_seconds += min(time.monotonic(), self._paused_until) - started
+
+    def release(self, sent_at, response=None, endpoint=None):
+        """
+        Frees the slot taken at sent_at and adjusts the limit from the response
+        (None if the request failed without one, which leaves the limit as is).
+        Latencies are averaged per endpoint (see zoho_client.endpoint_label).
+        """
+        now = time.monotonic()
+        status = getattr(response, 'status_code', None)
+        with self._lock:
+            self._in_flight -= 1
+            if status == 429:
+                self.throttled_responses += 1
+                retry_after = retry_after_seconds(response)
+                if retry_after:
+                    paused_until = now + min(retry_after, MAX_RETRY_AFTER_SECONDS)
+                    if paused_until > self._paused_until:
+                        self._paused_until = paused_until
+                        self.retry_after_pauses += 1
+                        self._recheck_waiters()
+                self._decrease(sent_at, now)
+            elif response is not None and status < 400:
+                latency = now - sent_at
+                average = self._latency.get(endpoint)
+                if (average is not None and latency > LATENCY_SPIKE_MIN_SECONDS
+                        and latency > average * LATENCY_SPIKE_FACTOR):
+                    self.latency_backoffs += 1
+                    self._decrease(sent_at, now)
+                else:
+                    self._latency[endpoint] = latency if average is None else (
+                        average + LATENCY_SMOOTHING * (latency - average)
+                    )
+                    if self.adaptive:
+                        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._grant()
+
+    def _decrease(self, sent_at, now):
+        if not self.adaptive or sent_at < self._last_decrease:
+            return
+        self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+        self._last_decrease = now
+        self.decreases += 1
+
+    def stats(self):
+        """Returns the current limit and throttling counters for logging."""
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiters),
+                "peak_in_flight": self.peak_in_flight,
+                "throttled_responses": self.throttled_responses,
+                "latency_backoffs": self.latency_backoffs,
+                "decreases": self.decreases,
+                "retry_after_pauses": self.retry_after_pauses,
+                "total_pause_seconds": round(self.total_pause_seconds, 3),
+            }
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_concurrency_limiter():
+    """Returns the process-wide concurrency limiter, creating it on first use."""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = ZohoConcurrencyLimiter()
+    return _limiter
+
+def configure_concurrency_limiter(**kwargs):
+    """
+    Replaces the process-wide limiter with one built from kwargs (initial_limit,
+    min_limit, max_limit, adaptive). Clients created afterwards use it.
+    """
+    global _limiter
+    with _limiter_lock:
+        _limiter = ZohoConcurrencyLimiter(**kwargs)
+    return _limiter
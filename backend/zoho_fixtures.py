@@ -0,0 +1,383 @@
+# Record/replay of Zoho HTTP traffic for offline testing and benchmarking.
+#
+# ZOHO_HTTP_MODE selects how zoho_client talks to Zoho:
+#   live    (default) requests go to Zoho.
+#   record  requests go to Zoho and every GET response is appended to the
+#           fixture archive at ZOHO_FIXTURE_PATH.
+#   replay  no network traffic: GETs are answered from the fixture archive
+#           and token refreshes return a dummy token. Replay can add latency
+#           and inject 429s so concurrency and rate-limit settings can be
+#           benchmarked repeatably without spending Zoho quota (see
+#           benchmark_sync.py).
+#
+# The archive is gzip-compressed JSON lines, one record per response:
+#   {"method": "GET", "url": ..., "params": {...}, "endpoint": "salesorders",
+#    "object_id": "123" or null, "status": 200, "body": "<response text>",
+#    "retry_after": null, "elapsed_ms": 84.2, "recorded_at": "..."}
+# Request headers (credentials) and POSTs (token refreshes) are never recorded.
+import asyncio
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+
+HTTP_MODE = os.environ.get('ZOHO_HTTP_MODE', 'live').lower()
+DEFAULT_FIXTURE_PATH = os.environ.get(
+    'ZOHO_FIXTURE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zoho_fixtures.jsonl.gz')
+)
+# Replay latency per request in milliseconds; empty means use each response's recorded latency.
+REPLAY_LATENCY_MS = os.environ.get('ZOHO_REPLAY_LATENCY_MS', '')
+REPLAY_JITTER_MS = float(os.environ.get('ZOHO_REPLAY_JITTER_MS', '0'))
+# Fraction of replayed GETs answered with an injected 429.
+REPLAY_429_RATE = float(os.environ.get('ZOHO_REPLAY_429_RATE', '0'))
+# Emulates Zoho's per-minute request quota: GETs beyond it within a rolling minute get a 429 (0 = off).
+REPLAY_QUOTA_PER_MINUTE = int(os.environ.get('ZOHO_REPLAY_QUOTA_PER_MINUTE', '0'))
+REPLAY_SEED = os.environ.get('ZOHO_REPLAY_SEED', '0')
+# Records buffered before the archive is flushed to disk.
+RECORD_FLUSH_EVERY = 100
+API_PATH_PREFIX = '/inventory/v1/'
+# Not part of a replay lookup, so archives replay under any organization config.
+IGNORED_PARAMS = {'organization_id'}
+
+
+def request_key(method, url, params):
+    """
+    Identifies a request independently of parameter order and value types.
+    Parameters in IGNORED_PARAMS (account-specific, not request-specific) are left out.
+    """
+    return (method, url, tuple(sorted((str(k), str(v)) for k, v in (params or {}).items() if k not in IGNORED_PARAMS)))
+
+
+def endpoint_and_id(url):
+    """
+    Splits an API URL into (endpoint, object id), e.g. .../inventory/v1/salesorders/123
+    -> ('salesorders', '123') and .../inventory/v1/items -> ('items', None).
+    """
+    path = urlparse(url).path
+    if API_PATH_PREFIX in path:
+        path = path.split(API_PATH_PREFIX, 1)[1]
+    parts = [part for part in path.strip('/').split('/') if part]
+    if not parts:
+        return None, None
+    return parts[0], (parts[1] if len(parts) > 1 else None)
+
+
+class FixtureRecorder:
+    """
+    Appends response records to a gzip JSON-lines archive (thread-safe). Records
+    are streamed to disk as they arrive, so memory use does not grow with the
+    number of responses. With append=False an existing archive is replaced.
+    path defaults to DEFAULT_FIXTURE_PATH (as last set by configure()).
+    """
+
+    def __init__(self, path=None, flush_every=RECORD_FLUSH_EVERY, append=True):
+        path = path or DEFAULT_FIXTURE_PATH
+        self.path = path
+        self.flush_every = flush_every
+        self.recorded = 0
+        self._lock = threading.Lock()
+        # Appending starts a new gzip member; readers see one continuous stream.
+        self._file = gzip.open(path, 'at' if append else 'wt', encoding='utf-8')
+
+    def record(self, method, url, params, status, body, elapsed=None, retry_after=None):
+        endpoint, object_id = endpoint_and_id(url)
+        line = json.dumps({
+            "method": method,
+            "url": url,
+            "params": {str(k): str(v) for k, v in (params or {}).items()},
+            "endpoint": endpoint,
+            "object_id": object_id,
+            "status": status,
+            "body": body,
+            "retry_after": retry_after,
+            "elapsed_ms": None if elapsed is None else round(elapsed * 1000, 1),
+            "recorded_at": datetime.now().isoformat(),
+        }, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            self.recorded += 1
+            if self.recorded % self.flush_every == 0:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def iter_fixture_records(path):
+    """Yields every record of a fixture archive in recording order."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue # Last line of a recording that was cut short
+
+
+class FixtureArchive:
+    """
+    In-memory index of a fixture archive by request and by (endpoint, object id).
+    When a request was recorded more than once, the latest response wins.
+    path defaults to DEFAULT_FIXTURE_PATH (as last set by configure()).
+    """
+
+    def __init__(self, path=None):
+        path = path or DEFAULT_FIXTURE_PATH
+        self.path = path
+        self._by_request = {}
+        self._by_object = {}
+        for record in iter_fixture_records(path):
+            key = request_key(record.get('method', 'GET'), record['url'], record.get('params'))
+            self._by_request[key] = record
+            self._by_object.setdefault((record.get('endpoint'), record.get('object_id')), []).append(key)
+
+    def __len__(self):
+        return len(self._by_request)
+
+    def lookup(self, method, url, params):
+        return self._by_request.get(request_key(method, url, params))
+
+    def find(self, endpoint, object_id=None):
+        """Returns the latest records for an endpoint (and object id), one per distinct request."""
+        return [self._by_request[key] for key in dict.fromkeys(self._by_object.get((endpoint, object_id), []))]
+
+
+class ReplayResponse:
+    """The subset of requests.Response / httpx.Response the Zoho callers use."""
+
+    def __init__(self, url, status_code, text, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error (replay) for url: {self.url}", response=self)
+
+
+class RecordingTransport:
+    """Wraps a requests.Session and records every GET response it returns."""
+
+    def __init__(self, session, recorder):
+        self.session = session
+        self.recorder = recorder
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        started = time.monotonic()
+        response = self.session.get(url, headers=headers, params=params, timeout=timeout)
+        self.recorder.record(
+            'GET', url, params, response.status_code, response.text, time.monotonic() - started,
+            response.headers.get('Retry-After')
+        )
+        return response
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        return self.session.post(url, data=data, headers=headers, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncRecordingTransport:
+    """Wraps an httpx.AsyncClient and records every GET response it returns."""
+
+    def __init__(self, client, recorder):
+        self.client = client
+        self.recorder = recorder
+
+    async def get(self, url, headers=None, params=None):
+        started = time.monotonic()
+        response = await self.client.get(url, headers=headers, params=params)
+        self.recorder.record(
+            'GET', url, params, response.status_code, response.text, time.monotonic() - started,
+            response.headers.get('Retry-After')
+        )
+        return response
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class ReplayTransport:
+    """
+    Serves GETs from a FixtureArchive, with simulated latency, randomly injected
+    429s and an optional emulated per-minute quota. Requests that were never
+    recorded get a 404. Usable in place of a requests.Session (get/post/close)
+    and, through get_async/aclose, of an httpx.AsyncClient.
+    """
+
+    def __init__(self, archive, latency_ms=REPLAY_LATENCY_MS, jitter_ms=REPLAY_JITTER_MS,
+                 error_rate=REPLAY_429_RATE, quota_per_minute=REPLAY_QUOTA_PER_MINUTE, seed=REPLAY_SEED):
+        self.archive = archive
+        self.latency_ms = None if latency_ms in (None, '') else float(latency_ms)
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.quota_per_minute = quota_per_minute
+        self._random = random.Random(seed)
+        self._window = deque() # Times of GETs admitted within the last minute
+        self._lock = threading.Lock()
+        self.served = 0
+        self.misses = 0
+        self.injected_429 = 0
+        self.quota_429 = 0
+
+    def _respond(self, url, params):
+        """Returns (delay in seconds, response) for one GET."""
+        now = time.monotonic()
+        with self._lock:
+            jitter = self._random.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0
+            if self.quota_per_minute:
+                while self._window and now - self._window[0] >= 60:
+                    self._window.popleft()
+                if len(self._window) >= self.quota_per_minute:
+                    self.quota_429 += 1
+                    retry_after = max(1, int(60 - (now - self._window[0])) + 1)
+                    return jitter / 1000, self._throttled(url, retry_after)
+                self._window.append(now)
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.injected_429 += 1
+                return jitter / 1000, self._throttled(url, 1)
+
+            record = self.archive.lookup('GET', url, params)
+            if record is None:
+                self.misses += 1
+                body = json.dumps({"code": 404, "message": f"No recorded response for {url} {params or {}}"})
+                return jitter / 1000, ReplayResponse(url, 404, body)
+            self.served += 1
+
+        latency = self.latency_ms if self.latency_ms is not None else (record.get('elapsed_ms') or 0.0)
+        headers = {'Retry-After': record['retry_after']} if record.get('retry_after') else {}
+        return (latency + jitter) / 1000, ReplayResponse(url, record['status'], record['body'], headers)
+
+    def _throttled(self, url, retry_after):
+        body = json.dumps({"code": 44, "message": "API call limit exceeded (replay)"})
+        return ReplayResponse(url, 429, body, {'Retry-After': str(retry_after)})
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        delay, response = self._respond(url, params)
+        if delay > 0:
+            time.sleep(delay)
+        return response
+
+    async def get_async(self, url, headers=None, params=None):
+        delay, response = self._respond(url, params)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return response
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        """Token refreshes succeed with a dummy token."""
+        return ReplayResponse(url, 200, json.dumps({"access_token": "replay-token", "expires_in": 3600}))
+
+    def close(self):
+        pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "served": self.served,
+                "misses": self.misses,
+                "injected_429": self.injected_429,
+                "quota_429": self.quota_429,
+            }
+
+
+class AsyncReplayTransport:
+    """httpx.AsyncClient-shaped view of a ReplayTransport."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def get(self, url, headers=None, params=None):
+        return await self.transport.get_async(url, headers=headers, params=params)
+
+    async def aclose(self):
+        pass
+
+
+_recorder = None
+_replay = None
+_fixtures_lock = threading.Lock()
+
+def get_recorder():
+    """Returns the process-wide recorder (record mode), creating it on first use."""
+    global _recorder
+    with _fixtures_lock:
+        if _recorder is None:
+            _recorder = FixtureRecorder(DEFAULT_FIXTURE_PATH)
+            import atexit
+            atexit.register(_recorder.close)
+        return _recorder
+
+def get_replay_transport():
+    """Returns the process-wide replay transport, loading the archive on first use."""
+    global _replay
+    with _fixtures_lock:
+        if _replay is None:
+            archive = FixtureArchive(DEFAULT_FIXTURE_PATH)
+            print(f"Replaying {len(archive)} recorded Zoho responses from {archive.path}")
+            _replay = ReplayTransport(archive)
+        return _replay
+
+def configure(mode, path=None, **replay_options):
+    """
+    Switches the HTTP mode for clients created from now on (see
+    zoho_client.configure_client). path overrides ZOHO_FIXTURE_PATH and
+    replay_options are passed to ReplayTransport. Returns the replay transport
+    in replay mode, the recorder in record mode, otherwise None.
+    """
+    global HTTP_MODE, DEFAULT_FIXTURE_PATH, _recorder, _replay
+    with _fixtures_lock:
+        HTTP_MODE = mode
+        if path is not None:
+            DEFAULT_FIXTURE_PATH = path
+        if _recorder is not None:
+            _recorder.close()
+        _recorder = None
+        _replay = None
+        if mode == 'replay':
+            _replay = ReplayTransport(FixtureArchive(DEFAULT_FIXTURE_PATH), **replay_options)
+            return _replay
+    if mode == 'record':
+        return get_recorder()
+    return None
+
+def wrap_session(session):
+    """Returns the transport ZohoClient should use in the current mode in place of session."""
+    if HTTP_MODE == 'record':
+        return RecordingTransport(session, get_recorder())
+    if HTTP_MODE == 'replay':
+        session.close()
+        return get_replay_transport()
+    return session
+
+def wrap_async_client(create_client):
+    """
+    Returns the transport AsyncZohoClient should use in the current mode.
+    create_client() builds the httpx.AsyncClient; it is not called in replay mode.
+    """
+    if HTTP_MODE == 'replay':
+        return AsyncReplayTransport(get_replay_transport())
+    client = create_client()
+    if HTTP_MODE == 'record':
+        return AsyncRecordingTransport(client, get_recorder())
+    return client
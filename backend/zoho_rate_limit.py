@@ -0,0 +1,156 @@
+# Process-wide rate limiter for Zoho Inventory API calls.
+#
+# Every Zoho GET goes through zoho_client.ZohoClient.get, which calls
+# acquire() before it sends the request (AsyncZohoClient.get awaits
+# acquire_async()), so concurrent syncs and API-triggered fetches draw from
+# the same per-minute and per-day budgets instead of each discovering the
+# limit through 429 responses. Each budget is a sliding-window log, so no
+# 60-second (or 24-hour) window ever holds more than the budget, however the
+# window is placed: a fresh process cannot burst a full minute's budget on top
+# of the requests it goes on to send in that minute.
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+# Zoho Inventory allows 100 requests per minute per organization. The daily
+# allowance depends on the plan, so both budgets can be overridden.
+DEFAULT_REQUESTS_PER_MINUTE = int(os.environ.get('ZOHO_RATE_LIMIT_PER_MINUTE', '100'))
+DEFAULT_REQUESTS_PER_DAY = int(os.environ.get('ZOHO_RATE_LIMIT_PER_DAY', '10000'))
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request cannot be admitted within the caller's timeout."""
+
+
+class SlidingWindowLog:
+    """Admits at most `limit` requests in any `period`-second window, keeping the send times of the last `limit`."""
+
+    def __init__(self, limit, period):
+        self.limit = int(limit)
+        self.period = float(period)
+        self._times = deque()
+
+    def _expire(self, now):
+        while self._times and now - self._times[0] >= self.period:
+            self._times.popleft()
+
+    def wait_time(self, now):
+        """Seconds until one more request fits in the window (0 if one fits now)."""
+        self._expire(now)
+        if len(self._times) < self.limit:
+            return 0.0
+        return self._times[0] + self.period - now
+
+    def take(self, now):
+        self._times.append(now)
+
+    def available(self, now):
+        self._expire(now)
+        return self.limit - len(self._times)
+
+
+class ZohoRateLimiter:
+    """
+    Admits requests only when both the per-minute and the per-day window have
+    room. Callers block (outside the lock) until they are admitted, so requests
+    stay within the budget rather than bursting into 429s.
+    """
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, requests_per_day=DEFAULT_REQUESTS_PER_DAY):
+        self.requests_per_minute = requests_per_minute
+        self.requests_per_day = requests_per_day
+        self._minute_window = SlidingWindowLog(requests_per_minute, 60)
+        self._day_window = SlidingWindowLog(requests_per_day, 24 * 60 * 60)
+        self._lock = threading.Lock()
+        self.total_acquired = 0
+        self.total_wait_seconds = 0.0
+
+    def _try_acquire(self):
+        """Records a request in both windows if it fits; otherwise returns the wait needed."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._minute_window.wait_time(now), self._day_window.wait_time(now))
+            if wait <= 0:
+                self._minute_window.take(now)
+                self._day_window.take(now)
+                self.total_acquired += 1
+            return wait
+
+    def acquire(self, timeout=None):
+        """
+        Blocks until a request may be sent. Raises RateLimitExceeded if a
+        timeout (in seconds) is given and admission would take longer.
+        """
+        started = time.monotonic()
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                waited = time.monotonic() - started
+                if waited > 0:
+                    with self._lock:
+                        self.total_wait_seconds += waited
+                return
+            if timeout is not None and (time.monotonic() - started) + wait > timeout:
+                raise RateLimitExceeded(f"Zoho rate limit budget exhausted; next slot in {wait:.1f}s")
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout=None):
+        """Same as acquire(), but waits with asyncio.sleep so the event loop keeps running."""
+        started = time.monotonic()
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                waited = time.monotonic() - started
+                if waited > 0:
+                    with self._lock:
+                        self.total_wait_seconds += waited
+                return
+            if timeout is not None and (time.monotonic() - started) + wait > timeout:
+                raise RateLimitExceeded(f"Zoho rate limit budget exhausted; next slot in {wait:.1f}s")
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        """Returns a snapshot of remaining budget and totals for logging."""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "requests_per_day": self.requests_per_day,
+                "minute_requests_available": self._minute_window.available(now),
+                "day_requests_available": self._day_window.available(now),
+                "total_acquired": self.total_acquired,
+                "total_wait_seconds": round(self.total_wait_seconds, 3),
+            }
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_rate_limiter():
+    """Returns the process-wide limiter, creating it on first use."""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = ZohoRateLimiter()
+    return _limiter
+
+def acquire(timeout=None):
+    """Waits for a slot in the shared Zoho request budget."""
+    get_rate_limiter().acquire(timeout=timeout)
+
+async def acquire_async(timeout=None):
+    """Waits (without blocking the event loop) for a slot in the shared Zoho request budget."""
+    await get_rate_limiter().acquire_async(timeout=timeout)
+
+def configure_rate_limiter(**kwargs):
+    """
+    Replaces the process-wide limiter with one built from kwargs
+    (requests_per_minute, requests_per_day). Clients created afterwards use it.
+    """
+    global _limiter
+    with _limiter_lock:
+        _limiter = ZohoRateLimiter(**kwargs)
+    return _limiter
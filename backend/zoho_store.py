@@ -0,0 +1,185 @@
+# Local store of Zoho documents shared by every consumer of Zoho data.
+#
+# STEP1, generate_serial_history and the data_processing API all need the
+# same sales orders, packages and sales returns. Instead of each fetching
+# them, document_sync keeps one SQLite file current and the consumers derive
+# their inputs from it:
+#   - STEP1.write_step1_output_from_store writes a clinic group's Step 1 file;
+#   - generate_serial_history.build_serial_history_from_store builds the
+#     serial history (also used by the data_processing API with
+#     CLINIC_SYNC_SOURCE=store, while the store's syncs are recent).
+#
+# Each document is stored under (doc_type, doc_id) as the object Zoho returns
+# inside its detail response (the 'salesorder', 'package' or 'salesreturn'
+# object), together with the value document_sync compares to decide whether
+# it changed: last_modified_time for sales orders, STEP1.package_validator
+# for packages, and STEP1.salesreturn_change_key for sales returns.
+# Documents are returned in the order they were first stored.
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_STORE_PATH = os.environ.get(
+    'ZOHO_STORE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zoho_documents.sqlite3')
+)
+# Rows read per query while iterating over documents.
+ITERATION_BATCH_SIZE = 500
+# How recent a sync must be for consumers outside a sync run (the data_processing
+# API) to derive their inputs from the store rather than call Zoho.
+MAX_SYNC_AGE_HOURS = float(os.environ.get('ZOHO_STORE_MAX_AGE_HOURS', '24'))
+
+
+class ZohoDocumentStore:
+    """SQLite-backed store of Zoho documents keyed by (doc_type, doc_id)."""
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        # One connection shared by all worker threads; every access holds self._lock.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_type TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                customer_id TEXT,
+                modified_time TEXT,
+                payload TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (doc_type, doc_id)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_customer ON documents (doc_type, customer_id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sync_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def put(self, doc_type, doc_id, document, modified_time=None, customer_id=None):
+        """Inserts or replaces a document. A replaced document keeps its position in iteration order."""
+        data = json.dumps(document, separators=(',', ':'))
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO documents (doc_type, doc_id, customer_id, modified_time, payload, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (doc_type, doc_id) DO UPDATE SET
+                    customer_id = excluded.customer_id, modified_time = excluded.modified_time,
+                    payload = excluded.payload, fetched_at = excluded.fetched_at
+                """,
+                (doc_type, str(doc_id), customer_id, _text(modified_time), data, time.time())
+            )
+            self._conn.commit()
+
+    def get(self, doc_type, doc_id):
+        """Returns the stored document, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM documents WHERE doc_type = ? AND doc_id = ?", (doc_type, str(doc_id))
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def modified_times(self, doc_type):
+        """Returns {doc_id: modified_time} for every stored document of a type."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc_id, modified_time FROM documents WHERE doc_type = ?", (doc_type,)
+            ).fetchall()
+        return dict(rows)
+
+    def iter_documents(self, doc_type, customer_id=None):
+        """
+        Yields (doc_id, modified_time, document) for every document of a type (or
+        only a customer's), in the order they were first stored. Rows are read in
+        batches, so the store is not locked while the caller works.
+        """
+        query = "SELECT rowid, doc_id, modified_time, payload FROM documents WHERE doc_type = ? AND rowid > ?"
+        if customer_id is not None:
+            query += " AND customer_id = ?"
+        query += " ORDER BY rowid LIMIT ?"
+        last_rowid = 0
+        while True:
+            args = [doc_type, last_rowid] + ([customer_id] if customer_id is not None else []) + [ITERATION_BATCH_SIZE]
+            with self._lock:
+                rows = self._conn.execute(query, args).fetchall()
+            if not rows:
+                return
+            for rowid, doc_id, modified_time, payload in rows:
+                yield doc_id, modified_time, json.loads(payload)
+            last_rowid = rows[-1][0]
+
+    def delete_missing(self, doc_type, keep_ids):
+        """Deletes the documents of a type whose id is not in keep_ids. Returns how many were deleted."""
+        keep = {str(doc_id) for doc_id in keep_ids}
+        stale = [doc_id for doc_id in self.modified_times(doc_type) if doc_id not in keep]
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM documents WHERE doc_type = ? AND doc_id = ?", [(doc_type, doc_id) for doc_id in stale]
+            )
+            self._conn.commit()
+        return len(stale)
+
+    def count(self, doc_type):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents WHERE doc_type = ?", (doc_type,)).fetchone()[0]
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sync_meta VALUES (?, ?)", (key, json.dumps(value)))
+            self._conn.commit()
+
+    def synced_within(self, key, max_age_hours=MAX_SYNC_AGE_HOURS):
+        """True if the sync time stored under meta key (e.g. 'synced_at') is less than max_age_hours old."""
+        synced_at = self.get_meta(key)
+        try:
+            age = datetime.now() - datetime.fromisoformat(synced_at)
+        except (TypeError, ValueError):
+            return False
+        return age.total_seconds() < max_age_hours * 3600
+
+    def stats(self):
+        """Returns document counts by type for logging."""
+        with self._lock:
+            rows = self._conn.execute("SELECT doc_type, COUNT(*) FROM documents GROUP BY doc_type").fetchall()
+        return {"documents": dict(rows), "synced_at": self.get_meta('synced_at')}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Returns the process-wide document store, creating it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ZohoDocumentStore()
+    return _store
+
+def configure_store(path):
+    """Replaces the process-wide store with one at path (e.g. from a CLI flag)."""
+    global _store
+    with _store_lock:
+        old_store = _store
+        _store = ZohoDocumentStore(path)
+    if old_store is not None:
+        old_store.close()
+    return _store
@@ -0,0 +1,238 @@
+# Per-endpoint telemetry for Zoho API calls.
+#
+# Every GET ZohoClient or AsyncZohoClient sends is recorded with its latency,
+# response size and status under the endpoint it called (see
+# zoho_client.endpoint_label: 'salesorders', 'salesorders/{id}',
+# 'packages/{id}', 'salesreturns/{id}', 'items/serialnumbers', ...) and the
+# clinic group it was made for. The zoho_get implementations add what only
+# they know: retries, 401 token refreshes and time spent waiting after 429s.
+#
+# The clinic group is a context variable set with clinic_group(); asyncio
+# tasks and asyncio.to_thread inherit it, and STEP1.map_concurrently passes it
+# on to its worker threads.
+#
+# Counters accumulate twice: in the process-wide ZohoTelemetry (snapshot(),
+# served by the API) and in every report opened with collect() while the call
+# is made, which gives a structured report for one sync.
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Upper bounds (milliseconds) of the latency histogram buckets; slower calls go to the last bucket.
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Group recorded for calls made outside any clinic_group() block.
+NO_GROUP = '(none)'
+
+_current_group = contextvars.ContextVar('zoho_clinic_group', default=NO_GROUP)
+
+
+def _bucket_label(index):
+    if index < len(LATENCY_BUCKETS_MS):
+        return f"<={LATENCY_BUCKETS_MS[index]}ms"
+    return f">{LATENCY_BUCKETS_MS[-1]}ms"
+
+
+class EndpointStats:
+    """Counters for one (clinic group, endpoint) pair."""
+
+    def __init__(self):
+        self.requests = 0
+        self.failed_requests = 0 # No response at all (connection errors, timeouts)
+        self.statuses = {}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.bytes_received = 0
+        self.rate_limit_wait = 0.0 # Time spent waiting for the client-side rate limiter
+        self.retries = 0
+        self.token_refreshes = 0
+        self.throttle_wait = 0.0 # Time spent waiting after 429 responses
+
+    def add_request(self, status, latency, nbytes, rate_limit_wait):
+        self.requests += 1
+        if status is None:
+            self.failed_requests += 1
+        else:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        latency_ms = latency * 1000
+        index = 0
+        while index < len(LATENCY_BUCKETS_MS) and latency_ms > LATENCY_BUCKETS_MS[index]:
+            index += 1
+        self.latency_buckets[index] += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.bytes_received += nbytes
+        self.rate_limit_wait += rate_limit_wait
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.failed_requests += other.failed_requests
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.latency_buckets = [a + b for a, b in zip(self.latency_buckets, other.latency_buckets)]
+        self.total_latency += other.total_latency
+        self.max_latency = max(self.max_latency, other.max_latency)
+        self.bytes_received += other.bytes_received
+        self.rate_limit_wait += other.rate_limit_wait
+        self.retries += other.retries
+        self.token_refreshes += other.token_refreshes
+        self.throttle_wait += other.throttle_wait
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "failed_requests": self.failed_requests,
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "latency_histogram": {_bucket_label(i): count for i, count in enumerate(self.latency_buckets)},
+            "mean_latency_ms": round(self.total_latency * 1000 / self.requests, 1) if self.requests else None,
+            "max_latency_ms": round(self.max_latency * 1000, 1),
+            "bytes_received": self.bytes_received,
+            "rate_limit_wait_seconds": round(self.rate_limit_wait, 3),
+            "retries": self.retries,
+            "token_refreshes": self.token_refreshes,
+            "throttle_wait_seconds": round(self.throttle_wait, 3),
+        }
+
+
+class ZohoTelemetry:
+    """Thread-safe EndpointStats keyed by (clinic group, endpoint)."""
+
+    def __init__(self, name=None):
+        self.name = name
+        self.started_at = datetime.now().isoformat()
+        self._started = time.monotonic()
+        self.finished_at = None
+        self._elapsed = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _entry(self, group, endpoint):
+        key = (group, endpoint)
+        if key not in self._stats:
+            self._stats[key] = EndpointStats()
+        return self._stats[key]
+
+    def add_request(self, group, endpoint, status, latency, nbytes, rate_limit_wait):
+        with self._lock:
+            self._entry(group, endpoint).add_request(status, latency, nbytes, rate_limit_wait)
+
+    def add_retry(self, group, endpoint, token_refresh=False, throttle_wait=0.0):
+        with self._lock:
+            entry = self._entry(group, endpoint)
+            entry.retries += 1
+            if token_refresh:
+                entry.token_refreshes += 1
+            entry.throttle_wait += throttle_wait
+
+    def finish(self):
+        self.finished_at = datetime.now().isoformat()
+        self._elapsed = time.monotonic() - self._started
+
+    def as_dict(self):
+        """Returns the counters by endpoint, by clinic group (and endpoint), and in total."""
+        with self._lock:
+            stats = list(self._stats.items())
+        by_endpoint = {}
+        by_group = {}
+        total = EndpointStats()
+        for (group, endpoint), entry in sorted(stats, key=lambda item: item[0]):
+            by_endpoint.setdefault(endpoint, EndpointStats()).merge(entry)
+            by_group.setdefault(group, {})[endpoint] = entry.as_dict()
+            total.merge(entry)
+        elapsed = self._elapsed if self._elapsed is not None else time.monotonic() - self._started
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_seconds": round(elapsed, 3),
+            "total": total.as_dict(),
+            "by_endpoint": {endpoint: entry.as_dict() for endpoint, entry in by_endpoint.items()},
+            "by_clinic_group": by_group,
+        }
+
+
+_telemetry = ZohoTelemetry('process')
+_reports = [] # Reports opened with collect() that are still collecting
+_reports_lock = threading.Lock()
+last_report = None # as_dict() of the most recently finished report
+
+def _sinks():
+    with _reports_lock:
+        return [_telemetry, *_reports]
+
+def current_group():
+    return _current_group.get()
+
+@contextmanager
+def clinic_group(name):
+    """Attributes the Zoho calls made inside the block (and its tasks and worker threads) to a clinic group."""
+    token = _current_group.set(name)
+    try:
+        yield
+    finally:
+        _current_group.reset(token)
+
+def record_request(endpoint, response, latency, rate_limit_wait=0.0):
+    """Records one GET that was sent (response is None if it failed without one)."""
+    status = getattr(response, 'status_code', None)
+    nbytes = len(response.content or b'') if response is not None else 0
+    group = _current_group.get()
+    for sink in _sinks():
+        sink.add_request(group, endpoint, status, latency, nbytes, rate_limit_wait)
+
+def record_retry(endpoint, token_refresh=False, throttle_wait=0.0):
+    """Records a retried GET: after a 401 token refresh, or after waiting throttle_wait seconds on a 429."""
+    group = _current_group.get()
+    for sink in _sinks():
+        sink.add_retry(group, endpoint, token_refresh, throttle_wait)
+
+def snapshot():
+    """Returns the process-wide counters since startup (or the last reset())."""
+    return _telemetry.as_dict()
+
+def reset():
+    """Clears the process-wide counters."""
+    global _telemetry
+    with _reports_lock:
+        _telemetry = ZohoTelemetry('process')
+
+@contextmanager
+def collect(name):
+    """
+    Collects the Zoho calls made while the block runs into a new report, which
+    is yielded. Concurrent blocks each see every call made meanwhile. On exit
+    the report is finished and its dict kept in last_report.
+    """
+    global last_report
+    report = ZohoTelemetry(name)
+    with _reports_lock:
+        _reports.append(report)
+    try:
+        yield report
+    finally:
+        with _reports_lock:
+            _reports.remove(report)
+        report.finish()
+        last_report = report.as_dict()
+
+def write_report(report, path):
+    """Writes a report's dict to path as JSON (via a temporary file)."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(report.as_dict(), f, indent=2)
+    os.replace(temp_path, path)
+
+def print_summary(report):
+    """Prints one line per endpoint of a report."""
+    data = report.as_dict()
+    total = data['total']
+    print(f"Zoho calls ({data['name']}): {total['requests']} requests, {total['bytes_received']} bytes, "
+          f"{total['retries']} retries, {total['token_refreshes']} token refreshes, "
+          f"{total['throttle_wait_seconds']}s waiting on 429s in {data['elapsed_seconds']}s")
+    for endpoint, stats in data['by_endpoint'].items():
+        print(f"  {endpoint}: {stats['requests']} requests, mean {stats['mean_latency_ms']} ms, "
+              f"max {stats['max_latency_ms']} ms, {stats['bytes_received']} bytes, {stats['retries']} retries")